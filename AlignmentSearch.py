@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Parallel evaluation of the (pad event, pixel event) alignment candidates
+tried in TimingAlignment.find_first_alignment.
+
+The candidates are evaluated speculatively by a pool of worker processes which
+share the already loaded time stamp arrays (inherited on fork). Once a
+candidate passes the good match threshold, the workers skip the candidates
+which the serial search would not try anymore. The serial search is then
+replayed on the results, so the chosen alignment is the same as before.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import multiprocessing
+
+import numpy
+
+from EventMatching import match_events
+
+
+###############################
+# Residuals of one candidate
+###############################
+
+def candidate_residuals(t_pad, t_pixel, i_align_pad, i_align_pixel, offset, slope, n_events, search_width=10,
+                        i_start=1, first_pad=0):
+    """ Residuals t_pixel - t_pad of n_events-1 pad events (starting at first_pad) for one
+    alignment candidate. Same as the matching loop of find_first_alignment: the search starts
+    around pixel event i_start - 1 (default: 0) and every window is centered one event after
+    the previous best match.
+    """
+    pad_0 = t_pad[i_align_pad - 1]
+    pixel_0 = t_pixel[i_align_pixel]
+    match = match_events(t_pad[first_pad:first_pad + n_events - 1], t_pixel, pixel_0, pad_0, offset, slope,
+                         i_start=i_start, search_width=search_width, step=2)
+    return match[1]
+
+
+def residual_stats(residuals, x_min=-0.04, x_max=0.04):
+    """ Integral, mean and RMS as a TH1 with range [x_min, x_max) would report them.
+    Return [integral, mean, rms]
+    """
+    in_range = residuals[(residuals >= x_min) & (residuals < x_max)]
+    if len(in_range) == 0:
+        return [0, 0., 0.]
+    mean = in_range.mean()
+    rms = numpy.sqrt(max(0., (in_range * in_range).mean() - mean * mean))
+    return [len(in_range), mean, rms]
+
+
+def alignment_candidates(max_align_pad=10, max_align_pixel=80, max_align_pixel_later=40):
+    """ All candidates the serial search might try, in the order it tries them.
+    Return a list of [rank, i_align_pad, i_align_pixel]
+    """
+    candidates = []
+    for i_align_pad in xrange(1, max_align_pad):
+        if i_align_pad == 1:
+            n_pixel = max_align_pixel
+        else:
+            n_pixel = max_align_pixel_later
+        for i_align_pixel in xrange(n_pixel):
+            candidates.append([len(candidates), i_align_pad, i_align_pixel])
+    return candidates
+
+
+###############################
+# Cross-correlation seeding
+###############################
+
+def _standardize(values):
+    """ Zero mean, unit variance (a constant series stays zero) """
+    values = values - values.mean()
+    std = values.std()
+    if std > 0:
+        values = values / std
+    return values
+
+
+def correlation_offsets(t_pad, t_pixel, max_offset, n_top=5, min_overlap=100):
+    """ Find the index offsets between pad and pixel events from the time differences
+    between consecutive events. Pad event i corresponds to pixel event i + offset.
+
+    The cross-correlation of the (standardized) time difference series is calculated
+    with an FFT for all offsets in [-max_offset, max_offset] and normalized by the
+    number of overlapping events.
+
+    :param t_pad: pad time stamps [s]
+    :param t_pixel: pixel time stamps [clock ticks, 25 ns]
+    :return: list of [offset, correlation] for the n_top best offsets, best first
+    """
+    dt_pad = _standardize(numpy.diff(t_pad))
+    dt_pixel = _standardize(numpy.diff(t_pixel) * 25e-9)
+    n_pad = len(dt_pad)
+    n_pixel = len(dt_pixel)
+    if n_pad == 0 or n_pixel == 0:
+        return []
+
+    # Zero padding to at least n_pad + n_pixel avoids wrap-around
+    n_fft = 1
+    while n_fft < n_pad + n_pixel:
+        n_fft *= 2
+    corr = numpy.fft.irfft(numpy.conj(numpy.fft.rfft(dt_pad, n_fft)) * numpy.fft.rfft(dt_pixel, n_fft), n_fft)
+
+    offsets = numpy.arange(-max_offset, max_offset + 1)
+    overlap = numpy.minimum(n_pad, n_pixel - offsets) - numpy.maximum(0, -offsets)
+    offsets = offsets[overlap >= min_overlap]
+    overlap = overlap[overlap >= min_overlap]
+    if len(offsets) == 0:
+        return []
+    score = corr[offsets % n_fft] / overlap
+
+    best = numpy.argsort(-score)[:n_top]
+    return [[int(offsets[i]), float(score[i])] for i in best]
+
+
+def offset_to_candidate(offset):
+    """ Convert an index offset to an alignment candidate [i_align_pad, i_align_pixel]
+    (as used by find_first_alignment: pad event i_align_pad-1 <-> pixel event i_align_pixel)
+    """
+    if offset >= 0:
+        return [1, offset]
+    return [1 - offset, 0]
+
+
+###############################
+# Worker processes
+###############################
+
+# State shared with the worker processes (set before the fork)
+_shared = {}
+
+
+def _init_worker(shared):
+    _shared.update(shared)
+
+
+def _evaluate(candidate):
+    """ Evaluate one candidate in a worker. Return [i_align_pad, i_align_pixel, residuals]
+    or residuals = None if the candidate was cancelled.
+    """
+    rank, i_align_pad, i_align_pixel = candidate
+    first_good = _shared["first_good"]
+    first_candidate = _shared["first_candidate"]
+
+    # Candidates the serial search skips after a good match / after any candidate
+    if i_align_pixel >= 20 and first_good.value < rank:
+        return [i_align_pad, i_align_pixel, None]
+    if i_align_pixel >= 40 and first_candidate.value < rank:
+        return [i_align_pad, i_align_pixel, None]
+
+    residuals = candidate_residuals(_shared["t_pad"], _shared["t_pixel"], i_align_pad, i_align_pixel,
+                                    _shared["offset"], _shared["slope"], _shared["n_events"])
+    integral, mean, rms = residual_stats(residuals)
+    if integral > 900:
+        with first_candidate.get_lock():
+            first_candidate.value = min(first_candidate.value, rank)
+        if rms < _shared["good_match_threshold"]:
+            with first_good.get_lock():
+                first_good.value = min(first_good.value, rank)
+    return [i_align_pad, i_align_pixel, residuals]
+
+
+###############################
+# evaluate_candidates
+###############################
+
+def evaluate_candidates(t_pad, t_pixel, offset, slope, n_events, good_match_threshold, n_workers):
+    """ Evaluate the alignment candidates on n_workers processes.
+    Return a dictionary (i_align_pad, i_align_pixel) -> residuals.
+    Cancelled candidates are missing, they have to be evaluated with candidate_residuals.
+    """
+    if n_workers <= 1:
+        return {}
+
+    no_rank = len(alignment_candidates()) + 1
+    shared = {"t_pad": t_pad,
+              "t_pixel": t_pixel,
+              "offset": offset,
+              "slope": slope,
+              "n_events": n_events,
+              "good_match_threshold": good_match_threshold,
+              "first_good": multiprocessing.Value('i', no_rank),
+              "first_candidate": multiprocessing.Value('i', no_rank)}
+
+    pool = multiprocessing.Pool(n_workers, _init_worker, (shared,))
+    results = {}
+    try:
+        for i_align_pad, i_align_pixel, residuals in pool.imap(_evaluate, alignment_candidates()):
+            if residuals is not None:
+                results[(i_align_pad, i_align_pixel)] = residuals
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+# End of evaluate_candidates
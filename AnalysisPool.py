@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Pool of warm worker processes running Analyze.analyzeRun.
+
+Every worker imports ROOT and Analyze and loads the run information once, then
+analyses the runs it gets from the task queue one after the other. For every
+run the worker sends back a status and the time it took. The output of a run
+(also of ROOT) goes to results/run_<run>/analyze.log.
+
+A worker which dies (e.g. crash in ROOT) is replaced, its run is reported as
+crashed.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+
+
+###############################
+# Worker
+###############################
+
+def log_file_name(run):
+    return "results/run_{0}/analyze.log".format(run)
+
+
+def _analyze(run, fit_engine):
+    """ Analyze.analyzeRun with stdout and stderr (of python and C++) redirected to the log file.
+    Return [status, error] """
+    import Analyze
+
+    if not os.path.exists(os.path.dirname(log_file_name(run))):
+        os.makedirs(os.path.dirname(log_file_name(run)))
+    log = open(log_file_name(run), "w")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        # The workers are daemonic processes, which can not start processes for the fits themselves
+        if Analyze.analyzeRun(run, fit_engine, n_workers=1):
+            return ["done", None]
+        return ["missing pedestal", None]
+    except Exception:
+        traceback.print_exc()
+        return ["failed", traceback.format_exc()]
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        log.close()
+
+
+def _worker(tasks, results, fit_engine):
+    start = time.time()
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    import Analyze
+    from RunInfo import RunInfo
+    RunInfo.load("runs.db")
+    startup = time.time() - start
+
+    while True:
+        run = tasks.get()
+        if run is None:
+            break
+        results.put({"run": run, "status": "started", "worker": os.getpid()})
+        start = time.time()
+        status, error = _analyze(run, fit_engine)
+        results.put({"run": run, "status": status, "error": error, "worker": os.getpid(),
+                     "time": time.time() - start, "startup": startup})
+        # The startup time is only counted once per worker
+        startup = 0.
+
+
+###############################
+# Class: AnalysisPool
+###############################
+
+class AnalysisPool:
+    """ Warm worker processes for Analyze.analyzeRun, see module documentation.
+
+    Example:
+    pool = AnalysisPool(n_workers=8)
+    for run in runs:
+        pool.submit(run)
+    for result in pool.wait():
+        print result["run"], result["status"], result["time"]
+    pool.close()
+    """
+
+    def __init__(self, n_workers=None, fit_engine='numpy'):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.fit_engine = fit_engine
+        self.tasks = multiprocessing.Queue()
+        # Written synchronously (no feeder thread): the messages of a worker which crashes are not lost
+        self.results = SimpleQueue()
+        self.workers = []
+        # Run of every worker (pid) which is busy
+        self.running = {}
+        self.pending = 0
+        for i_worker in range(n_workers):
+            self.start_worker()
+
+    # End __init__
+
+    def start_worker(self):
+        worker = multiprocessing.Process(target=_worker, args=(self.tasks, self.results, self.fit_engine))
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+
+    def submit(self, run):
+        """ Queue a run for analysis """
+        self.tasks.put(run)
+        self.pending += 1
+
+    def result(self):
+        """ Wait for the next finished run. Return a dictionary with run, status ('done', 'failed',
+        'missing pedestal' or 'crashed'), error (traceback), worker (pid), time and startup [s] """
+        while True:
+            result = self.poll()
+            if result is not None:
+                return result
+            time.sleep(0.1)
+
+    def poll(self):
+        """ Result of a finished run (see result) or None if no run finished """
+        while not self.results.empty():
+            result = self.results.get()
+            if result["status"] == "started":
+                self.running[result["worker"]] = [result["run"], time.time()]
+                continue
+            self.running.pop(result["worker"], None)
+            self.pending -= 1
+            return result
+        return self.check_workers()
+
+    def check_workers(self):
+        """ Replace a dead worker, return the result of the run it had or None """
+        for worker in self.workers:
+            if worker.is_alive():
+                continue
+            if worker.pid not in self.running:
+                # Died while idle, e.g. ROOT can not be imported
+                raise Exception('analysis worker {0} died (exit code {1})'.format(worker.pid, worker.exitcode))
+            self.workers.remove(worker)
+            self.start_worker()
+            run, start = self.running.pop(worker.pid)
+            self.pending -= 1
+            return {"run": run, "status": "crashed", "worker": worker.pid, "time": time.time() - start,
+                    "startup": 0., "error": "exit code {0}".format(worker.exitcode)}
+        return None
+
+    def wait(self):
+        """ Iterate over the results of all submitted runs as they finish """
+        while self.pending > 0:
+            yield self.result()
+
+    def close(self):
+        """ Stop the workers (after the queued runs) """
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+# End of class AnalysisPool
@@ -9,15 +9,26 @@ Analysis of the Runs and plot production
 ###############################
 
 import ROOT, copy, sys, math
+import numpy
+import LandauFit
 from RunInfo import RunInfo
 import AnalyzeHelpers as ah
+from BranchReader import BranchReader
+from HistoArrays import ArrayFiller, histogram_contents, shift_histogram, extend_histogram
+from HistoCache import HistoCache, tree_fingerprint, histogram_binning
+from FitCache import FitCache, cached_fit
 
 ###############################
 # Usage
 ###############################
 def usage():
     print 'use this thusly:'
-    print '    ./Analyze.py <runnumber>'
+    print '    ./Analyze.py <runnumber> [fit engine]'
+    print '    ./Analyze.py <runnumber> fast [check]'
+    print '    fit engine: numpy (default, Landau), langau (Landau (x) Gauss), root (TF1 fits)'
+    print '                or fast (XY map without fits: mode, truncated mean and FWHM, check: compare to'
+    print '                Landau fits; time slices as numpy)'
+    print '    numpy and langau fit all XY bins and all time slices in one batch each'
     return
 
 
@@ -28,12 +39,78 @@ def usage():
 ROOT.gStyle.SetPalette(53)
 ROOT.gStyle.SetNumberContours( 999 )
 
+###############################
+# raw pulse height histograms
+###############################
+
+# the pulse heights are stored without pedestal subtraction in fine bins and shifted when
+# the histograms are made, the raw range has to cover the final one shifted by the pedestal.
+# a raw bin across an edge of the final bins is split in proportion, fine raw bins keep the
+# error of this small: 0.25 wide, 1/16 of the final bin width for h_3dfull (4), 1/4 for
+# h_time_2d (1). h_3draw takes 27 x 27 x 4002 floats (12 MB)
+raw_range     = [-500., 500.]
+raw_bins_3d   = 4000
+raw_bins_time = 4000
+
+def rawHistograms(n_time_bins):
+    """ empty h_3draw and h_time_2draw for the integral50 values """
+    h_3draw = ROOT.TH3F('h_3draw','3D histogram (no pedestal subtraction)', 
+         25,   -0.30,   0.20, 
+         25,   -0.10,   0.40, 
+        raw_bins_3d, raw_range[0], raw_range[1])
+    h_time_2draw = ROOT.TH2F('h_time_2draw', 'h_time_2draw', n_time_bins, 0., n_time_bins, raw_bins_time, raw_range[0], raw_range[1])
+    return h_3draw, h_time_2draw
+
+def pedestalHistograms(h_3draw, h_time_2draw, pedestal):
+    """ h_3dfull and h_time_2d with the pedestal subtracted from the raw histograms """
+    if not (raw_range[0] <= pedestal - 400. and pedestal + 400. <= raw_range[1]):
+        print 'WARNING: pedestal %.1f shifts the histograms out of the stored range' %(pedestal)
+    h_3d = ROOT.TH3F('h_3dfull','3D histogram', 
+         25,   -0.30,   0.20, 
+         25,   -0.10,   0.40, 
+        200, -400.00, 400.00)
+    n_time_bins = h_time_2draw.GetNbinsX()
+    h_time_2d = ROOT.TH2F('h_time_2d', 'h_time_2d', n_time_bins, 0., n_time_bins, 500, -250., 250.)
+    shift_histogram(h_3draw, h_3d, pedestal)
+    shift_histogram(h_time_2draw, h_time_2d, pedestal)
+    return h_3d, h_time_2d
+
+###############################
+# entries in the cached histograms
+###############################
+
+# compared to check that the tree was only extended since the histograms were filled
+check_keys = ['n_pad', 't_pad', 'track_x', 'track_y', 'integral50']
+
+def fillState(reader, tree, n_entries):
+    """ description of the first n_entries of the tree, stored with the histograms filled with them """
+    state = {'tree': tree_fingerprint(tree), 'entries': n_entries}
+    if n_entries > 0:
+        first_entry = reader.read_entry(['n_pad'], 0)
+        last_entry  = reader.read_entry(check_keys, n_entries-1)
+        state['n_pad'] = [int(first_entry['n_pad']), int(last_entry['n_pad'])]
+        state['last_entry'] = dict((key, float(last_entry[key])) for key in check_keys)
+    return state
+
+def newEntries(reader, tree, state):
+    """ first entry of the tree which isn't in the histograms filled up to state,
+    None if the tree was rewritten since (not only new entries added at the end) """
+    if state['tree'] == tree_fingerprint(tree):
+        return state['entries']
+    if state['entries'] > reader.n_entries:
+        return None
+    current = fillState(reader, tree, state['entries'])
+    current['tree'] = state['tree']
+    if current != state:
+        return None
+    return state['entries']
+
 def getPedestalValue(hist):
     tmp_hist = copy.deepcopy(hist.ProjectionY())
     rms = tmp_hist.GetRMS()
     mp = tmp_hist.GetBinCenter(tmp_hist.GetMaximumBin())
     func = ROOT.TF1('gaus_fit','gaus',mp-rms/2,mp+rms/2)
-    tmp_hist.Fit(func,'','',mp-rms/2,mp+rms/2)
+    cached_fit(ah.fitCache, tmp_hist, func, '', mp-rms/2, mp+rms/2)
     central = func.GetParameter(1)
     c0 = ROOT.TCanvas('foo', 'bar', 600, 600)
     tmp_hist.Draw('')
@@ -42,7 +119,9 @@ def getPedestalValue(hist):
     return central
     
 
-def makeTimePlots(h_time_2d):
+def makeTimePlots(h_time_2d, fit_engine='root'):
+    """ fit_engine 'root': FitSlicesY with TF1,
+    'numpy' / 'langau': all slices at once with a Landau / Landau (x) Gauss (LandauFit) """
     profileY = h_time_2d.ProfileY()
     neg_landau = False
     if profileY.GetMean() < 0.:
@@ -56,7 +135,7 @@ def makeTimePlots(h_time_2d):
 
 
     land = h_time_2d.ProjectionY()
-    land.Fit(func)
+    cached_fit(ah.fitCache, land, func)
     c0 = ROOT.TCanvas('time_canvas', 'Canvas of the time evolution', 600, 300)
     if neg_landau:
         land.GetXaxis().SetRangeUser(-250,0)
@@ -66,8 +145,10 @@ def makeTimePlots(h_time_2d):
     c0.SaveAs('results/run_'+str(my_rn)+'/landau.pdf')
 
 
-    arr = ROOT.TObjArray()
-    h_time_2d.FitSlicesY(func, 0, -1, 0, 'QNR', arr)
+    if fit_engine == 'root':
+        arr = ah.fitSlicesY(h_time_2d, func, 'QNR')
+    else:
+        arr = ah.fitSlicesBatch(h_time_2d, neg_landau, 'langau' if fit_engine == 'langau' else 'landau')
 
     mpvs = arr[1] ## MPVs are fit parameter 1
     if neg_landau:
@@ -100,7 +181,11 @@ def makeTimePlots(h_time_2d):
     return arr
 
 
-def makeXYPlots(h_3d):
+def makeXYPlots(h_3d, n_workers=None, fit_engine='numpy', check=False):
+    """ fit_engine 'numpy' / 'langau': all bins at once with a Landau / Landau (x) Gauss (LandauFit),
+    'root': TF1 fits on n_workers processes,
+    'fast': no fits, mode, truncated mean (lowest 80%) and FWHM instead of MPV, mean and width.
+    check (fast only): compare mode and median to the MPV of Landau fits """
 
     cp2d = copy.deepcopy(h_3d.Project3D('yx'))
 
@@ -134,31 +219,52 @@ def makeXYPlots(h_3d):
     mpvs   = []
     means  = []
     sigmas = []
-    
-    for xbin in range(1,h_3d.GetNbinsX()+1):
-        for ybin in range(1,h_3d.GetNbinsY()+1):
-            z_histo = h_3d.ProjectionZ(h_3d.GetName()+'_pz_'+str(xbin)+'_'+str(ybin), xbin, xbin, ybin, ybin)
-            if z_histo.Integral() < 100.: 
+
+    ## z distributions of all xy bins as arrays (with under- and overflow, as ProjectionZ)
+    nx, ny, nz = h_3d.GetNbinsX(), h_3d.GetNbinsY(), h_3d.GetNbinsZ()
+    contents = histogram_contents(h_3d).reshape(nz+2, ny+2, nx+2)
+    fit_bins = []
+    for xbin in range(1,nx+1):
+        for ybin in range(1,ny+1):
+            z_contents = contents[:, ybin, xbin]
+            if z_contents[1:nz+1].sum() < 100.:
                 continue
-            #print 'at xbin %d and ybin %d' %(xbin, ybin)
-            #z_histo.Fit('landau','q')
-            fit_res = ah.fitLandauGaus(z_histo)
-    
-            ## get the mean and MPV of the landau for all the bins with non-zero integral
-            # mpv = z_histo.GetFunction('landau').GetParameter(1) #fit_res[1].GetParameter(1)
-    
-            #mpv = fit_res.getRealValue('ml')
-            mpv = fit_res[1][1]
-            mpvs.append(mpv)
-            sig = fit_res[1][2]
-            sigmas.append(sig)
-    
-            mean = z_histo.GetMean()
-            means.append(mean)
-            h_2d_mpv  .SetBinContent(xbin, ybin, mpv )
-            h_2d_sigma.SetBinContent(xbin, ybin, sig )
-            h_2d_mean .SetBinContent(xbin, ybin, mean)
-            h_2d_nfill.SetBinContent(xbin, ybin, z_histo.Integral())
+            fit_bins.append([xbin, ybin, z_contents])
+
+    ## the fits start from the results of neighbouring bins: the batch fits from the
+    ## fitted direct neighbours, the TF1 fits go along the columns (one column per process)
+    index = dict(((xbin, ybin), ibin) for ibin, (xbin, ybin, z_contents) in enumerate(fit_bins))
+    neighbours = []
+    for xbin, ybin, z_contents in fit_bins:
+        neighbours.append([index[pos] for pos in [(xbin-1, ybin), (xbin+1, ybin), (xbin, ybin-1), (xbin, ybin+1)] if pos in index])
+    columns = {}
+    for ibin, (xbin, ybin, z_contents) in enumerate(fit_bins):
+        columns.setdefault(xbin, []).append(ibin)
+    chains = [columns[xbin] for xbin in sorted(columns)]
+
+    ## fit the bins, the results come back in order
+    z_min, z_max = h_3d.GetZaxis().GetXmin(), h_3d.GetZaxis().GetXmax()
+    if fit_engine == 'fast':
+        fit_results = ah.estimateLandauBatch([z_contents for xbin, ybin, z_contents in fit_bins], z_min, z_max)
+    elif fit_engine in ['numpy', 'langau']:
+        fit_results = ah.fitLandauBatch([z_contents for xbin, ybin, z_contents in fit_bins], z_min, z_max,
+                                        'langau' if fit_engine == 'langau' else 'landau', neighbours)
+    else:
+        fit_results = ah.fitLandauArrays([z_contents for xbin, ybin, z_contents in fit_bins], z_min, z_max,
+                                         n_workers, chains)
+
+    for (xbin, ybin, z_contents), (fit_res, mean, integral) in zip(fit_bins, fit_results):
+        ## get the mean and MPV of the landau for all the bins with non-zero integral
+        mpv = fit_res[1]
+        mpvs.append(mpv)
+        sig = fit_res[2]
+        sigmas.append(sig)
+
+        means.append(mean)
+        h_2d_mpv  .SetBinContent(xbin, ybin, mpv )
+        h_2d_sigma.SetBinContent(xbin, ybin, sig )
+        h_2d_mean .SetBinContent(xbin, ybin, mean)
+        h_2d_nfill.SetBinContent(xbin, ybin, integral)
     
     ROOT.gStyle.SetOptStat(0)
     
@@ -173,25 +279,29 @@ def makeXYPlots(h_3d):
     c1.cd(2)
     ROOT.gPad.SetTicks(1,1)
     central = ah.mean(means)
-    h_2d_mean.SetTitle('XY distribution of mean PH')
+    h_2d_mean.SetTitle('XY distribution of mean PH' if fit_engine != 'fast' else 'XY distribution of truncated mean PH')
     h_2d_mean.Draw('colz')
     h_2d_mean.GetZaxis().SetRangeUser(central-50., central+50.)
     
     c1.cd(3)
     ROOT.gPad.SetTicks(1,1)
     central = ah.mean(mpvs)
-    h_2d_mpv.SetTitle('XY distribution of MPV of PH')
+    h_2d_mpv.SetTitle('XY distribution of MPV of PH' if fit_engine != 'fast' else 'XY distribution of mode of PH')
     h_2d_mpv.Draw('colz')
     h_2d_mpv.GetZaxis().SetRangeUser(central-40., central+40.)
     
     c1.cd(4)
     ROOT.gPad.SetTicks(1,1)
     central = ah.mean(sigmas)
-    h_2d_sigma.SetTitle('width of PH')
+    h_2d_sigma.SetTitle('width of PH' if fit_engine != 'fast' else 'width of PH (FWHM / %.2f)' %(LandauFit.LANDAU_FWHM))
     h_2d_sigma.Draw('colz')
     h_2d_sigma.GetZaxis().SetRangeUser(0., central+10.)
     
     c1.SaveAs('results/run_'+str(my_rn)+'/plots.pdf')
+
+    if fit_engine == 'fast' and check:
+        checkFastXYPlots(h_3d, cp2d, fit_bins, fit_results, neighbours)
+
     # ROOT.gStyle.Reset()
     # reset the style
     ROOT.gStyle.SetTitleSize(tmp_size,'t')
@@ -202,22 +312,64 @@ def makeXYPlots(h_3d):
 
     del h_2d_mpv, h_2d_mean, h_2d_nfill, h_3d
 
-## reorganize later
-if __name__ == "__main__":
+def checkFastXYPlots(h_3d, cp2d, fit_bins, fast_results, neighbours):
+    """ maps of mode - MPV and median - MPV, with the MPV of batched Landau fits.
+    the mode of TMath::Landau(x, mpv, sigma) is at mpv - 0.22 sigma """
+    z_min, z_max = h_3d.GetZaxis().GetXmin(), h_3d.GetZaxis().GetXmax()
+    fit_results = ah.fitLandauBatch([z_contents for xbin, ybin, z_contents in fit_bins], z_min, z_max,
+                                    'landau', neighbours)
+
+    h_2d_mode_diff   = copy.deepcopy(cp2d)
+    h_2d_median_diff = copy.deepcopy(cp2d)
+    h_2d_mode_diff  .Reset()
+    h_2d_median_diff.Reset()
+    mode_diffs   = []
+    median_diffs = []
+    for (xbin, ybin, z_contents), fast_res, fit_res in zip(fit_bins, fast_results, fit_results):
+        mpv = fit_res[0][1]
+        mode_diffs  .append(fast_res[0][1] - mpv)
+        median_diffs.append(fast_res[0][3] - mpv)
+        h_2d_mode_diff  .SetBinContent(xbin, ybin, mode_diffs[-1])
+        h_2d_median_diff.SetBinContent(xbin, ybin, median_diffs[-1])
+    if not mode_diffs:
+        return
+    print 'mode   - MPV: mean %.2f, rms %.2f' %(numpy.mean(mode_diffs)  , numpy.std(mode_diffs))
+    print 'median - MPV: mean %.2f, rms %.2f' %(numpy.mean(median_diffs), numpy.std(median_diffs))
+
+    c2 = ROOT.TCanvas('fast_check', 'fast_check', 600, 300)
+    c2.Divide(2,1)
+    c2.cd(1)
+    ROOT.gPad.SetTicks(1,1)
+    h_2d_mode_diff.SetTitle('mode - MPV of PH')
+    h_2d_mode_diff.Draw('colz')
+    c2.cd(2)
+    ROOT.gPad.SetTicks(1,1)
+    h_2d_median_diff.SetTitle('median - MPV of PH')
+    h_2d_median_diff.Draw('colz')
+    c2.SaveAs('results/run_'+str(my_rn)+'/fast_check.pdf')
 
-    if len(sys.argv) != 2:
-        usage()
-        sys.exit(-1)
+###############################
+# analysis of one run
+###############################
+
+def analyzeRun(run_number, fit_engine='numpy', check=False, n_workers=None):
+    """ fill the histograms of the run (or load them from track_info.root) and make the plots,
+    for pedestal runs the pedestal is written to the run database. see usage() for fit_engine and check,
+    n_workers is the number of processes of the 'root' XY fits (see makeXYPlots).
+    returns False if the run can't be analyzed yet (pedestal missing) """
 
     ###############################
     # Get all the runs from the json
     ###############################
     
-    RunInfo.load('runs.json')
+    RunInfo.reload('runs.db')
 
+    ## fit results of earlier runs of the same histograms are reused
+    if ah.fitCache is None:
+        ah.fitCache = FitCache()
     
     global my_rn
-    my_rn  = int(sys.argv[-1])
+    my_rn  = run_number
     my_run = RunInfo.runs[my_rn]
     print my_run.__dict__
 
@@ -233,94 +385,127 @@ if __name__ == "__main__":
     
     print 'there\'s a total of %.0f events in the tree' %(n_ev)
     
-    global loaded 
-    loaded = False
+    ###############################
+    # pedestal and time binning
+    ###############################
+
+    runPedestal = math.isnan(my_run.pedestal) and (my_run.pedestal_run == -1 or my_run.number == my_run.pedestal_run)
+
+    print 'is nan?', math.isnan(my_run.pedestal)
+    if math.isnan(my_run.pedestal) and (my_run.pedestal_run != -1 and my_run.number != my_run.pedestal_run):
+        print 'analyze the pedestal run first!! it\'s run', my_run.pedestal_run
+        infile.Close()
+        return False
+    if runPedestal:
+        pedestal = 0.
+    else:
+        pedestal = my_run.pedestal
+
+    # make the time binning 10 minutes for < 100 Hz and one minute above
+    time_binning = 60.
+    if my_run.rate_trigger < 100:
+        time_binning = 600.
+
+    ########################################
+    # get the times of first and last events
+    ########################################
+
+    reader = BranchReader(my_tree)
+    time_first = reader.read_entry(['t_pad'], 0)['t_pad']
+    time_last  = reader.read_entry(['t_pad'], n_ev-1)['t_pad']
+    length = time_last - time_first
+    mins = length/time_binning
+
+    print 'run of %.2f minutes length' %(mins)
+
+    h_3draw, h_time_2draw = rawHistograms(int(mins+1))
 
     ###############################
-    # check if the histograms are already in the file. load them if they're there
+    # check if the raw histograms are already in the file. load them if they're there
     ###############################
 
-    if infile.Get('h_3dfull') != None and infile.Get('h_time_2d') != None:
-        h_3d      = copy.deepcopy(infile.Get('h_3dfull') )
-        h_time_2d = copy.deepcopy(infile.Get('h_time_2d'))
-        loaded = True
-        print 'file already loaded'
+    # everything the contents depend on, a change of any of these gives a new variant
+    # (which entries are filled is kept in the state, the time axis grows with the run)
+    spec = {'time_binning': time_binning,
+            'time_first'  : float(time_first),
+            'binning'     : [histogram_binning(h_3draw), histogram_binning(h_time_2draw)[0::2]],
+            'cuts'        : ['!(track_x < -99 && track_y < -99)', 'integral50 != -1'],
+            'values'      : ['track_x', 'track_y', 'integral50', '(t_pad - time_first) / time_binning'],
+            }
+    cache  = HistoCache(infile)
+    cached = cache.get(spec, ['h_3draw', 'h_time_2draw'])
+    state  = cache.state(spec)
+
+    first_entry = 0
+    if cached is not None and state is not None:
+        first_entry = newEntries(reader, my_tree, state)
+    if first_entry is None:
+        print 'the tree was rewritten, refill the histograms'
+        first_entry = 0
+    elif first_entry > 0:
+        extend_histogram(cached['h_3draw'], h_3draw)
+        extend_histogram(cached['h_time_2draw'], h_time_2draw)
     
     ###############################
-    # if the histograms aren't yet there, fill them
+    # fill the histograms with the entries which aren't there yet
     ###############################
-    if not loaded:
-
-        print 'loading the histograms into the root file'
-        h_3d = ROOT.TH3F('h_3dfull','3D histogram', 
-             25,   -0.30,   0.20, 
-             25,   -0.10,   0.40, 
-            200, -400.00, 400.00)
-
-        runPedestal = math.isnan(my_run.pedestal) and (my_run.pedestal_run == -1 or my_run.number == my_run.pedestal_run)
-
-        print 'is nan?', math.isnan(my_run.pedestal)
-        if math.isnan(my_run.pedestal) and (my_run.pedestal_run != -1 and my_run.number != my_run.pedestal_run):
-            print 'analyze the pedestal run first!! it\'s run', my_run.pedestal_run
-            sys.exit()
-        if runPedestal:
-            pedestal = 0.
-        else:
-            pedestal = my_run.pedestal
-
-        ########################################
-        # get the times of first and last events
-        ########################################
-
-        # make the time binning 10 minutes for < 100 Hz and one minute above
-        time_binning = 60.
-        if my_run.rate_trigger < 100:
-            time_binning = 600.
-
-        my_tree.GetEntry(0)
-        time_first = my_tree.t_pad
-        my_tree.GetEntry(n_ev-1)
-        time_last  = my_tree.t_pad
-        length = time_last - time_first
-        mins = length/time_binning
-
-        h_time_2d = ROOT.TH2F('h_time_2d', 'h_time_2d', int(mins+1), 0., int(mins+1), 500, -250., 250.)
-    
-        print 'run of %.2f minutes length' %(mins)
-        
-        ## fill the tree data in the histograms
-        for ev in my_tree:
-            if ev.track_x < -99. and ev.track_y < -99.: ## ommit empty events
-                continue
-            if ev.integral50 == -1.: # these are calibration events
-                continue
-            rel_time = int( (ev.t_pad - time_first) / time_binning) ## change to t_pad 
-        
+    if first_entry == n_ev:
+        print 'file already loaded'
+    else:
+
+        print 'loading the entries %d to %d into the root file' %(first_entry, n_ev)
+
+        ## fill the tree data in the histograms, reading only the needed branches
+        ## (binned with numpy, same contents as filling event by event)
+        filler_3d   = ArrayFiller(h_3draw)
+        filler_time = ArrayFiller(h_time_2draw)
+        for first, columns in reader.iter_chunks(['track_x', 'track_y', 'integral50', 't_pad'], first_entry):
+            track_x    = columns['track_x']
+            track_y    = columns['track_y']
+            integral50 = columns['integral50']
+            selected  = ~((track_x < -99.) & (track_y < -99.)) ## ommit empty events
+            selected &= integral50 != -1. # these are calibration events
+            rel_time = ((columns['t_pad'][selected] - time_first) / time_binning).astype(int) ## change to t_pad
+
             # fill the 3D histogram
-            h_3d.Fill(ev.track_x, ev.track_y, ev.integral50 - pedestal)
-        
+            filler_3d.fill(track_x[selected], track_y[selected], integral50[selected])
+
             # fill all the time histograms with the integral
-            h_time_2d.Fill(rel_time, ev.integral50 - pedestal)
+            filler_time.fill(rel_time, integral50[selected])
+        filler_3d.write()
+        filler_time.write()
         
-        # re-open file for writing
-        infile.ReOpen('UPDATE')
-        infile.cd()
+    ###############################
+    # subtract the pedestal (no need to refill when it changes)
+    ###############################
 
-        h_3d.Write()
-        h_time_2d.Write()
-        loaded = True
+    h_3d, h_time_2d = pedestalHistograms(h_3draw, h_time_2draw, pedestal)
+
+    # re-open file for writing
+    infile.ReOpen('UPDATE')
+    infile.cd()
+
+    # the histograms with the current pedestal are kept under the plain names
+    h_3d.Write('', ROOT.TObject.kOverwrite)
+    h_time_2d.Write('', ROOT.TObject.kOverwrite)
+    if first_entry < n_ev:
+        key = cache.put(spec, [h_3draw, h_time_2draw], fillState(reader, my_tree, n_ev))
+        # keep only the current variant of the raw histograms (e.g. not the one of an old binning)
+        for other, other_spec in cache.variants().items():
+            if other != key and other_spec.get('values') == spec['values']:
+                cache.remove(other)
     
     if my_run.data_type == 1:
         print '------------------------------------'
         print '--- this is a pedestal run ---------'
         print '------------------------------------'
         pedestal = getPedestalValue(h_time_2d)
-        my_run.pedestal = pedestal
-        for rn, r in RunInfo.runs.items():
-            if r == my_run: continue
-            if r.pedestal_run == my_run.number:
+        def setPedestal(runs):
+            runs[my_rn].pedestal = pedestal
+            for r in RunInfo.query(pedestal_run=my_rn):
                 r.pedestal = pedestal
-        RunInfo.dump('runs.json')
+        ## other processes may be writing the file at the same time
+        RunInfo.update_runs('runs.db', setPedestal)
         
         
     else:
@@ -331,9 +516,23 @@ if __name__ == "__main__":
             print 'this run still needs a pedestal!'
             ped_run = my_run.pedestal_run
 
-        makeXYPlots(h_3d)
-        b = makeTimePlots(h_time_2d)
+        makeXYPlots(h_3d, n_workers, fit_engine=fit_engine, check=check)
+        # the fast mode has no estimator for the time slices, they are fitted in one batch as with numpy
+        b = makeTimePlots(h_time_2d, fit_engine={'fast': 'numpy'}.get(fit_engine, fit_engine))
 
+    ah.fitCache.save()
     infile.Close()
+    return True
+
 
+## reorganize later
+if __name__ == "__main__":
+
+    if len(sys.argv) not in [2, 3, 4] or (len(sys.argv) >= 3 and sys.argv[2] not in ['numpy', 'langau', 'root', 'fast']) \
+            or (len(sys.argv) == 4 and (sys.argv[2] != 'fast' or sys.argv[3] != 'check')):
+        usage()
+        sys.exit(-1)
+    fit_engine = sys.argv[2] if len(sys.argv) >= 3 else 'numpy'
+    check = len(sys.argv) == 4
 
+    analyzeRun(int(sys.argv[1]), fit_engine, check)
@@ -3,8 +3,16 @@
 ###############################
 
 import ROOT, copy
+import multiprocessing
+import numpy
 from array import array
-from ROOT import RooFit, RooRealVar, RooGaussian, RooLandau, RooDataSet, RooArgList, RooTreeData, RooFFTConvPdf, RooDataHist
+import LandauFit
+from FitCache import cached_fit
+from HistoArrays import histogram_contents
+from HistoCache import histogram_binning
+
+## FitCache for the fits below (None: always fit)
+fitCache = None
 
 def median(ls):
     sls = sorted(ls)
@@ -54,7 +62,13 @@ def turnHisto(hist):
         tmp_hist.SetBinError  (nbins-bin, hist.GetBinError  (bin+1))
     return tmp_hist
 
-def fitLandauGaus(hist):
+def fitFailed(fit_res, xmin, xmax):
+    """ True unless fit_res [norm, mpv, sigma, ...] is a Landau with the MPV inside [xmin, xmax] """
+    return not (numpy.all(numpy.isfinite(fit_res)) and fit_res[2] > 0. and xmin <= fit_res[1] <= xmax)
+
+def fitLandauGaus(hist, start=None):
+    """ start: fit_res to start from (e.g. of a neighbouring bin) instead of mean and RMS,
+    the fit is repeated from mean and RMS if it fails """
 
     neg_landau = False
     if hist.GetMean() < 0.:
@@ -68,15 +82,285 @@ def fitLandauGaus(hist):
     #else:
     func = ROOT.TF1('my_landau','[0] * TMath::Landau(x,[1],[2])', hist.GetXaxis().GetXmin(), hist.GetXaxis().GetXmax())
     func.SetParameters(1, hist.GetMean(), hist.GetRMS() )
+    if start is not None:
+        func.SetParameters(start[0], start[1] if not neg_landau else -1.*start[1], start[2])
 
-    hist.Fit('my_landau','q')
+    cached_fit(fitCache, hist, func, 'q')
+    fit_res = [func.GetParameter(ipar) for ipar in range(3)]
+    if start is not None and fitFailed(fit_res, hist.GetXaxis().GetXmin(), hist.GetXaxis().GetXmax()):
+        func.SetParameters(1, hist.GetMean(), hist.GetRMS() )
+        cached_fit(fitCache, hist, func, 'q')
     fit_res = []
     fit_res.append(func.GetParameter(0) if not neg_landau else     func.GetParameter(0))
     fit_res.append(func.GetParameter(1) if not neg_landau else -1.*func.GetParameter(1))
     fit_res.append(func.GetParameter(2) if not neg_landau else     func.GetParameter(2))
     return hist, fit_res
 
+def fitLandauArray(args):
+    """ fitLandauGaus for a histogram given as [bin contents incl. under- and overflow, xmin, xmax]
+    or [contents, xmin, xmax, start]. Returns [fit_res, mean, integral] """
+    contents, xmin, xmax = args[:3]
+    start = args[3] if len(args) > 3 else None
+    hist = ROOT.TH1D('h_landau_array', '', len(contents)-2, xmin, xmax)
+    hist.SetDirectory(0)
+    for ibin in range(len(contents)):
+        hist.SetBinContent(ibin, contents[ibin])
+    fit_res = fitLandauGaus(hist, start)[1]
+    return [fit_res, hist.GetMean(), hist.Integral()]
+
+def fitLandauChain(args):
+    """ fitLandauArray for [list of contents, xmin, xmax], one after the other: every fit starts
+    from the result of the last successful one (so the histograms should be neighbours) """
+    contents_list, xmin, xmax = args
+    results = []
+    start = None
+    for contents in contents_list:
+        result = fitLandauArray([contents, xmin, xmax, start])
+        results.append(result)
+        if not fitFailed(result[0], xmin, xmax):
+            start = result[0]
+    return results
+
+def fitLandauArrays(contents_list, xmin, xmax, n_workers=None, chains=None):
+    """ fitLandauArray for many histograms with the same binning on a pool of n_workers processes
+    (default: number of cores). chains: lists of indices of contents_list, the histograms of a chain
+    are fitted in this order by fitLandauChain (default: every histogram on its own, from mean and RMS).
+    Results are in the order of contents_list, they only depend on the chains, not on the number of workers. """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if chains is None:
+        chains = [[itask] for itask in range(len(contents_list))]
+    tasks = [[[list(contents_list[itask]) for itask in chain], xmin, xmax] for chain in chains]
+    chain_results = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    if fitCache is not None:
+        for ichain in range(len(tasks)):
+            keys[ichain] = fitCache.key(numpy.concatenate(tasks[ichain][0]), 'fitLandauChain',
+                                        [len(contents) for contents in tasks[ichain][0]], xmin, xmax)
+            chain_results[ichain] = fitCache.get(keys[ichain])
+    todo = [ichain for ichain in range(len(tasks)) if chain_results[ichain] is None]
+
+    if n_workers <= 1 or len(todo) <= 1:
+        fitted = map(fitLandauChain, [tasks[ichain] for ichain in todo])
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            fitted = pool.map(fitLandauChain, [tasks[ichain] for ichain in todo])
+        finally:
+            pool.close()
+            pool.join()
+    for ichain, result in zip(todo, fitted):
+        chain_results[ichain] = result
+        if fitCache is not None:
+            fitCache.put(keys[ichain], result)
+
+    results = [None] * len(contents_list)
+    for chain, result in zip(chains, chain_results):
+        for itask, task_result in zip(chain, result):
+            results[itask] = task_result
+    return results
+
+def batchFitter(model):
+    """ LandauFit function for the model 'landau' or 'langau' (Landau (x) Gauss) """
+    if model == 'langau':
+        return LandauFit.fit_landau_gauss_batch
+    return LandauFit.fit_landau_batch
+
+def batchFit(contents, xmin, xmax, negative=None, model='landau', start=None):
+    """ batchFitter(model) with full_output for the rows of contents, rows fitted before are
+    taken from fitCache. start: start parameters per row (NaN rows: from mean and RMS).
+    Returns [parameters, errors, chi2, npoints] """
+    n_par = 4 if model == 'langau' else 3
+    if start is None:
+        start = numpy.nan * numpy.zeros((len(contents), n_par))
+    results = [None] * len(contents)
+    keys = [None] * len(contents)
+    if fitCache is not None:
+        for irow in range(len(contents)):
+            row_start = list(start[irow]) if numpy.all(numpy.isfinite(start[irow])) else None
+            keys[irow] = fitCache.key(contents[irow], 'LandauFit.' + model, xmin, xmax, negative, row_start)
+            results[irow] = fitCache.get(keys[irow])
+    todo = [irow for irow in range(len(contents)) if results[irow] is None]
+
+    if todo:
+        parameters, errors, chi2, npoints = batchFitter(model)(contents[todo], xmin, xmax, negative,
+                                                               full_output=True, start=start[todo])
+        for i in range(len(todo)):
+            results[todo[i]] = {'parameters': list(parameters[i]), 'errors': list(errors[i]),
+                                'chi2': float(chi2[i]), 'npoints': int(npoints[i])}
+            if fitCache is not None:
+                fitCache.put(keys[todo[i]], results[todo[i]])
+    return [numpy.array([result['parameters'] for result in results]).reshape(-1, n_par),
+            numpy.array([result['errors'] for result in results]).reshape(-1, n_par),
+            numpy.array([result['chi2'] for result in results]),
+            numpy.array([result['npoints'] for result in results])]
+
+def warmBatchFit(contents, xmin, xmax, negative=None, model='landau', neighbours=None):
+    """ batchFit in two waves: first a set of rows of which no two are neighbours
+    (neighbours[i]: indices of the neighbours of row i), from mean and RMS. Then the other
+    rows, starting from the median result of their successfully fitted neighbours.
+    Rows which fail with these start values are fitted again from mean and RMS. """
+    if neighbours is None or len(contents) == 0:
+        return batchFit(contents, xmin, xmax, negative, model)
+    first = numpy.zeros(len(contents), dtype=bool)
+    for irow in range(len(contents)):
+        if not first[neighbours[irow]].any():
+            first[irow] = True
+
+    n_par = 4 if model == 'langau' else 3
+    parameters = numpy.zeros((len(contents), n_par))
+    errors     = numpy.zeros((len(contents), n_par))
+    chi2       = numpy.zeros(len(contents))
+    npoints    = numpy.zeros(len(contents), dtype=int)
+    def fit(rows, start=None):
+        results = batchFit(contents[rows], xmin, xmax, negative, model, start)
+        parameters[rows], errors[rows], chi2[rows], npoints[rows] = results
+    fit(first)
+
+    converged = numpy.array([not fitFailed(par, xmin, xmax) for par in parameters]) & first
+    start = numpy.nan * numpy.zeros((len(contents), n_par))
+    for irow in numpy.flatnonzero(~first):
+        seeds = [ineighbour for ineighbour in neighbours[irow] if converged[ineighbour]]
+        if seeds:
+            start[irow] = numpy.median(parameters[seeds], axis=0)
+    fit(~first, start[~first])
+
+    warm = numpy.isfinite(start).all(axis=1)
+    failed = warm & numpy.array([fitFailed(par, xmin, xmax) for par in parameters])
+    if failed.any():
+        fit(failed)
+    return [parameters, errors, chi2, npoints]
+
+def fitLandauBatch(contents_list, xmin, xmax, model='landau', neighbours=None):
+    """ Same as fitLandauArrays, but all histograms are fitted at once with LandauFit.
+    With model 'langau' fit_res is [norm, mpv, sigma, sigma_gauss].
+    neighbours: see warmBatchFit (default: all fits start from mean and RMS) """
+    contents = numpy.array([list(contents) for contents in contents_list], dtype=float)
+    if len(contents) == 0:
+        return []
+    contents = contents[:, 1:-1]
+    nbins = contents.shape[1]
+    centers = xmin + (xmax - xmin) / float(nbins) * (numpy.arange(nbins) + 0.5)
+    integrals = contents.sum(axis=1)
+    means = (contents * centers).sum(axis=1) / numpy.where(integrals != 0, integrals, 1.)
+    parameters = warmBatchFit(contents, xmin, xmax, model=model, neighbours=neighbours)[0]
+    return [[list(parameters[i]), means[i], integrals[i]] for i in range(len(contents))]
+
+def estimateLandauBatch(contents_list, xmin, xmax, fraction=0.8):
+    """ Fit-free replacement of fitLandauBatch (LandauFit.robust_estimators): fit_res is
+    [integral, mode, width, median] and the mean is the truncated mean of the lowest fraction """
+    contents = numpy.array([list(contents) for contents in contents_list], dtype=float)
+    if len(contents) == 0:
+        return []
+    contents = contents[:, 1:-1]
+    integrals = contents.sum(axis=1)
+    estimates = LandauFit.robust_estimators(contents, xmin, xmax, fraction=fraction)
+    return [[[integrals[i], estimates['mode'][i], estimates['width'][i], estimates['median'][i]],
+             estimates['truncated_mean'][i], integrals[i]] for i in range(len(contents))]
+
+def fitSlicesBatch(h2, neg_landau, model='landau'):
+    """ Batched replacement of h2.FitSlicesY with a (negative) Landau: returns a TObjArray
+    with one histogram per parameter (value and error per x bin) and the chi2/ndf, named as
+    by FitSlicesY. The MPVs of negative Landaus are positive, as for a fit of Landau(-x).
+    Every other slice starts from the results of the neighbouring slices (see warmBatchFit). """
+    nx, ny = h2.GetNbinsX(), h2.GetNbinsY()
+    contents = numpy.array([[h2.GetBinContent(xbin, ybin) for ybin in range(1, ny+1)] for xbin in range(1, nx+1)])
+    filled = contents.sum(axis=1) > 0
+    n_filled = filled.sum()
+    neighbours = [[ineighbour for ineighbour in [islice-1, islice+1] if 0 <= ineighbour < n_filled]
+                  for islice in range(n_filled)]
+    parameters, errors, chi2, npoints = warmBatchFit(contents[filled], h2.GetYaxis().GetXmin(),
+                                                     h2.GetYaxis().GetXmax(), neg_landau, model, neighbours)
+    if neg_landau:
+        parameters[:, 1] *= -1.
+    xbins = numpy.flatnonzero(filled) + 1
+    xaxis = h2.GetXaxis()
+
+    arr = ROOT.TObjArray()
+    arr.SetOwner(True)
+    for ipar in range(parameters.shape[1]+1):
+        if ipar < parameters.shape[1]:
+            name = '{0}_{1}'.format(h2.GetName(), ipar)
+        else:
+            name = '{0}_chi2'.format(h2.GetName())
+        hist = ROOT.TH1D(name, name, nx, xaxis.GetXmin(), xaxis.GetXmax())
+        hist.SetDirectory(0)
+        for i in range(len(xbins)):
+            if ipar < parameters.shape[1]:
+                hist.SetBinContent(int(xbins[i]), parameters[i, ipar])
+                hist.SetBinError  (int(xbins[i]), errors[i, ipar])
+            elif npoints[i] > parameters.shape[1]:
+                hist.SetBinContent(int(xbins[i]), chi2[i] / (npoints[i] - parameters.shape[1]))
+        arr.Add(hist)
+    return arr
+
+def fitSlicesY(h2, func, options='QNR'):
+    """ Same as h2.FitSlicesY(func, 0, -1, 0, options), but the slices are fitted in order and every
+    fit starts from the result of the last successful one (from the parameters of func for the first
+    slice and when the fit fails). The resulting histograms are taken from fitCache if h2 (same contents
+    and binning) was fitted with the same function and start parameters before """
+    key = None
+    if fitCache is not None:
+        key = fitCache.key(histogram_contents(h2), func.GetTitle(), 'fitSlicesY', histogram_binning(h2), options,
+                           [func.GetParameter(ipar) for ipar in range(func.GetNpar())], [func.GetXmin(), func.GetXmax()])
+        result = fitCache.get(key)
+    if key is None or result is None:
+        result = fitSlices(h2, func, options)
+        if fitCache is not None:
+            fitCache.put(key, result)
+
+    arr = ROOT.TObjArray()
+    arr.SetOwner(True)
+    xaxis = h2.GetXaxis()
+    for name, title, contents, errors in result:
+        hist = ROOT.TH1D(name, title, xaxis.GetNbins(), xaxis.GetXmin(), xaxis.GetXmax())
+        hist.SetDirectory(0)
+        for ibin in range(len(contents)):
+            hist.SetBinContent(ibin, contents[ibin])
+            hist.SetBinError  (ibin, errors[ibin])
+        arr.Add(hist)
+    return arr
+
+def fitSlices(h2, func, options):
+    """ The fits of fitSlicesY. Returns [name, title, contents, errors] of the result histograms """
+    npar = func.GetNpar()
+    nx = h2.GetNbinsX()
+    ymin, ymax = func.GetXmin(), func.GetXmax()
+    cold = array('d', [func.GetParameter(ipar) for ipar in range(npar)])
+    contents = [[0.] * (nx+2) for ipar in range(npar+1)]
+    errors   = [[0.] * (nx+2) for ipar in range(npar+1)]
+
+    start = cold
+    for xbin in range(1, nx+1):
+        proj = h2.ProjectionY('{0}_slice'.format(h2.GetName()), xbin, xbin, 'e')
+        proj.SetDirectory(0)
+        if proj.GetEntries() == 0:
+            continue
+        func.SetParameters(start)
+        proj.Fit(func, options)
+        fit_res = [func.GetParameter(ipar) for ipar in range(npar)]
+        failed = fitFailed(fit_res, ymin, ymax)
+        if failed and start is not cold:
+            func.SetParameters(cold)
+            proj.Fit(func, options)
+            fit_res = [func.GetParameter(ipar) for ipar in range(npar)]
+            failed = fitFailed(fit_res, ymin, ymax)
+        npfits = func.GetNumberFitPoints()
+        if npfits <= npar:
+            continue
+        for ipar in range(npar):
+            contents[ipar][xbin] = fit_res[ipar]
+            errors  [ipar][xbin] = func.GetParError(ipar)
+        contents[npar][xbin] = func.GetChisquare() / (npfits - npar)
+        if not failed:
+            start = array('d', fit_res)
+
+    names  = ['{0}_{1}'.format(h2.GetName(), ipar) for ipar in range(npar)] + ['{0}_chi2'.format(h2.GetName())]
+    titles = ['Fitted value of par[{0}]={1}'.format(ipar, func.GetParName(ipar)) for ipar in range(npar)] + ['chisquare']
+    return [[names[ipar], titles[ipar], contents[ipar], errors[ipar]] for ipar in range(npar+1)]
+
 ## ROOFIT VERSION
+## (needs from ROOT import RooFit, RooRealVar, RooGaussian, RooLandau, RooArgList, RooFFTConvPdf, RooDataHist)
 
     ### x   = RooRealVar('x', 'x', hist.GetXaxis().GetXmin(), hist.GetXaxis().GetXmax())
     ### ral = RooArgList(x)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Startup time of the command line programs.
+
+For every program the imports and the first step of real work it does are
+run in a fresh interpreter (nothing is cached in the process, the OS file
+cache is warm after the first repetition):
+ - go.py:              RunInfo, RunScheduler, load runs.db and build the job graph
+ - EnterRuns.py:       RunInfo, load runs.db (then it asks for input)
+ - Analyze.py:         import Analyze (then analyzeRun opens the files)
+ - TimingAlignment.py: ROOT, TimingAlignmentClass and BranchCache (then it opens the files)
+The time until this point, the number of imported modules and whether ROOT was
+imported are printed.
+
+Usage: python BenchmarkStartup.py [repetitions] [program ...]
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+import sys
+import json
+import subprocess
+
+
+###############################
+# Programs
+###############################
+
+programs = [
+    ["go.py", "from RunInfo import RunInfo\n"
+              "from RunScheduler import RunScheduler\n"
+              "RunInfo.load('runs.db')\n"
+              "RunScheduler(1).build()\n"],
+    ["EnterRuns.py", "from RunInfo import RunInfo\n"
+                     "RunInfo.load('runs.db')\n"],
+    ["Analyze.py", "import Analyze\n"],
+    ["TimingAlignment.py", "import ROOT\n"
+                           "import TimingAlignmentClass\n"
+                           "from BranchCache import BranchCache\n"],
+]
+
+# Runs the code of a program and prints the time it took as JSON
+template = """
+import time
+start = time.time()
+import sys
+n_modules = len(sys.modules)
+{code}
+print '@@@' + __import__('json').dumps({{'time': time.time() - start,
+                                         'modules': len(sys.modules) - n_modules,
+                                         'root': 'ROOT' in sys.modules}})
+"""
+
+
+def measure(code):
+    """ Dictionary time [s], modules, root of one fresh interpreter, None if the code failed """
+    process = subprocess.Popen([sys.executable, "-c", template.format(code=code)],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    output = process.communicate()[0]
+    for line in output.splitlines():
+        if line.startswith('@@@'):
+            return json.loads(line[3:])
+    print output
+    return None
+
+
+###############################
+# Main
+###############################
+
+if __name__ == "__main__":
+    repetitions = 5
+    selected = [program for program, code in programs]
+    if len(sys.argv) > 1:
+        repetitions = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        selected = sys.argv[2:]
+
+    print '{0:<20s} {1:>8s} {2:>8s} {3:>8s} {4:>6s}'.format('program', 'min [s]', 'median', 'modules', 'ROOT')
+    for program, code in programs:
+        if program not in selected:
+            continue
+        results = []
+        for i in range(repetitions):
+            results.append(measure(code))
+            if results[-1] is None:
+                break
+        if None in results:
+            print '{0:<20s} failed'.format(program)
+            continue
+        times = sorted(result['time'] for result in results)
+        print '{0:<20s} {1:8.3f} {2:8.3f} {3:8d} {4:>6s}'.format(program, times[0], times[len(times) / 2],
+                                                                 results[0]['modules'],
+                                                                 'yes' if results[0]['root'] else 'no')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of tree branches as numpy files.
+
+Every branch read through a BranchReader with a cache is extracted once from
+the ROOT file into <cache_dir>/<key>/<tree>.<branch>.npy. Later reads (also of
+later actions and runs) map these files into memory instead of decompressing
+the ROOT baskets again. The key is made from the path, size and creation date
+of the input file, so a reprocessed input file gets a new entry.
+
+The total size is limited, the least recently used files are removed first.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+import json
+import hashlib
+
+import numpy
+
+
+###############################
+# Class: BranchCache
+###############################
+
+class BranchCache:
+    """ Memory mapped branch columns, see module documentation.
+
+    Example:
+    cache = BranchCache("./branch_cache/", max_size=20 * 1024 ** 3)
+    reader = BranchReader(tree_pad, branch_names, cache=cache)
+    """
+
+    def __init__(self, cache_dir, max_size=20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    # End __init__
+
+    def source_dir(self, tree):
+        """ Cache directory of the file the tree was read from, or None if it can not be cached """
+        f = tree.GetCurrentFile()
+        if not f:
+            return None
+        path = os.path.abspath(f.GetName())
+        if not os.path.isfile(path):
+            # e.g. remote files
+            return None
+        source = {"path": path,
+                  "size": os.path.getsize(path),
+                  "creation_date": f.GetCreationDate().Convert()}
+        key = hashlib.sha1(json.dumps(source, sort_keys=True)).hexdigest()
+        directory = os.path.join(self.cache_dir, key)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+            f_source = open(os.path.join(directory, "source.json"), "w")
+            f_source.write(json.dumps(source, sort_keys=True, indent=4))
+            f_source.close()
+        return directory
+
+    def column(self, tree, branch, read_branch):
+        """ All entries of one branch as read-only memory mapped array.
+        read_branch(branch) is called to read the branch from the tree if it is not cached yet.
+        Return None if the tree can not be cached.
+        """
+        directory = self.source_dir(tree)
+        if directory is None:
+            return None
+        filename = os.path.join(directory, "{0}.{1}.npy".format(tree.GetName(), branch))
+
+        if os.path.exists(filename):
+            # Mark as recently used
+            os.utime(filename, None)
+        else:
+            values = read_branch(branch)
+            # Write to a temporary file first: other processes only ever see complete files
+            filename_tmp = "{0}.{1}.tmp.npy".format(filename[:-4], os.getpid())
+            numpy.save(filename_tmp, values)
+            os.rename(filename_tmp, filename)
+            self.evict(keep=filename)
+        return numpy.load(filename, mmap_mode='r')
+
+    def evict(self, keep=None):
+        """ Remove the least recently used files until the cache is smaller than max_size """
+        files = []
+        for key in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith(".npy") and ".tmp." not in name:
+                    filename = os.path.join(directory, name)
+                    stat = os.stat(filename)
+                    files.append([stat.st_mtime, stat.st_size, filename])
+
+        total_size = sum(size for used, size, filename in files)
+        for used, size, filename in sorted(files):
+            if total_size <= self.max_size:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+                total_size -= size
+                directory = os.path.dirname(filename)
+                if not [name for name in os.listdir(directory) if name.endswith(".npy")]:
+                    os.remove(os.path.join(directory, "source.json"))
+                    os.rmdir(directory)
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+
+
+# End of class BranchCache
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Columnar access to ROOT trees.
+
+Reads only the requested branches of a tree into numpy arrays, in chunks of
+a configurable number of entries, instead of one GetEntry per event which
+deserializes every branch of every entry. With a BranchCache the branches
+are extracted once and memory mapped afterwards.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import numpy
+
+
+###############################
+# Class: BranchReader
+###############################
+
+class BranchReader:
+    """ Chunked reader for the branches of one tree.
+
+    Branches are requested by key. Keys are translated with the branch_names map
+    (as used in TimingAlignment.py), keys not in the map are used as branch names.
+
+    Example:
+    reader = BranchReader(tree_pad, branch_names, chunk_size=100000)
+    t_pad = reader.read_all(["t_pad"])["t_pad"]
+    for first, columns in reader.iter_chunks(["t_pad", "integral_50_pad"]):
+        ...
+    """
+
+    # TTree::Draw gives access to at most four columns per call (GetV1..GetV4)
+    max_columns = 4
+
+    def __init__(self, tree, branch_names=None, chunk_size=100000, cache=None):
+        self.tree = tree
+        if branch_names is None:
+            branch_names = {}
+        self.branch_names = branch_names
+        self.chunk_size = chunk_size
+        self.n_entries = tree.GetEntries()
+        self.cache = cache
+        self.cached_columns = {}
+
+    # End __init__
+
+    def branch(self, key):
+        return self.branch_names.get(key, key)
+
+    def read(self, keys, first=0, n_entries=None):
+        """ Read the branches for the entries [first, first+n_entries) in one go.
+        Return a dictionary key -> numpy array (float64, read-only for cached branches)
+        """
+        if n_entries is None:
+            n_entries = self.n_entries - first
+        n_entries = max(0, min(n_entries, self.n_entries - first))
+        columns = {}
+        if n_entries == 0:
+            for key in keys:
+                columns[key] = numpy.zeros(0)
+            return columns
+
+        not_cached = []
+        for key in keys:
+            column = self.cached_column(key)
+            if column is None:
+                not_cached.append(key)
+            else:
+                columns[key] = column[first:first + n_entries]
+
+        branches = self.draw([self.branch(key) for key in not_cached], first, n_entries)
+        for key in not_cached:
+            columns[key] = branches[self.branch(key)]
+        return columns
+
+    def cached_column(self, key):
+        """ All entries of a branch from the cache, None without cache """
+        if self.cache is None:
+            return None
+        if key not in self.cached_columns:
+            self.cached_columns[key] = self.cache.column(self.tree, self.branch(key), self.read_branch)
+        return self.cached_columns[key]
+
+    def read_branch(self, branch):
+        """ All entries of one branch, read chunk by chunk """
+        chunks = [self.draw([branch], first, min(self.chunk_size, self.n_entries - first))[branch]
+                  for first in xrange(0, self.n_entries, self.chunk_size)]
+        if not chunks:
+            return numpy.zeros(0)
+        return numpy.concatenate(chunks)
+
+    def draw(self, branches, first, n_entries):
+        """ Read the entries [first, first+n_entries) of the branches with TTree::Draw.
+        Return a dictionary branch -> numpy array (float64)
+        """
+        columns = {}
+        self.tree.SetEstimate(n_entries + 1)
+        for i_group in range(0, len(branches), self.max_columns):
+            group = branches[i_group:i_group + self.max_columns]
+            varexp = ":".join(group)
+            n_read = self.tree.Draw(varexp, "", "goff", n_entries, first)
+            if n_read != n_entries:
+                raise Exception('read {0} instead of {1} entries of {2}'.format(n_read, n_entries, varexp))
+            for i_column, branch in enumerate(group):
+                buf = getattr(self.tree, "GetV{0}".format(i_column + 1))()
+                buf.SetSize(n_read)
+                columns[branch] = numpy.frombuffer(buf, dtype=numpy.float64, count=n_read).copy()
+        return columns
+
+    def iter_chunks(self, keys, first=0, last=None):
+        """ Lazily iterate over the entries [first, last) in chunks of chunk_size entries.
+        Yields [first entry of the chunk, dictionary key -> numpy array]
+        """
+        if last is None or last > self.n_entries:
+            last = self.n_entries
+        for chunk_first in xrange(first, last, self.chunk_size):
+            n_entries = min(self.chunk_size, last - chunk_first)
+            yield [chunk_first, self.read(keys, chunk_first, n_entries)]
+
+    def read_all(self, keys, first=0, last=None):
+        """ Read the entries [first, last) chunk by chunk and return the concatenated arrays """
+        chunks = [columns for chunk_first, columns in self.iter_chunks(keys, first, last)]
+        columns = {}
+        for key in keys:
+            if chunks:
+                columns[key] = numpy.concatenate([chunk[key] for chunk in chunks])
+            else:
+                columns[key] = numpy.zeros(0)
+        return columns
+
+    def gather(self, keys, entries):
+        """ Read the branches for a list of entries (any order, negative entries give NaN).
+        Only the chunks which contain requested entries are read, for cached branches the
+        entries are picked directly.
+        Return a dictionary key -> numpy array with one value per requested entry
+        """
+        entries = numpy.asarray(entries, dtype=numpy.int64)
+        columns = {}
+        for key in keys:
+            columns[key] = numpy.empty(len(entries))
+            columns[key].fill(numpy.nan)
+        valid = numpy.flatnonzero((entries >= 0) & (entries < self.n_entries))
+        if len(valid) == 0:
+            return columns
+        if all(self.cached_column(key) is not None for key in keys):
+            for key in keys:
+                columns[key][valid] = self.cached_column(key)[entries[valid]]
+            return columns
+
+        # Walk through the requested entries in order of the tree
+        order = valid[numpy.argsort(entries[valid], kind='mergesort')]
+        sorted_entries = entries[order]
+        i_first = 0
+        while i_first < len(order):
+            chunk_first = int(sorted_entries[i_first])
+            chunk_last = min(chunk_first + self.chunk_size, self.n_entries)
+            i_last = int(numpy.searchsorted(sorted_entries, chunk_last, side='left'))
+            chunk = self.read(keys, chunk_first, chunk_last - chunk_first)
+            for key in keys:
+                columns[key][order[i_first:i_last]] = chunk[key][sorted_entries[i_first:i_last] - chunk_first]
+            i_first = i_last
+        return columns
+
+    def read_entry(self, keys, entry):
+        """ Read single values for one entry. Return a dictionary key -> value """
+        columns = self.read(keys, entry, 1)
+        return dict((key, columns[key][0]) for key in keys)
+
+
+# End of class BranchReader
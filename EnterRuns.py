@@ -17,7 +17,7 @@ from RunInfo import RunInfo
 # Get already saved runs
 ###############################
 
-runs_filename = "runs.json"
+runs_filename = "runs.db"
 RunInfo.load(runs_filename)
 
 
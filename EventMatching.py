@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+
+"""
+Vectorized matching of pad and pixel events for TimingAlignment.py
+
+Instead of reading a window of pixel entries per pad event, the time stamps
+of both trees are loaded once as arrays, all pixel clock ticks are converted
+to pad time in one pass and the nearest pixel event for every pad event is
+found with a sorted search.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import numpy
+
+
+###############################
+# pixel_to_pad_time
+###############################
+
+def pixel_to_pad_time(pixel_now, pixel_0, pad_now, pad_0, offset, slope):
+    """ Same conversion as TimingAlignment.pixel_to_pad_time, works on arrays """
+    # How many ticks have passed since first pixel time-stamp
+    delta_pixel = pixel_now - pixel_0
+
+    # Convert ticks to seconds (1 tick ~ 25 ns)
+    delta_second = delta_pixel * 25e-9 + offset
+
+    # Add time difference (in seconds) to initial pad time
+    return pad_0 + delta_second + slope * (pad_now - pad_0)
+
+
+# End of pixel_to_pad_time
+
+
+###############################
+# Matching helpers
+###############################
+
+def _lowest_index(pixel_ticks, indices):
+    """ For (possibly duplicated) time stamps return the lowest index with the same value """
+    return numpy.searchsorted(pixel_ticks, pixel_ticks[indices], side='left')
+
+
+def _best_in_window(pixel_ticks, nearest, lo, hi):
+    """ Best match inside the window [lo, hi) given the globally nearest pixel event.
+    The residual is unimodal in the pixel index, so the best event inside the window
+    is the window edge closest to the global optimum.
+    """
+    if nearest < lo:
+        return lo
+    if nearest >= hi:
+        return max(lo, int(numpy.searchsorted(pixel_ticks, pixel_ticks[hi - 1], side='left')))
+    return nearest
+
+
+def _match_sequential(t_pad, t_pixel, pixel_0, pad_0, offset, slope, i_start, search_width, step):
+    """ Reference implementation: window scan per pad event (works on arrays, not trees).
+    Used for pixel streams which are not ordered in time.
+    """
+    n_pixel = len(t_pixel)
+    i_best = numpy.zeros(len(t_pad), dtype=numpy.int64)
+    center = i_start
+    for i_ev in xrange(len(t_pad)):
+        lo = max(center - search_width, 0)
+        hi = min(center + search_width, n_pixel)
+        window = t_pixel[lo:hi]
+        delta = pixel_to_pad_time(window, pixel_0, t_pad[i_ev], pad_0, offset, slope) - t_pad[i_ev]
+        # argmin returns the first occurence, same as the stable sort of the window scan
+        i_best[i_ev] = lo + int(numpy.argmin(numpy.abs(delta)))
+        center = i_best[i_ev] + step
+    return i_best
+
+
+###############################
+# nearest_pixel_events
+###############################
+
+def nearest_pixel_events(t_pad, t_pixel, pixel_0, pad_0, offset, slope):
+    """ Pixel event nearest in time to every pad event (no search window),
+    found by binary search. The pixel time stamps have to be ordered in time.
+    Of several equally near events the lowest index is returned.
+    """
+    t_pad = numpy.asarray(t_pad, dtype=numpy.float64)
+    n_pixel = len(t_pixel)
+
+    # Position of each pad event on the pixel time axis:
+    # residual = (t_pixel - pixel_0) * 25ns - ((t_pad - pad_0) * (1 - slope) - offset)
+    pixel_seconds = (t_pixel - pixel_0) * 25e-9
+    pad_seconds = (t_pad - pad_0) * (1. - slope) - offset
+    right = numpy.clip(numpy.searchsorted(pixel_seconds, pad_seconds, side='left'), 0, n_pixel - 1)
+    left = _lowest_index(t_pixel, numpy.clip(right - 1, 0, n_pixel - 1))
+
+    # Decide between the two neighbours with the exact conversion
+    delta_left = pixel_to_pad_time(t_pixel[left], pixel_0, t_pad, pad_0, offset, slope) - t_pad
+    delta_right = pixel_to_pad_time(t_pixel[right], pixel_0, t_pad, pad_0, offset, slope) - t_pad
+    return numpy.where(numpy.abs(delta_left) <= numpy.abs(delta_right), left, right)
+
+
+###############################
+# match_events
+###############################
+
+def match_events(t_pad, t_pixel, pixel_0, pad_0, offset, slope, i_start, search_width, step=0):
+    """ Find the best matching pixel event for every pad event.
+
+    Gives the same result as calling TimingAlignment.find_associated_pixel_event once per
+    pad event, where the search window of pad event k is
+    [center - search_width, center + search_width) and the center is i_start for the first
+    event and (best match of the previous event + step) afterwards.
+
+    :param t_pad: pad time stamps [s] of the events to match (in processing order)
+    :param t_pixel: all pixel time stamps [clock ticks]
+    :param pixel_0: pixel time stamp of the alignment event
+    :param pad_0: pad time stamp of the alignment event
+    :param offset: time offset between pixel and pad clock [s]
+    :param slope: drift between pixel and pad clock
+    :param i_start: center of the search window for the first pad event
+    :param search_width: half width of the search window
+    :param step: shift of the window center relative to the previous best match
+    :return: [i_best, delta_t, time_pixel_in_pad] as arrays (one entry per pad event)
+    """
+    t_pad = numpy.asarray(t_pad, dtype=numpy.float64)
+    t_pixel = numpy.asarray(t_pixel)
+    n_pad = len(t_pad)
+    n_pixel = len(t_pixel)
+
+    if n_pad == 0 or n_pixel == 0:
+        return [numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0)]
+
+    if numpy.any(numpy.diff(t_pixel) < 0):
+        # Not ordered in time: no sorted search possible
+        i_best = _match_sequential(t_pad, t_pixel, pixel_0, pad_0, offset, slope, i_start, search_width, step)
+    else:
+        nearest = nearest_pixel_events(t_pad, t_pixel, pixel_0, pad_0, offset, slope)
+
+        # Window constraint: as long as the nearest event lies inside the window around the
+        # previous match the greedy search finds the same event
+        center = numpy.empty(n_pad, dtype=numpy.int64)
+        center[0] = i_start
+        center[1:] = nearest[:-1] + step
+        lo = numpy.maximum(center - search_width, 0)
+        hi = numpy.minimum(center + search_width, n_pixel)
+        outside = numpy.flatnonzero((nearest < lo) | (nearest >= hi))
+
+        # Follow the greedy search through the regions where it lost track of the
+        # nearest event, until it is back on the nearest event
+        i_best = nearest.copy()
+        i_last = -1
+        for i_ev in outside:
+            if i_ev <= i_last:
+                continue
+            i_last = i_ev
+            while i_last < n_pad:
+                if i_last == 0:
+                    this_center = i_start
+                else:
+                    this_center = int(i_best[i_last - 1]) + step
+                this_lo = max(this_center - search_width, 0)
+                this_hi = min(this_center + search_width, n_pixel)
+                i_best[i_last] = _best_in_window(t_pixel, int(nearest[i_last]), this_lo, this_hi)
+                if i_best[i_last] == nearest[i_last]:
+                    break
+                i_last += 1
+
+    time_pixel_in_pad = pixel_to_pad_time(t_pixel[i_best], pixel_0, t_pad, pad_0, offset, slope)
+    delta_t = time_pixel_in_pad - t_pad
+    return [i_best, delta_t, time_pixel_in_pad]
+
+
+# End of match_events
+
+
+###############################
+# Class: DriftTracker
+###############################
+
+class DriftTracker:
+    """ Recursive least squares estimate of the residual t_pixel - t_pad as a linear
+    function of the time since the alignment event: residual = a + b * (t_pad - pad_0).
+
+    Correcting the time offset by -a and the drift by -b gives the timing constants
+    which save_histograms otherwise gets from the fit of h2 after the loop.
+    """
+
+    def __init__(self, noise=2e-5, forgetting=1., p_offset=1e-6, p_slope=1e-10):
+        # noise: expected spread of the residuals [s]
+        # forgetting: weight of the past per event (1 = no forgetting)
+        # p_offset / p_slope: prior variances of the corrections
+        self.noise2 = noise * noise
+        self.forgetting = forgetting
+        self.a = 0.
+        self.b = 0.
+        # Covariance matrix of [a, b]
+        self.p00 = p_offset
+        self.p01 = 0.
+        self.p11 = p_slope
+        self.n_updates = 0
+
+    # End __init__
+
+    def predict(self, x):
+        return self.a + self.b * x
+
+    def update(self, x, residual):
+        # Gain k = P h / (noise^2 + h^T P h) with h = [1, x]
+        ph0 = self.p00 + self.p01 * x
+        ph1 = self.p01 + self.p11 * x
+        denominator = self.noise2 + ph0 + ph1 * x
+        k0 = ph0 / denominator
+        k1 = ph1 / denominator
+
+        error = residual - self.predict(x)
+        self.a += k0 * error
+        self.b += k1 * error
+
+        # P = (P - k h^T P) / lambda
+        self.p00 = (self.p00 - k0 * ph0) / self.forgetting
+        self.p01 = (self.p01 - k0 * ph1) / self.forgetting
+        self.p11 = (self.p11 - k1 * ph1) / self.forgetting
+        self.n_updates += 1
+
+
+# End of class DriftTracker
+
+
+###############################
+# match_events_tracking
+###############################
+
+def match_events_tracking(t_pad, t_pixel, pixel_0, pad_0, offset, slope, i_start, max_width,
+                          min_width=2, accept=0.001, tight=0.0001, n_tight=10):
+    """ Match pad and pixel events while tracking the clock offset and drift.
+
+    Every matched event (|residual| < accept) updates a DriftTracker, whose prediction
+    corrects the pixel to pad time conversion of the following events. The half width of
+    the search window shrinks by one event after n_tight consecutive matches with a
+    residual below tight (down to min_width) and doubles after a miss (up to max_width).
+
+    :return: [i_best, delta_t, time_pixel_in_pad, offset, slope, n_lookups] where delta_t and
+             time_pixel_in_pad use the corrected timing constants, offset and slope are the
+             timing constants at the end of the run and n_lookups is the number of pixel events
+             compared
+    """
+    n_pad = len(t_pad)
+    n_pixel = len(t_pixel)
+    i_best = numpy.zeros(n_pad, dtype=numpy.int64)
+    delta_t = numpy.zeros(n_pad)
+    time_pixel_in_pad = numpy.zeros(n_pad)
+
+    # Plain python lists: the windows are too small for numpy to pay off
+    t_pad_list = numpy.asarray(t_pad, dtype=numpy.float64).tolist()
+    t_pixel_list = numpy.asarray(t_pixel).tolist()
+
+    tracker = DriftTracker()
+    width = max_width
+    n_good = 0
+    n_lookups = 0
+    center = i_start
+    for i_ev in xrange(n_pad):
+        time_pad = t_pad_list[i_ev]
+        x = time_pad - pad_0
+        correction = tracker.predict(x)
+
+        lo = max(center - width, 0)
+        hi = min(center + width, n_pixel)
+        best = lo
+        best_raw = None
+        best_abs = None
+        for i_pixel in xrange(lo, hi):
+            raw = pixel_to_pad_time(t_pixel_list[i_pixel], pixel_0, time_pad, pad_0, offset, slope) - time_pad
+            this_abs = abs(raw - correction)
+            if best_abs is None or this_abs < best_abs:
+                best = i_pixel
+                best_raw = raw
+                best_abs = this_abs
+        n_lookups += hi - lo
+
+        i_best[i_ev] = best
+        delta_t[i_ev] = best_raw - correction
+        time_pixel_in_pad[i_ev] = time_pad + delta_t[i_ev]
+        center = best
+
+        if best_abs < accept:
+            tracker.update(x, best_raw)
+            if best_abs < tight:
+                n_good += 1
+            else:
+                n_good = 0
+            if n_good >= n_tight and width > min_width:
+                width -= 1
+                n_good = 0
+        else:
+            n_good = 0
+            width = min(2 * width, max_width)
+
+    return [i_best, delta_t, time_pixel_in_pad, offset - tracker.a, slope - tracker.b, n_lookups]
+
+
+# End of match_events_tracking
+
+
+###############################
+# align_banded
+###############################
+
+def _skipped_ranges(indices):
+    """ Group sorted indices into ranges. Return a list of [first, last] """
+    ranges = []
+    for index in indices:
+        index = int(index)
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
+def _align_block(pad_seconds, pixel_seconds, guide, band, gap_pad, gap_pixel, j_start):
+    """ Banded alignment of the pad events of one block.
+
+    Row i covers the pixel events [first[i], first[i] + width[i]) around guide[i].
+    cost[i][j] is the lowest total cost of pad events 0..i and pixel events up to j:
+    min(match: cost[i-1][j-1] + |residual|, skip pad: cost[i-1][j] + gap_pad,
+        skip pixel: cost[i][j-1] + gap_pixel).
+    j_start: the block starts after pixel event j_start (-1: free start)
+
+    Return [first, moves] with moves[i] the choice (0: match, 1: skip pad, 2: skip pixel) per cell
+    and the pixel event of the best end cell of the last row
+    """
+    n_pad = len(pad_seconds)
+    n_pixel = len(pixel_seconds)
+    first = numpy.clip(guide - band, 0, n_pixel - 1)
+    last = numpy.clip(guide + band + 1, 1, n_pixel)
+    # Consecutive rows have to overlap (the guide jumps where many events are missing)
+    first[1:] = numpy.minimum(first[1:], last[:-1])
+    if j_start >= 0:
+        first[0] = min(first[0], j_start)
+        last[0] = max(last[0], min(j_start + 2, n_pixel))
+    moves = []
+
+    # Row -1
+    if j_start < 0:
+        prev_first = -1
+        prev_cost = numpy.zeros(n_pixel + 1)
+    else:
+        prev_first = j_start
+        prev_cost = numpy.zeros(1)
+
+    for i in xrange(n_pad):
+        columns = numpy.arange(first[i], last[i])
+
+        # Previous row at j-1 (match) and j (skip pad)
+        i_diag = columns - 1 - prev_first
+        i_up = columns - prev_first
+        diag = numpy.where((i_diag >= 0) & (i_diag < len(prev_cost)),
+                           prev_cost[numpy.clip(i_diag, 0, len(prev_cost) - 1)], numpy.inf)
+        up = numpy.where((i_up >= 0) & (i_up < len(prev_cost)),
+                         prev_cost[numpy.clip(i_up, 0, len(prev_cost) - 1)], numpy.inf)
+        diag = diag + numpy.abs(pixel_seconds[columns] - pad_seconds[i])
+        up = up + gap_pad
+        best = numpy.minimum(diag, up)
+
+        # Skip pixel: cost[j] = min(best[j], cost[j-1] + gap_pixel), a running minimum
+        steps = numpy.arange(len(columns)) * gap_pixel
+        cost = numpy.minimum.accumulate(best - steps) + steps
+
+        move = numpy.where(diag <= up, 0, 1).astype(numpy.int8)
+        move[cost < best] = 2
+        moves.append(move)
+
+        prev_first = first[i]
+        prev_cost = cost
+
+    j_end = int(first[-1] + numpy.argmin(prev_cost))
+    return [first, moves, j_end]
+
+
+def _trace_back(first, moves, j_end):
+    """ Follow the moves back from the end cell.
+    Return [matched pixel per pad event (-1: skipped), pixel event from which each row is left]
+    """
+    n_pad = len(moves)
+    matched = -numpy.ones(n_pad, dtype=numpy.int64)
+    exit_column = numpy.zeros(n_pad, dtype=numpy.int64)
+    i = n_pad - 1
+    j = j_end
+    exit_column[i] = j
+    while i >= 0:
+        k = j - first[i]
+        if k < 0 or k >= len(moves[i]):
+            # Left the band: only possible at the free start of the first block
+            break
+        move = moves[i][k]
+        if move == 0:
+            matched[i] = j
+            i -= 1
+            j -= 1
+        elif move == 1:
+            i -= 1
+        else:
+            j -= 1
+            continue
+        if i >= 0:
+            exit_column[i] = j
+    return [matched, exit_column]
+
+
+def align_banded(t_pad, t_pixel, pixel_0, pad_0, offset, slope, band=10, gap_pad=0.0005, gap_pixel=0.0005,
+                 block_size=50000, overlap=2000):
+    """ Align the pad and pixel time stamps as two sequences, allowing events missing on
+    either side. The total absolute residual plus gap_pad per skipped pad event and
+    gap_pixel per skipped pixel event is minimized.
+
+    The alignment is restricted to a band of +- band pixel events around the pixel event
+    nearest in time, so time and memory are O(n * band). Long runs are aligned in blocks of
+    block_size pad events; each block is aligned with overlap more events and only its
+    first block_size events are kept.
+
+    :return: [i_best, delta_t, time_pixel_in_pad, skipped_pad, skipped_pixel]
+             i_best is -1 (and delta_t/time_pixel_in_pad NaN) for skipped pad events,
+             skipped_pad/skipped_pixel are lists of [first, last] index ranges
+    """
+    t_pad = numpy.asarray(t_pad, dtype=numpy.float64)
+    t_pixel = numpy.asarray(t_pixel)
+    n_pad = len(t_pad)
+    n_pixel = len(t_pixel)
+    i_best = -numpy.ones(n_pad, dtype=numpy.int64)
+
+    if n_pad > 0 and n_pixel > 0:
+        pixel_seconds = (t_pixel - pixel_0) * 25e-9
+        pad_seconds = (t_pad - pad_0) * (1. - slope) - offset
+        guide = numpy.clip(numpy.searchsorted(pixel_seconds, pad_seconds), 0, n_pixel - 1)
+        # The band follows the time axis, it has to be monotonous
+        guide = numpy.maximum.accumulate(guide)
+
+        j_start = -1
+        for block_first in xrange(0, n_pad, block_size):
+            block_last = min(n_pad, block_first + block_size + overlap)
+            keep = min(block_size, n_pad - block_first)
+            first, moves, j_end = _align_block(pad_seconds[block_first:block_last], pixel_seconds,
+                                               guide[block_first:block_last], band, gap_pad, gap_pixel,
+                                               j_start)
+            matched, exit_column = _trace_back(first, moves, j_end)
+            i_best[block_first:block_first + keep] = matched[:keep]
+            j_start = int(exit_column[keep - 1])
+
+    delta_t = numpy.empty(n_pad)
+    delta_t.fill(numpy.nan)
+    time_pixel_in_pad = numpy.empty(n_pad)
+    time_pixel_in_pad.fill(numpy.nan)
+    is_matched = i_best >= 0
+    time_pixel_in_pad[is_matched] = pixel_to_pad_time(t_pixel[i_best[is_matched]], pixel_0,
+                                                      t_pad[is_matched], pad_0, offset, slope)
+    delta_t[is_matched] = time_pixel_in_pad[is_matched] - t_pad[is_matched]
+
+    # Pixel events between the first and last match which are not used
+    matched_pixels = i_best[is_matched]
+    skipped_pixel = []
+    if len(matched_pixels):
+        used = numpy.zeros(n_pixel, dtype=bool)
+        used[matched_pixels] = True
+        skipped_pixel = _skipped_ranges(numpy.flatnonzero(~used[matched_pixels[0]:matched_pixels[-1] + 1]) +
+                                        matched_pixels[0])
+    skipped_pad = _skipped_ranges(numpy.flatnonzero(~is_matched))
+    return [i_best, delta_t, time_pixel_in_pad, skipped_pad, skipped_pixel]
+
+
+# End of align_banded
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of fit results.
+
+A fit result is stored under a hash of everything it depends on: the bin
+contents and binning of the fitted histogram, the fit model and start
+parameters and the fit range. Fitting the same histogram again (e.g. when only
+the drawing of the plots changed) takes the result from the cache.
+
+The results are kept in an SQLite file (default ./fit_cache/fit_results.db),
+one row per result, looked up one at a time. save() writes the new results of
+this process in one transaction, so processes saving at the same time do not
+lose each other's results. The total size is limited, the least recently used
+results are removed first.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+import numpy
+
+import ROOT
+
+from HistoArrays import histogram_contents
+from HistoCache import histogram_binning
+
+
+###############################
+# Class: FitCache
+###############################
+
+class FitCache:
+    """ Fit results by key, see module documentation.
+
+    Example:
+    cache = FitCache()
+    key = cache.key(contents, "landau", [x_min, x_max])
+    result = cache.get(key)
+    if result is None:
+        result = fit(contents)
+        cache.put(key, result)
+    cache.save()
+    """
+
+    # Wait this long [s] for other processes saving
+    timeout = 600.
+
+    def __init__(self, filename='./fit_cache/fit_results.db', max_size=100 * 1024 ** 2):
+        self.filename = filename
+        self.max_size = max_size
+        # Results of this process: all looked up or new ones, the new ones and the keys read from the file
+        self.results = {}
+        self.new_results = {}
+        self.used = set()
+        self.connection = None
+        self.pid = None
+
+    # End __init__
+
+    def connect(self):
+        """ The connection of this process (a connection must not be used after a fork) """
+        if self.pid != os.getpid():
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created by another process in the meantime
+                    pass
+            # Transactions are started explicitly (see save)
+            self.connection = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, result TEXT, '
+                                    'size INTEGER, used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fits_used ON fits (used)')
+            self.pid = os.getpid()
+        return self.connection
+
+    def key(self, contents, model, *args):
+        """ Hash of the bin contents (array) and JSON serializable descriptions of the fit """
+        digest = hashlib.sha1(numpy.ascontiguousarray(contents, dtype=numpy.float64).tostring())
+        digest.update(json.dumps([model] + list(args), sort_keys=True))
+        return digest.hexdigest()
+
+    def get(self, key):
+        if key not in self.results:
+            row = self.connect().execute('SELECT result FROM fits WHERE key = ?', [key]).fetchone()
+            if row is None:
+                return None
+            self.results[key] = json.loads(row[0])
+            self.used.add(key)
+        return self.results[key]
+
+    def put(self, key, result):
+        """ Store a JSON serializable result """
+        self.results[key] = result
+        self.new_results[key] = result
+
+    def save(self):
+        """ Write the new results to the file, mark the results read as recently used and remove
+        the least recently used results above max_size """
+        if not self.new_results and not self.used:
+            return
+        connection = self.connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = [[key, json.dumps(result)] for key, result in self.new_results.items()]
+            connection.executemany('INSERT OR REPLACE INTO fits (key, result, size, used) VALUES (?, ?, ?, ?)',
+                                   [[key, result, len(key) + len(result), now] for key, result in rows])
+            connection.executemany('UPDATE fits SET used = ? WHERE key = ?', [[now, key] for key in self.used])
+            self.evict(connection)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        self.new_results = {}
+        self.used = set()
+
+    def evict(self, connection):
+        total_size = connection.execute('SELECT total(size) FROM fits').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        removed = []
+        rows = connection.execute('SELECT key, size FROM fits ORDER BY used')
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            removed.append([key])
+            total_size -= size
+        rows.close()
+        connection.executemany('DELETE FROM fits WHERE key = ?', removed)
+
+
+# End of class FitCache
+
+
+###############################
+# cached_fit
+###############################
+
+def cached_fit(cache, hist, func, options='', x_min=None, x_max=None):
+    """ hist.Fit(func, options, '', x_min, x_max), unless a histogram with the same contents and
+    binning was fitted with the same function, start parameters, options and range before. Then
+    the parameters, errors and chi2 are set from the cache and (unless option N) a copy of func is
+    attached to hist, as after the fit. Without cache (None) the fit is always done.
+    """
+    n_par = func.GetNpar()
+    if x_min is None:
+        x_min, x_max = func.GetXmin(), func.GetXmax()
+    if cache is None:
+        hist.Fit(func, options, '', x_min, x_max)
+        return
+
+    key = cache.key(histogram_contents(hist), func.GetTitle(), histogram_binning(hist),
+                    [func.GetParameter(i) for i in xrange(n_par)], options, [x_min, x_max])
+    result = cache.get(key)
+    if result is None:
+        hist.Fit(func, options, '', x_min, x_max)
+        cache.put(key, {"parameters": [func.GetParameter(i) for i in xrange(n_par)],
+                        "errors": [func.GetParError(i) for i in xrange(n_par)],
+                        "chi2": func.GetChisquare(),
+                        "ndf": func.GetNDF()})
+        return
+
+    for i in xrange(n_par):
+        func.SetParameter(i, result["parameters"][i])
+        func.SetParError(i, result["errors"][i])
+    func.SetChisquare(result["chi2"])
+    func.SetNDF(result["ndf"])
+    if 'N' not in options.upper():
+        fitted = func.Clone()
+        ROOT.SetOwnership(fitted, False)
+        hist.GetListOfFunctions().Add(fitted)
+
+
+# End of cached_fit
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+Fill ROOT histograms from numpy arrays.
+
+The bin of every value is calculated with the same formula as TAxis::FindFixBin,
+the contents are then set for all cells at once and the statistics are summed
+up in the same order as calling Fill once per value, so the histogram is
+identical to one filled event by event (unit weights, fixed axes).
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import array
+
+import numpy
+
+
+###############################
+# Binning
+###############################
+
+def axis_bins(axis, values):
+    """ Bin numbers of the values on a TAxis (0: underflow, n+1: overflow), as TAxis::FindFixBin """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    n_bins = axis.GetNbins()
+    x_min = axis.GetXmin()
+    x_max = axis.GetXmax()
+    bins = numpy.empty(len(values), dtype=numpy.int64)
+
+    with numpy.errstate(invalid='ignore'):
+        underflow = values < x_min
+        # Written such that NaN ends up in the overflow, as in ROOT
+        overflow = ~(values < x_max)
+    in_range = ~underflow & ~overflow
+    edges = axis.GetXbins()
+    if edges.GetSize() > 0:
+        # Variable bin widths
+        edges = numpy.array([edges.At(i) for i in xrange(edges.GetSize())])
+        bins[in_range] = numpy.searchsorted(edges, values[in_range], side='right')
+    else:
+        bins[in_range] = 1 + (n_bins * (values[in_range] - x_min) / (x_max - x_min)).astype(numpy.int64)
+    bins[underflow] = 0
+    bins[overflow] = n_bins + 1
+    return bins
+
+
+def histogram_axes(histo):
+    return [histo.GetXaxis(), histo.GetYaxis(), histo.GetZaxis()][:histo.GetDimension()]
+
+
+def n_cells(histo):
+    n = 1
+    for axis in histogram_axes(histo):
+        n *= axis.GetNbins() + 2
+    return n
+
+
+# Element types of the TArray base classes of TH1F, TH2D, ...
+_array_types = {'C': numpy.int8, 'S': numpy.int16, 'I': numpy.int32, 'F': numpy.float32, 'D': numpy.float64}
+
+
+def histogram_contents(histo):
+    """ Contents of all cells (including under- and overflow) in global bin order """
+    dtype = _array_types.get(histo.ClassName()[-1])
+    if dtype is not None:
+        # Read the array of the histogram directly if PyROOT gives access to it
+        try:
+            buf = histo.GetArray()
+            buf.SetSize(n_cells(histo))
+            return numpy.frombuffer(buf, dtype=dtype, count=n_cells(histo)).astype(numpy.float64)
+        except (AttributeError, TypeError, ValueError):
+            pass
+    contents = array.array('d', [0.]) * n_cells(histo)
+    for i_cell in xrange(len(contents)):
+        contents[i_cell] = histo.GetBinContent(i_cell)
+    return numpy.frombuffer(contents, dtype=numpy.float64).copy()
+
+
+def set_contents(histo, contents):
+    """ Set the contents of all cells (global bin order), also the squared weights if they are stored """
+    if histo.GetSumw2N() > 0:
+        sumw2 = histo.GetSumw2()
+        for i_cell in numpy.flatnonzero(contents):
+            sumw2.SetAt(contents[i_cell], int(i_cell))
+    histo.SetContent(array.array('d', contents))
+
+
+###############################
+# Class: ArrayFiller
+###############################
+
+def _sequential_sum(start, values):
+    """ start + values[0] + values[1] + ... in this order (numpy.sum adds pairwise) """
+    if len(values) == 0:
+        return start
+    return numpy.cumsum(numpy.concatenate([[start], values]))[-1]
+
+
+class ArrayFiller:
+    """ Collects the entries of a histogram chunk by chunk, the histogram is updated with write().
+    Same result as histo.Fill(columns[0][i], columns[1][i], ...) for all entries, one column per
+    dimension. Works for unit weights and fixed axes (not extended while filling).
+
+    Example:
+    filler = ArrayFiller(h_time_2d)
+    for first, columns in reader.iter_chunks(["t_pad", "integral50"]):
+        filler.fill(columns["t_pad"], columns["integral50"])
+    filler.write()
+    """
+
+    def __init__(self, histo):
+        self.histo = histo
+        self.axes = histogram_axes(histo)
+        if histo.GetEntries() > 0:
+            self.contents = histogram_contents(histo)
+        else:
+            self.contents = numpy.zeros(n_cells(histo))
+        self.stats = array.array('d', [0.] * 13)
+        histo.GetStats(self.stats)
+        self.n_stats = {1: 4, 2: 7, 3: 11}[len(self.axes)]
+        self.entries = histo.GetEntries()
+
+    # End __init__
+
+    def fill(self, *columns):
+        if len(columns) != len(self.axes):
+            raise Exception('{0} columns for a {1}-dimensional histogram'.format(len(columns), len(self.axes)))
+        columns = [numpy.asarray(column, dtype=numpy.float64) for column in columns]
+        n_entries = len(columns[0])
+        if n_entries == 0:
+            return
+
+        # Global bin numbers as in TH1::GetBin
+        global_bins = numpy.zeros(n_entries, dtype=numpy.int64)
+        stride = 1
+        in_range = numpy.ones(n_entries, dtype=bool)
+        for axis, column in zip(self.axes, columns):
+            bins = axis_bins(axis, column)
+            global_bins += stride * bins
+            stride *= axis.GetNbins() + 2
+            in_range &= (bins > 0) & (bins <= axis.GetNbins())
+        self.contents += numpy.bincount(global_bins, minlength=len(self.contents))
+        self.entries += n_entries
+
+        # Statistics: only the entries inside the axis ranges are counted (TH1::Fill),
+        # in the order [w, w2, x, x2, y, y2, xy, z, z2, xz, yz]
+        values = [column[in_range] for column in columns]
+        terms = [numpy.ones(len(values[0])), numpy.ones(len(values[0]))]
+        for i_axis in xrange(len(self.axes)):
+            terms += [values[i_axis], values[i_axis] * values[i_axis]]
+            if i_axis == 1:
+                terms.append(values[0] * values[1])
+            if i_axis == 2:
+                terms += [values[0] * values[2], values[1] * values[2]]
+        for i_stat in xrange(self.n_stats):
+            self.stats[i_stat] = _sequential_sum(self.stats[i_stat], terms[i_stat])
+
+    def write(self):
+        """ Set contents, statistics and number of entries of the histogram """
+        set_contents(self.histo, self.contents)
+        self.histo.PutStats(self.stats)
+        self.histo.SetEntries(self.entries)
+
+
+# End of class ArrayFiller
+
+
+###############################
+# fill_histogram
+###############################
+
+def fill_histogram(histo, *columns):
+    """ Same as histo.Fill(columns[0][i], columns[1][i], ...) for all i, see ArrayFiller """
+    filler = ArrayFiller(histo)
+    filler.fill(*columns)
+    filler.write()
+
+
+# End of fill_histogram
+
+
+###############################
+# shift_histogram
+###############################
+
+def shift_histogram(raw, target, offset):
+    """ Fill target with the contents of raw, the values on the last axis shifted by -offset.
+    The other axes of raw and target must have the same binning. Every bin of raw minus offset
+    goes to the target bin it lies in, a bin across an edge of the target bins is split between
+    the two in proportion (as if its entries were uniform in it). Under- and overflow stay under-
+    and overflow, so raw has to be binned finer than target and should cover its range shifted
+    by offset. The statistics are calculated from the bin contents.
+    """
+    raw_axes = histogram_axes(raw)
+    target_axes = histogram_axes(target)
+    raw_axis = raw_axes[-1]
+    target_axis = target_axes[-1]
+    n_raw = raw_axis.GetNbins()
+    n_target = target_axis.GetNbins()
+
+    # Target bins of the low and high edge of every raw bin of the last axis, increasing with the raw bin
+    low = numpy.array([raw_axis.GetBinLowEdge(i_bin) for i_bin in xrange(1, n_raw + 1)]) - offset
+    high = numpy.array([raw_axis.GetBinUpEdge(i_bin) for i_bin in xrange(1, n_raw + 1)]) - offset
+    bins = numpy.concatenate([[0], axis_bins(target_axis, low), [n_target + 1]])
+    bins_high = numpy.concatenate([[0], axis_bins(target_axis, high), [n_target + 1]])
+    if n_cells(raw) / (n_raw + 2) != n_cells(target) / (n_target + 2):
+        raise Exception('Binning of {0} and {1} does not match'.format(raw.GetName(), target.GetName()))
+    if numpy.any(bins_high - bins > 1):
+        raise Exception('Bins of {0} are wider than the ones of {1}'.format(raw.GetName(), target.GetName()))
+
+    # The last axis is the slowest one in the global bin order: sum the rows of raw bins
+    # starting in the same target bin
+    contents = histogram_contents(raw).reshape(n_raw + 2, -1)
+    starts = numpy.concatenate([[0], numpy.nonzero(numpy.diff(bins))[0] + 1])
+    shifted = numpy.zeros((n_target + 2, contents.shape[1]))
+    shifted[bins[starts]] = numpy.add.reduceat(contents, starts, axis=0)
+
+    # Move the part above the edge of the raw bins across an edge (at most one per target bin)
+    split = numpy.nonzero(bins_high != bins)[0]
+    edges = numpy.array([target_axis.GetBinUpEdge(int(i_bin)) for i_bin in bins[split]])
+    fraction = (high[split - 1] - edges) / (high[split - 1] - low[split - 1])
+    moved = contents[split] * fraction[:, numpy.newaxis]
+    shifted[bins[split]] -= moved
+    shifted[bins_high[split]] += moved
+    contents = shifted.ravel()
+
+    target.Reset()
+    set_contents(target, contents)
+    target.ResetStats()
+    target.SetEntries(raw.GetEntries())
+
+
+# End of shift_histogram
+
+
+###############################
+# extend_histogram
+###############################
+
+def extend_histogram(histo, target):
+    """ Copy histo into target, whose x axis continues the one of histo with more bins of
+    the same width. The other axes must have the same binning. The x overflow of histo stays
+    in the overflow (it is not known in which of the new bins it would be).
+    """
+    n_old = histo.GetXaxis().GetNbins()
+    n_new = target.GetXaxis().GetNbins()
+    if n_new < n_old:
+        raise Exception('{0} has less bins than {1}'.format(target.GetName(), histo.GetName()))
+
+    # The x axis is the fastest one in the global bin order
+    contents = histogram_contents(histo).reshape(-1, n_old + 2)
+    extended = numpy.zeros((contents.shape[0], n_new + 2))
+    extended[:, :n_old + 1] = contents[:, :n_old + 1]
+    extended[:, -1] = contents[:, -1]
+
+    stats = array.array('d', [0.] * 13)
+    histo.GetStats(stats)
+    target.Reset()
+    set_contents(target, extended.ravel())
+    target.PutStats(stats)
+    target.SetEntries(histo.GetEntries())
+
+
+# End of extend_histogram
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Content addressed cache of histograms inside a ROOT file.
+
+Histograms are stored in <file>:histo_cache/<key>/ together with the
+description they were made from (a TNamed "spec" holding JSON). The key is a
+hash of this description, which should contain everything the contents depend
+on: a fingerprint of the input tree, constants like the pedestal, the binning
+and the cuts. Changing any of them gives a new key, so a stale variant is never
+picked up, and several variants can be kept in the same file.
+
+Histograms which are filled incrementally leave the input tree out of the
+description and store a "state" instead (e.g. the number of entries filled),
+which the user checks against the current tree.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import json
+import hashlib
+
+import ROOT
+
+
+###############################
+# Keys
+###############################
+
+def tree_fingerprint(tree):
+    """ Description of the contents of a tree which changes whenever the tree is rewritten """
+    fingerprint = {"entries": int(tree.GetEntries()),
+                   "tot_bytes": int(tree.GetTotBytes()),
+                   "zip_bytes": int(tree.GetZipBytes())}
+    directory = tree.GetDirectory()
+    if directory:
+        key = directory.GetKey(tree.GetName())
+        if key:
+            fingerprint["cycle"] = int(key.GetCycle())
+            fingerprint["datime"] = int(key.GetDatime().Convert())
+    return fingerprint
+
+
+def histogram_binning(histo):
+    """ Class and [n_bins, min, max] (or the bin edges) of every axis of a histogram """
+    binning = [histo.ClassName()]
+    for axis in [histo.GetXaxis(), histo.GetYaxis(), histo.GetZaxis()][:histo.GetDimension()]:
+        edges = axis.GetXbins()
+        if edges.GetSize() > 0:
+            binning.append([edges.At(i) for i in xrange(edges.GetSize())])
+        else:
+            binning.append([axis.GetNbins(), axis.GetXmin(), axis.GetXmax()])
+    return binning
+
+
+def cache_key(spec):
+    """ Hash of a JSON serializable description """
+    return hashlib.sha1(json.dumps(spec, sort_keys=True)).hexdigest()[:16]
+
+
+###############################
+# Class: HistoCache
+###############################
+
+class HistoCache:
+    """ Histograms stored in a ROOT file under the key of their description, see module documentation.
+
+    Example:
+    cache = HistoCache(infile)
+    spec = {"tree": tree_fingerprint(tree), "pedestal": pedestal, "binning": histogram_binning(h)}
+    histos = cache.get(spec, ["h"])
+    if histos is None:
+        # fill h
+        cache.put(spec, [h])   # infile has to be writable
+    """
+
+    def __init__(self, tfile, dirname="histo_cache"):
+        self.tfile = tfile
+        self.dirname = dirname
+
+    # End __init__
+
+    def directory(self, spec):
+        return self.tfile.GetDirectory("{0}/{1}".format(self.dirname, cache_key(spec)))
+
+    def get(self, spec, names):
+        """ Dictionary name: histogram (not attached to any file) of the cached variant of spec.
+        Return None unless all histograms are found.
+        """
+        directory = self.directory(spec)
+        if not directory:
+            return None
+        stored = directory.Get("spec")
+        if not stored or json.loads(stored.GetTitle()) != json.loads(json.dumps(spec)):
+            # Hash collision
+            return None
+        histos = {}
+        for name in names:
+            histo = directory.Get(name)
+            if not histo:
+                return None
+            histos[name] = histo.Clone(name)
+            histos[name].SetDirectory(0)
+        return histos
+
+    def state(self, spec):
+        """ The state stored with the variant of spec (see put), None if there is none """
+        directory = self.directory(spec)
+        if not directory:
+            return None
+        stored = directory.Get("state")
+        if not stored:
+            return None
+        return json.loads(stored.GetTitle())
+
+    def put(self, spec, histos, state=None):
+        """ Store the histograms as the variant of spec (replaces an existing variant).
+        state is any JSON serializable information about how far the histograms are filled.
+        """
+        top = self.tfile.GetDirectory(self.dirname)
+        if not top:
+            top = self.tfile.mkdir(self.dirname)
+        key = cache_key(spec)
+        directory = top.GetDirectory(key)
+        if not directory:
+            directory = top.mkdir(key)
+        directory.WriteTObject(ROOT.TNamed("spec", json.dumps(spec, sort_keys=True)), "spec", "WriteDelete")
+        if state is not None:
+            directory.WriteTObject(ROOT.TNamed("state", json.dumps(state, sort_keys=True)), "state", "WriteDelete")
+        for histo in histos:
+            directory.WriteTObject(histo, histo.GetName(), "WriteDelete")
+        return key
+
+    def variants(self):
+        """ Dictionary key: spec of all stored variants """
+        top = self.tfile.GetDirectory(self.dirname)
+        if not top:
+            return {}
+        variants = {}
+        for key in top.GetListOfKeys():
+            stored = top.Get("{0}/spec".format(key.GetName()))
+            if stored:
+                variants[key.GetName()] = json.loads(stored.GetTitle())
+        return variants
+
+    def export(self, keys=None):
+        """ Copies (not attached to any file) of the stored objects of all variants (or of the given keys),
+        dictionary key: list of objects. Used to keep the cache when the file is recreated, see restore.
+        """
+        top = self.tfile.GetDirectory(self.dirname)
+        if not top:
+            return {}
+        variants = {}
+        for key in top.GetListOfKeys():
+            if keys is not None and key.GetName() not in keys:
+                continue
+            directory = top.GetDirectory(key.GetName())
+            variants[key.GetName()] = []
+            for obj_key in directory.GetListOfKeys():
+                obj = obj_key.ReadObj()
+                if isinstance(obj, ROOT.TH1):
+                    obj.SetDirectory(0)
+                variants[key.GetName()].append(obj)
+        return variants
+
+    def restore(self, variants):
+        """ Store objects returned by export """
+        top = self.tfile.GetDirectory(self.dirname)
+        if not top:
+            top = self.tfile.mkdir(self.dirname)
+        for key, objs in variants.items():
+            directory = top.GetDirectory(key)
+            if not directory:
+                directory = top.mkdir(key)
+            for obj in objs:
+                directory.WriteTObject(obj, obj.GetName(), "WriteDelete")
+
+    def remove(self, key):
+        """ Delete a stored variant """
+        top = self.tfile.GetDirectory(self.dirname)
+        if top and top.GetDirectory(key):
+            top.Delete("{0};*".format(key))
+
+
+# End of class HistoCache
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+"""
+Batched Landau fits of many histograms with the same binning.
+
+Fits the model of AnalyzeHelpers.fitLandauGaus, [0] * TMath::Landau(x, [1], [2]),
+to all rows of an (N_hist x N_bins) array of bin contents at once: chi2 with
+the bin errors sqrt(content), empty bins excluded, function evaluated at the
+bin centers (as TH1::Fit without options). The minimization is a Levenberg-
+Marquardt iteration done for all histograms in parallel with numpy.
+
+The Landau (x) Gauss model is evaluated by interpolation in a table of the
+convolution over (Gauss width / Landau width, x), calculated once with FFTs
+and cached on disk.
+
+robust_estimators gives fit-free estimates of the same quantities (mode,
+truncated mean, median, width) for quick looks.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+
+import numpy
+
+
+###############################
+# landau_pdf
+###############################
+
+# Coefficients of CERNLIB G110 DENLAN (as in ROOT::Math::landau_pdf)
+_p1 = [0.4259894875, -0.1249762550, 0.03984243700, -0.006298287635, 0.001511162253]
+_q1 = [1.0, -0.3388260629, 0.09594393323, -0.01608042283, 0.003778942063]
+_p2 = [0.1788541609, 0.1173957403, 0.01488850518, -0.001394989411, 0.0001283617211]
+_q2 = [1.0, 0.7428795082, 0.3153932961, 0.06694219548, 0.008790609714]
+_p3 = [0.1788544503, 0.09359161662, 0.006325387654, 0.00006611667319, -0.000002031049101]
+_q3 = [1.0, 0.6097809921, 0.2560616665, 0.04746722384, 0.006957301675]
+_p4 = [0.9874054407, 118.6723273, 849.2794360, -743.7792444, 427.0262186]
+_q4 = [1.0, 106.8615961, 337.6496214, 2016.712389, 1597.063511]
+_p5 = [1.003675074, 167.5702434, 4789.711289, 21217.86767, -22324.94910]
+_q5 = [1.0, 156.9424537, 3745.310488, 9834.698876, 66924.28357]
+_p6 = [1.000827619, 664.9143136, 62972.92665, 475554.6998, -5743609.109]
+_q6 = [1.0, 651.4101098, 56974.73333, 165917.4725, -2815759.939]
+_a1 = [0.04166666667, -0.01996527778, 0.02709538966]
+_a2 = [-1.845568670, -4.284640743]
+
+
+def _ratio(p, q, u):
+    """ Ratio of the two polynomials of degree 4 (Horner scheme as in DENLAN) """
+    return (p[0] + (p[1] + (p[2] + (p[3] + p[4] * u) * u) * u) * u) / \
+           (q[0] + (q[1] + (q[2] + (q[3] + q[4] * u) * u) * u) * u)
+
+
+def landau_pdf(v):
+    """ Landau density of v = (x - mpv) / sigma, same as TMath::Landau(x, mpv, sigma) """
+    v = numpy.asarray(v, dtype=numpy.float64)
+    result = numpy.zeros(v.shape)
+
+    with numpy.errstate(all='ignore'):
+        region = v < -5.5
+        u = numpy.exp(v[region] + 1.)
+        values = 0.3989422803 * (numpy.exp(-1. / u) / numpy.sqrt(u)) * (1 + (_a1[0] + (_a1[1] + _a1[2] * u) * u) * u)
+        result[region] = numpy.where(u < 1e-10, 0., values)
+
+        region = (v >= -5.5) & (v < -1)
+        u = numpy.exp(-v[region] - 1)
+        result[region] = numpy.exp(-u) * numpy.sqrt(u) * _ratio(_p1, _q1, v[region])
+
+        region = (v >= -1) & (v < 1)
+        result[region] = _ratio(_p2, _q2, v[region])
+
+        region = (v >= 1) & (v < 5)
+        result[region] = _ratio(_p3, _q3, v[region])
+
+        for v_min, v_max, p, q in [[5, 12, _p4, _q4], [12, 50, _p5, _q5], [50, 300, _p6, _q6]]:
+            region = (v >= v_min) & (v < v_max)
+            u = 1 / v[region]
+            result[region] = u * u * _ratio(p, q, u)
+
+        region = v >= 300
+        u = 1 / (v[region] - v[region] * numpy.log(v[region]) / (v[region] + 1))
+        result[region] = u * u * (1 + (_a2[0] + _a2[1] * u) * u)
+    return result
+
+
+def landau_pdf_derivative(v, step=1e-5):
+    return (landau_pdf(v + step) - landau_pdf(v - step)) / (2 * step)
+
+
+###############################
+# Batched Levenberg-Marquardt
+###############################
+
+def _prepare(contents, x_min, x_max, negative):
+    """ Bin centers, reversed contents of negative histograms, moments and chi2 weights.
+    Return [contents, x, negative, integral, mean, rms, weights]
+    """
+    contents = numpy.atleast_2d(numpy.asarray(contents, dtype=numpy.float64))
+    n_hist, n_bins = contents.shape
+    width = (x_max - x_min) / float(n_bins)
+    x = x_min + width * (numpy.arange(n_bins) + 0.5)
+
+    # Polarity from the mean, negative histograms are fitted with reversed bin order
+    integral = contents.sum(axis=1)
+    with numpy.errstate(all='ignore'):
+        mean = (contents * x).sum(axis=1) / integral
+    if negative is None:
+        with numpy.errstate(invalid='ignore'):
+            negative = mean < 0
+    negative = numpy.zeros(n_hist, dtype=bool) | negative
+    contents = numpy.where(negative[:, numpy.newaxis], contents[:, ::-1], contents)
+
+    with numpy.errstate(all='ignore'):
+        mean = (contents * x).sum(axis=1) / integral
+        rms = numpy.sqrt(numpy.maximum((contents * x * x).sum(axis=1) / integral - mean * mean, 0.))
+        rms = numpy.where(rms > 0, rms, width)
+        weights = numpy.where(contents > 0, 1. / contents, 0.)
+    return [contents, x, negative, integral, mean, rms, weights]
+
+
+def _chi2(contents, weights, values):
+    return (weights * (contents - values) ** 2).sum(axis=1)
+
+
+def _levenberg_marquardt(contents, weights, parameters, model, valid, max_iterations, tolerance):
+    """ Minimize the chi2 of all histograms at once.
+    model(parameters) returns [values (N_hist x N_bins), jacobian (N_hist x N_bins x N_par)],
+    valid(parameters) marks the parameters for which the model is defined.
+    Return [parameters, errors, chi2] (errors from the inverse of J^T W J)
+    """
+    parameters = parameters.copy()
+    n_hist, n_parameters = parameters.shape
+    identity = numpy.eye(n_parameters)[numpy.newaxis]
+
+    def chi2_of(parameters):
+        with numpy.errstate(all='ignore'):
+            chi2 = _chi2(contents, weights, model(parameters)[0])
+        return numpy.where(valid(parameters) & numpy.isfinite(chi2), chi2, numpy.inf)
+
+    def normal_equations(parameters):
+        with numpy.errstate(all='ignore'):
+            values, jacobian = model(parameters)
+        weighted = jacobian * weights[:, :, numpy.newaxis]
+        jtj = numpy.einsum('nbi,nbj->nij', weighted, jacobian)
+        gradient = numpy.einsum('nbi,nb->ni', weighted, contents - values)
+        return [jtj, gradient]
+
+    def solvable(matrices, use):
+        # Replace the systems of finished / degenerate histograms by the identity
+        matrices = numpy.where(numpy.isfinite(matrices), matrices, 0.)
+        matrices[~use] = identity[0]
+        matrices[numpy.abs(numpy.linalg.det(matrices)) < 1e-300] = identity[0]
+        return matrices
+
+    chi2 = chi2_of(parameters)
+    damping = numpy.ones(n_hist) * 1e-3
+    active = numpy.isfinite(chi2)
+    for i_iteration in xrange(max_iterations):
+        if not active.any():
+            break
+        jtj, gradient = normal_equations(parameters)
+        diagonal = numpy.einsum('nii->ni', jtj)
+        damped = solvable(jtj + damping[:, numpy.newaxis, numpy.newaxis] * diagonal[:, :, numpy.newaxis] * identity,
+                          active)
+        step = numpy.linalg.solve(damped, numpy.where(numpy.isfinite(gradient), gradient, 0.)[:, :, numpy.newaxis])
+        step = step[:, :, 0]
+        step[~active] = 0.
+
+        trial = parameters + step
+        trial_chi2 = chi2_of(trial)
+        better = active & (trial_chi2 <= chi2)
+        converged = better & (chi2 - trial_chi2 <= tolerance * numpy.maximum(chi2, 1.))
+        parameters[better] = trial[better]
+        chi2 = numpy.where(better, trial_chi2, chi2)
+        damping = numpy.where(better, damping / 10., damping * 10.)
+        active &= ~converged & (damping < 1e10)
+
+    # Parameter errors as for a chi2 fit (error definition 1)
+    jtj = normal_equations(parameters)[0]
+    fitted = numpy.isfinite(chi2)
+    covariance = numpy.linalg.inv(solvable(jtj, fitted))
+    errors = numpy.sqrt(numpy.abs(numpy.einsum('nii->ni', covariance)))
+    errors[~fitted] = 0.
+    return [parameters, errors, chi2]
+
+
+###############################
+# fit_landau_batch
+###############################
+
+def landau_model(x):
+    """ [0] * TMath::Landau(x, [1], [2]) and its derivatives for the batched fit """
+    def model(parameters):
+        norm, mpv, sigma = [parameters[:, i:i + 1] for i in xrange(3)]
+        v = (x - mpv) / sigma
+        shape = landau_pdf(v)
+        derivative = landau_pdf_derivative(v)
+        jacobian = numpy.empty(shape.shape + (3,))
+        jacobian[:, :, 0] = shape
+        jacobian[:, :, 1] = -norm * derivative / sigma
+        jacobian[:, :, 2] = -norm * derivative * v / sigma
+        return [norm * shape, jacobian]
+    return model
+
+
+def _valid_landau(parameters):
+    # The function vanishes for sigma <= 0 (TMath::Landau)
+    return parameters[:, 2] > 0
+
+
+def _start_rows(start, n_hist, n_par):
+    """ Rows with given start parameters (start is None or N_hist x n_par, NaN rows: not given) """
+    if start is None:
+        return numpy.zeros(n_hist, dtype=bool)
+    start = numpy.asarray(start, dtype=numpy.float64).reshape(n_hist, n_par)
+    return numpy.isfinite(start).all(axis=1)
+
+
+def fit_landau_batch(contents, x_min, x_max, negative=None, full_output=False, max_iterations=200,
+                     tolerance=1e-10, start=None):
+    """ Fit [0] * TMath::Landau(x, [1], [2]) to every row of contents (bin contents without
+    under- and overflow on the axis [x_min, x_max]).
+
+    Histograms with negative mean (or where negative is True) are fitted with the bin order
+    reversed (as AnalyzeHelpers.turnHisto), their MPV is returned with negative sign.
+    Start values: mean and RMS of the histogram, normalization from a linear fit, or the
+    rows of start (e.g. the results of neighbouring histograms, same layout as the result)
+    where they are finite.
+
+    :return: array (N_hist x 3) of [norm, mpv, sigma], the layout of the fitLandauGaus results,
+             with full_output [parameters, errors, chi2, number of non-empty bins]
+    """
+    contents, x, negative, integral, mean, rms, weights = _prepare(contents, x_min, x_max, negative)
+
+    # Start values, the normalization from a linear least squares fit
+    parameters = numpy.zeros((len(contents), 3))
+    parameters[:, 1] = mean
+    parameters[:, 2] = rms
+    shape = landau_pdf((x - parameters[:, 1:2]) / parameters[:, 2:3])
+    with numpy.errstate(all='ignore'):
+        norm = (weights * contents * shape).sum(axis=1) / (weights * shape * shape).sum(axis=1)
+    parameters[:, 0] = numpy.where(numpy.isfinite(norm), norm, 1.)
+    warm = _start_rows(start, len(contents), 3)
+    if warm.any():
+        parameters[warm] = numpy.asarray(start, dtype=numpy.float64).reshape(len(contents), 3)[warm]
+        parameters[warm, 1] = numpy.where(negative[warm], -parameters[warm, 1], parameters[warm, 1])
+    parameters[integral <= 0] = numpy.nan
+
+    parameters, errors, chi2 = _levenberg_marquardt(contents, weights, parameters, landau_model(x),
+                                                    _valid_landau, max_iterations, tolerance)
+    parameters[:, 1] = numpy.where(negative, -parameters[:, 1], parameters[:, 1])
+    if full_output:
+        return [parameters, errors, chi2, (contents > 0).sum(axis=1)]
+    return parameters
+
+
+# End of fit_landau_batch
+
+
+###############################
+# Class: LandauGaussTable
+###############################
+
+class LandauGaussTable:
+    """ Landau density convolved with a Gaussian, tabulated over the width ratio
+    r = sigma_gauss / sigma_landau and v = (x - mpv) / sigma_landau:
+    g(r, v) = integral landau_pdf(v - t) * gauss(t, 0, r) dt
+    Values are interpolated bilinearly. Above the table the Gauss smearing of the
+    1/v^2 tail is neglected (plain Landau), below it the density is zero.
+
+    The table is saved as <table_dir>/landau_gauss_<binning>.npy and loaded from there.
+    """
+
+    def __init__(self, table_dir='./fit_cache/', r_max=5., n_r=101, v_min=-30., v_max=200., v_step=0.02):
+        self.r_max = r_max
+        self.r_step = r_max / (n_r - 1.)
+        self.v_min = v_min
+        self.v_max = v_max
+        self.v_step = v_step
+        self.n_r = n_r
+        self.n_v = int(round((v_max - v_min) / v_step)) + 1
+
+        filename = os.path.join(table_dir, "landau_gauss_{0}_{1}_{2}_{3}_{4}.npy".format(
+            n_r, r_max, v_min, v_max, v_step))
+        if os.path.exists(filename):
+            self.table = numpy.load(filename)
+        else:
+            self.table = self.calculate()
+            if not os.path.exists(table_dir):
+                os.makedirs(table_dir)
+            filename_tmp = "{0}.{1}.tmp.npy".format(filename[:-4], os.getpid())
+            numpy.save(filename_tmp, self.table)
+            os.rename(filename_tmp, filename)
+
+    # End __init__
+
+    def calculate(self):
+        """ Convolutions for all width ratios, as products of Fourier transforms """
+        # The Landau density is needed up to 8 Gauss widths beyond the table,
+        # the zero padding keeps the periodic convolution from wrapping around
+        margin = int(numpy.ceil(8 * self.r_max / self.v_step))
+        v = self.v_min + self.v_step * numpy.arange(-margin, self.n_v + margin)
+        n_fft = 1
+        while n_fft < len(v) + margin:
+            n_fft *= 2
+        landau = numpy.fft.rfft(landau_pdf(v), n_fft)
+        frequencies = numpy.fft.rfftfreq(n_fft, self.v_step)
+
+        table = numpy.empty((self.n_r, self.n_v))
+        for i_r in xrange(self.n_r):
+            r = i_r * self.r_step
+            gauss = numpy.exp(-2 * (numpy.pi * frequencies * r) ** 2)
+            table[i_r] = numpy.fft.irfft(landau * gauss, n_fft)[margin:margin + self.n_v]
+        return table
+
+    def __call__(self, r, v):
+        """ g(r, v) for arrays r, v of the same shape (r in [0, r_max]) """
+        r = numpy.clip(r, 0., self.r_max)
+        r_index = r / self.r_step
+        i_r = numpy.minimum(r_index.astype(numpy.int64), self.n_r - 2)
+        w_r = r_index - i_r
+
+        v_index = (v - self.v_min) / self.v_step
+        inside = (v_index >= 0) & (v_index < self.n_v - 1)
+        v_index = numpy.where(inside, v_index, 0.)
+        i_v = v_index.astype(numpy.int64)
+        w_v = v_index - i_v
+
+        values = (1 - w_r) * ((1 - w_v) * self.table[i_r, i_v] + w_v * self.table[i_r, i_v + 1]) + \
+            w_r * ((1 - w_v) * self.table[i_r + 1, i_v] + w_v * self.table[i_r + 1, i_v + 1])
+        above = v >= self.v_max - self.v_step
+        values = numpy.where(inside, values, 0.)
+        values[above] = landau_pdf(v[above])
+        return values
+
+    def derivatives(self, r, v):
+        """ Return [g, dg/dv, dg/dr] (differences over one table step) """
+        r_up = numpy.minimum(r + self.r_step / 2, self.r_max)
+        r_down = numpy.maximum(r - self.r_step / 2, 0.)
+        d_v = (self(r, v + self.v_step) - self(r, v - self.v_step)) / (2 * self.v_step)
+        d_r = (self(r_up, v) - self(r_down, v)) / numpy.maximum(r_up - r_down, 1e-12)
+        return [self(r, v), d_v, d_r]
+
+
+# End of class LandauGaussTable
+
+
+###############################
+# fit_landau_gauss_batch
+###############################
+
+def landau_gauss_model(x, table):
+    """ [0] * (Landau(x, [1], [2]) (x) Gauss(0, [3])) and its derivatives for the batched fit """
+    def model(parameters):
+        norm, mpv, sigma, sigma_gauss = [parameters[:, i:i + 1] for i in xrange(4)]
+        v = (x - mpv) / sigma
+        r = numpy.broadcast_to(sigma_gauss / sigma, v.shape)
+        shape, d_v, d_r = table.derivatives(r, v)
+        jacobian = numpy.empty(shape.shape + (4,))
+        jacobian[:, :, 0] = shape
+        jacobian[:, :, 1] = -norm * d_v / sigma
+        jacobian[:, :, 2] = -norm * (d_v * v + d_r * r) / sigma
+        jacobian[:, :, 3] = norm * d_r / sigma
+        return [norm * shape, jacobian]
+    return model
+
+
+def fit_landau_gauss_batch(contents, x_min, x_max, negative=None, full_output=False, table=None,
+                           max_iterations=200, tolerance=1e-10, start=None):
+    """ Fit a Landau convolved with a Gaussian, [0] * (Landau(x, [1], [2]) (x) Gauss(0, [3])),
+    to every row of contents. Same conventions as fit_landau_batch, the start values come
+    from the Landau fit (which starts from start where given).
+    table: LandauGaussTable (default: the one in ./fit_cache/)
+
+    :return: array (N_hist x 4) of [norm, mpv, sigma, sigma_gauss],
+             with full_output [parameters, errors, chi2, number of non-empty bins]
+    """
+    if table is None:
+        table = LandauGaussTable()
+    if start is not None:
+        # Only the Landau part seeds the Landau fit, the Gauss width then starts as for a
+        # cold start (near sigma_gauss = 0 the iteration could stop early otherwise)
+        start = numpy.asarray(start, dtype=numpy.float64).reshape(-1, 4)[:, :3]
+    landau = fit_landau_batch(contents, x_min, x_max, negative, max_iterations=max_iterations,
+                              tolerance=tolerance, start=start)
+    contents, x, negative, integral, mean, rms, weights = _prepare(contents, x_min, x_max, negative)
+
+    # Start: the Landau fit with part of the width given to the Gaussian
+    parameters = numpy.zeros((len(contents), 4))
+    parameters[:, 0] = landau[:, 0]
+    parameters[:, 1] = numpy.where(negative, -landau[:, 1], landau[:, 1])
+    parameters[:, 2] = landau[:, 2] * 0.8
+    parameters[:, 3] = landau[:, 2] * 0.4
+
+    def valid(parameters):
+        return (parameters[:, 2] > 0) & (parameters[:, 3] >= 0) & (parameters[:, 3] <= table.r_max * parameters[:, 2])
+
+    parameters, errors, chi2 = _levenberg_marquardt(contents, weights, parameters, landau_gauss_model(x, table),
+                                                    valid, max_iterations, tolerance)
+    parameters[:, 1] = numpy.where(negative, -parameters[:, 1], parameters[:, 1])
+    if full_output:
+        return [parameters, errors, chi2, (contents > 0).sum(axis=1)]
+    return parameters
+
+
+# End of fit_landau_gauss_batch
+
+
+###############################
+# robust_estimators
+###############################
+
+# FWHM of the Landau density in units of its width parameter
+LANDAU_FWHM = 4.0186
+
+
+def robust_estimators(contents, x_min, x_max, negative=None, fraction=0.8):
+    """ Fit-free estimates for every row of contents (same conventions as fit_landau_batch):
+    - mode: maximum bin, refined by the parabola through it and its two neighbours
+    - truncated_mean: mean of the lowest fraction of the entries (of the highest for
+      negative histograms, i.e. without the Landau tail)
+    - median
+    - width: FWHM / LANDAU_FWHM, corresponds to the width parameter of a Landau
+    Entries in partially included bins are counted proportionally, all at the bin center.
+
+    :return: dictionary name -> array (N_hist) with the names above, NaN for empty rows
+    """
+    contents, x, negative, integral, mean, rms, weights = _prepare(contents, x_min, x_max, negative)
+    n_hist, n_bins = contents.shape
+    width = x[1] - x[0] if n_bins > 1 else x_max - x_min
+    rows = numpy.arange(n_hist)
+    index = numpy.arange(n_bins)
+
+    # Mode
+    peak = contents.argmax(axis=1)
+    inner = (peak > 0) & (peak < n_bins - 1)
+    left = contents[rows, numpy.maximum(peak - 1, 0)]
+    center = contents[rows, peak]
+    right = contents[rows, numpy.minimum(peak + 1, n_bins - 1)]
+    curvature = left - 2 * center + right
+    with numpy.errstate(all='ignore'):
+        shift = numpy.where(inner & (curvature < 0), 0.5 * (left - right) / curvature, 0.)
+    mode = x[peak] + numpy.clip(shift, -0.5, 0.5) * width
+
+    # Truncated mean and median from the cumulative distribution
+    below = numpy.cumsum(contents, axis=1) - contents
+    cut = fraction * integral
+    included = numpy.clip(cut[:, numpy.newaxis] - below, 0, contents)
+    with numpy.errstate(all='ignore'):
+        truncated_mean = (included * x).sum(axis=1) / cut
+        i_median = numpy.minimum((below + contents < 0.5 * integral[:, numpy.newaxis]).sum(axis=1), n_bins - 1)
+        median = x_min + width * (i_median + (0.5 * integral - below[rows, i_median]) / contents[rows, i_median])
+
+    # Full width at half maximum, linear interpolation between the bins around the crossings
+    half = 0.5 * center
+    low = contents < half[:, numpy.newaxis]
+    i_left = numpy.where(low & (index < peak[:, numpy.newaxis]), index, -1).max(axis=1)
+    i_right = numpy.where(low & (index > peak[:, numpy.newaxis]), index, n_bins).min(axis=1)
+    with numpy.errstate(all='ignore'):
+        l0 = numpy.maximum(i_left, 0)
+        l1 = numpy.minimum(l0 + 1, n_bins - 1)
+        x_left = numpy.where(i_left >= 0, x[l0] + width * (half - contents[rows, l0]) /
+                             (contents[rows, l1] - contents[rows, l0]), x_min)
+        r1 = numpy.minimum(i_right, n_bins - 1)
+        r0 = numpy.maximum(r1 - 1, 0)
+        x_right = numpy.where(i_right < n_bins, x[r0] + width * (contents[rows, r0] - half) /
+                              (contents[rows, r0] - contents[rows, r1]), x_max)
+    fwhm = x_right - x_left
+
+    estimates = {"mode": mode, "truncated_mean": truncated_mean, "median": median,
+                 "width": fwhm / LANDAU_FWHM}
+    for name in ["mode", "truncated_mean", "median"]:
+        estimates[name] = numpy.where(negative, -estimates[name], estimates[name])
+    for name in estimates:
+        estimates[name] = numpy.where(integral > 0, estimates[name], numpy.nan)
+    return estimates
+
+
+# End of robust_estimators
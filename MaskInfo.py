@@ -27,6 +27,10 @@ class MaskInfo:
     #    S30-DATA-2030
     masks = {}
 
+    # The masks are read from this file on first access (see get_masks)
+    filename = "masks.json"
+    loaded = False
+
 
     # Helper function: create_name
     # Create name (used as key for masks dict) from diamond, data_type and mask_time
@@ -98,10 +102,18 @@ class MaskInfo:
         for k, v in data.iteritems():
             # print k, v
             MaskInfo(**v)
+        cls.loaded = True
         # print '\tLoad: ',k, v
 
         # End of to_JSON
 
+    # The masks dictionary, loaded from MaskInfo.filename if nothing was loaded yet
+    @classmethod
+    def get_masks(cls):
+        if not cls.loaded:
+            cls.load(cls.filename)
+        return cls.masks
+
 
 # End of class MaskInfo  
 
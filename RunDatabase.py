@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+SQLite storage of the run information (see RunInfo).
+
+Every run is one row: the run number, the columns used to select runs
+(data_type, diamond, pedestal_run, bias_voltage, all indexed) and the complete
+run information as JSON. Updating a run writes only its row, inside a
+transaction, so many processes can store their results at the same time
+without overwriting each other.
+
+runs.json stays the format to exchange and edit the run information: an empty
+database is filled from the JSON file next to it (runs.db <- runs.json), and
+
+python RunDatabase.py export runs.json [runs.db]
+python RunDatabase.py import runs.json [runs.db]
+
+write the database to JSON and (re)place all runs in the database by the
+content of a JSON file.
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+import sys
+import json
+import sqlite3
+import contextlib
+
+
+###############################
+# Class: RunDatabase
+###############################
+
+class RunDatabase:
+    """ Run information (dictionaries as in runs.json) in an SQLite file, see module documentation.
+
+    Example:
+    database = RunDatabase('runs.db')
+    info = database.read()[70]
+    info['pedestal'] = 12.3
+    database.write([info])
+    print database.select(data_type=0, pedestal_run=70)
+    """
+
+    # Columns next to the JSON of a run, all with an index
+    columns = ['data_type', 'diamond', 'pedestal_run', 'bias_voltage']
+
+    # Wait this long [s] for other processes writing to the database
+    timeout = 600.
+
+    def __init__(self, filename='runs.db', json_filename=None):
+        self.filename = filename
+        if json_filename is None:
+            json_filename = os.path.splitext(filename)[0] + '.json'
+        # Transactions are started explicitly (see transaction)
+        self.connection = sqlite3.connect(filename, timeout=self.timeout, isolation_level=None)
+        self.depth = 0
+        with self.transaction():
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (number INTEGER PRIMARY KEY, {0}, info TEXT)'
+                                    .format(', '.join(self.columns)))
+            for column in self.columns:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS runs_{0} ON runs ({0})'.format(column))
+            if os.path.exists(json_filename) and not self.connection.execute('SELECT count(*) FROM runs').fetchone()[0]:
+                self.import_json(json_filename)
+
+    # End __init__
+
+    @staticmethod
+    def is_database(filename):
+        """ Whether the run information in filename is stored in a database (else JSON) """
+        return filename.endswith('.db')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Other processes can not write until the (outermost) transaction is committed.
+        An exception rolls the transaction back. """
+        if self.depth == 0:
+            self.connection.execute('BEGIN IMMEDIATE')
+        self.depth += 1
+        try:
+            yield
+        except:
+            self.depth -= 1
+            if self.depth == 0:
+                self.connection.execute('ROLLBACK')
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.connection.execute('COMMIT')
+
+    def read(self, numbers=None):
+        """ Dictionary number: run information of all runs (or of the given run numbers) """
+        if numbers is None:
+            rows = self.connection.execute('SELECT number, info FROM runs')
+        else:
+            numbers = list(numbers)
+            rows = self.connection.execute('SELECT number, info FROM runs WHERE number IN ({0})'
+                                           .format(', '.join('?' * len(numbers))), numbers)
+        return dict((number, json.loads(info)) for number, info in rows)
+
+    def write(self, infos):
+        """ Insert or replace the rows of a list of run information dictionaries """
+        with self.transaction():
+            self.connection.executemany('INSERT OR REPLACE INTO runs (number, {0}, info) VALUES (?, {1}, ?)'
+                                        .format(', '.join(self.columns), ', '.join('?' * len(self.columns))),
+                                        [[info['number']] + [info[column] for column in self.columns] +
+                                         [json.dumps(info, sort_keys=True)] for info in infos])
+
+    def replace(self, infos):
+        """ Replace all runs by a list of run information dictionaries """
+        with self.transaction():
+            self.connection.execute('DELETE FROM runs')
+            self.write(infos)
+
+    def select(self, **conditions):
+        """ Sorted numbers of the runs with the given values of the indexed columns, e.g. data_type=0 """
+        for column in conditions:
+            if column not in self.columns:
+                raise Exception('cannot select runs by {0}, only by {1}'.format(column, self.columns))
+        where = ' AND '.join('{0} = ?'.format(column) for column in sorted(conditions))
+        rows = self.connection.execute('SELECT number FROM runs{0} ORDER BY number'.format(' WHERE ' + where if where else ''),
+                                       [conditions[column] for column in sorted(conditions)])
+        return [row[0] for row in rows]
+
+    def import_json(self, json_filename):
+        """ Replace all runs by the content of a runs.json file """
+        f = open(json_filename)
+        data = json.load(f)
+        f.close()
+        self.replace(data.values())
+
+    def export_json(self, json_filename):
+        """ Write all runs to a file in the format of runs.json """
+        filename_tmp = "{0}.{1}.tmp".format(json_filename, os.getpid())
+        f = open(filename_tmp, "w")
+        f.write(json.dumps(self.read(), sort_keys=True, indent=4))
+        f.close()
+        os.rename(filename_tmp, json_filename)
+
+    def close(self):
+        self.connection.close()
+
+
+# End of class RunDatabase
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4] or sys.argv[1] not in ['import', 'export']:
+        print 'usage: python {0} import|export runs.json [runs.db]'.format(sys.argv[0])
+        sys.exit(-1)
+    database_filename = sys.argv[3] if len(sys.argv) == 4 else 'runs.db'
+    database = RunDatabase(database_filename, json_filename=sys.argv[2])
+    if sys.argv[1] == 'import':
+        database.import_json(sys.argv[2])
+    else:
+        database.export_json(sys.argv[2])
+    print '{0}ed {1} runs'.format(sys.argv[1], len(database.select()))
+    database.close()
@@ -9,22 +9,24 @@ Class RunInfo for 2014 September PSI Testbeam Analysis.
 # Imports
 ###############################
 
+import re
 import json
+import math
+import glob
 import types as t
 
 from Initializer import initializer
 from MaskInfo import MaskInfo
 from DataTypes import data_types
-import portalocker
+from RunDatabase import RunDatabase
 import os
+import fcntl
 
 
 def signum(x):
     return (x > 0) - (x < 0)
 
 
-MaskInfo.load("masks.json")
-
 ###############################
 # MaskInfo
 ###############################
@@ -36,6 +38,9 @@ class RunInfo:
     #  -keys = run number
     runs = {}
 
+    # File used by update_run_info (*.db: SQLite database, else JSON)
+    filename = "runs.db"
+
     # initializer - a member variable is automatically created
     #  for each argument of the constructor
     @initializer
@@ -104,9 +109,123 @@ class RunInfo:
         assert (type(calibration_event_fraction) is t.FloatType),"invalid calibration_event_fraction \"{0}\"".format(calibration_event_fraction)
 
         # Add to runs dictionary
-        RunInfo.runs[self.number] = self
+        RunInfo.register(self)
 
     # End of __init__
+
+    # Keep the indexes up to date when an attribute of a registered run changes
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        if RunInfo.runs.get(self.__dict__.get('number')) is self:
+            RunInfo.index_remove(self)
+            RunInfo.index_add(self)
+
+    # Add a run to the runs dictionary (replacing a run with the same number)
+    @classmethod
+    def register(cls, run):
+        if run.number in cls.runs:
+            cls.index_remove(cls.runs[run.number])
+        cls.runs[run.number] = run
+        cls.index_add(run)
+
+    ###############################
+    # Queries
+    ###############################
+
+    # Indexes are built on first use by query and kept up to date by register and __setattr__
+    #  -key: attribute name or one of the derived keys below
+    #  -indexes[key] = {value: set of run numbers}, index_values[key] = {run number: value}
+    indexes = {}
+    index_values = {}
+
+    # Keys computed from a run
+    derived_keys = {
+        'mask': lambda run: run.get_mask_key(),
+        'has_timing': lambda run: run.calibration_event_fraction > 0.,
+        'has_pedestal': lambda run: not math.isnan(run.pedestal),
+        'has_plots': lambda run: run.number in RunInfo.plots(),
+    }
+
+    # Numbers of the runs with results/run_<number>/plots.pdf, found once per process (see invalidate)
+    runs_with_plots = None
+
+    @classmethod
+    def plots(cls):
+        if cls.runs_with_plots is None:
+            cls.runs_with_plots = set()
+            for name in glob.glob('results/run_*/plots.pdf'):
+                # skip other directories, e.g. results/run_70_old
+                match = re.match(r'run_(\d+)$', os.path.basename(os.path.dirname(name)))
+                if match:
+                    cls.runs_with_plots.add(int(match.group(1)))
+        return cls.runs_with_plots
+
+    @classmethod
+    def index_value(cls, run, key):
+        if key in cls.derived_keys:
+            return cls.derived_keys[key](run)
+        return getattr(run, key)
+
+    @classmethod
+    def index_add(cls, run):
+        for key, index in cls.indexes.items():
+            value = cls.index_value(run, key)
+            index.setdefault(value, set()).add(run.number)
+            cls.index_values[key][run.number] = value
+
+    @classmethod
+    def index_remove(cls, run):
+        for key, index in cls.indexes.items():
+            if run.number not in cls.index_values[key]:
+                continue
+            value = cls.index_values[key].pop(run.number)
+            index[value].discard(run.number)
+            if not index[value]:
+                del index[value]
+
+    @classmethod
+    def index(cls, key):
+        """ {value: set of run numbers} of an attribute or derived key """
+        if key not in cls.indexes:
+            cls.indexes[key] = {}
+            cls.index_values[key] = {}
+            for number, run in cls.runs.items():
+                value = cls.index_value(run, key)
+                cls.indexes[key].setdefault(value, set()).add(number)
+                cls.index_values[key][number] = value
+        return cls.indexes[key]
+
+    @classmethod
+    def invalidate(cls, key=None):
+        """ Build the index of key (default: all) again on next use, e.g. has_plots after new plots """
+        if key in [None, 'has_plots']:
+            cls.runs_with_plots = None
+        for k in cls.indexes.keys():
+            if key in [None, k]:
+                del cls.indexes[k]
+                del cls.index_values[k]
+
+    @classmethod
+    def query(cls, **conditions):
+        """ Runs (sorted by number) matching all conditions key=value, a list of values matches any of them.
+        Keys are attributes (data_type, diamond, bias_voltage, pedestal_run, ...) or derived keys
+        (mask, has_timing, has_pedestal, has_plots). Example: data runs of S129 at -500 V without plots
+        RunInfo.query(data_type=0, diamond='S129', bias_voltage=-500, has_plots=False)
+        """
+        selected = []
+        for key, values in conditions.items():
+            if type(values) not in [t.ListType, t.TupleType, set]:
+                values = [values]
+            index = cls.index(key)
+            numbers = set()
+            for value in values:
+                numbers.update(index.get(value, ()))
+            selected.append(numbers)
+        if not selected:
+            return [cls.runs[number] for number in sorted(cls.runs)]
+        selected.sort(key=len)
+        numbers = selected[0].intersection(*selected[1:])
+        return [cls.runs[number] for number in sorted(numbers)]
     @staticmethod
     def update_timing(run, align_ev_pixel, align_ev_pad, time_offset, time_drift):
         RunInfo.runs[run].align_ev_pixel = align_ev_pixel
@@ -114,15 +233,49 @@ class RunInfo:
         RunInfo.runs[run].time_offset = time_offset
         RunInfo.runs[run].time_drift = time_drift
 
+    # Fields of a run written by the timing alignment
+    timing_fields = ['align_ev_pixel', 'align_ev_pad', 'time_offset', 'time_drift', 'calibration_event_fraction',
+                     'time_pad_data', 'time_pixel_data', 'time_timing_alignment']
+
+    # Write the fields (list of names, default: all, e.g. for a new run) of run_timing to RunInfo.filename
     @staticmethod
-    def update_run_info(run_timing):
+    def update_run_info(run_timing, fields=None):
         # run_timing.print_info()
-        print 'save to json: ',run_timing.number
-        RunInfo.load('runs.json')
-        RunInfo.runs[run_timing.number] = run_timing
-        # RunInfo.update_timing(run_timing.run, run_timing.align_pixel, run_timing.align_pad, run_timing.offset,
-        #                       run_timing.slope)
-        RunInfo.dump('runs.json')
+        print 'save to {0}: '.format(RunInfo.filename), run_timing.number
+        if fields is None:
+            fields = run_timing.__dict__.keys()
+        RunInfo.update_fields(run_timing.number, **dict((name, getattr(run_timing, name)) for name in fields))
+
+    # Set some fields of a run in RunInfo.filename. The other fields keep the values in the file,
+    #  also when other processes changed them since this process loaded it
+    @classmethod
+    def update_fields(cls, run_number, **fields):
+        def check(info):
+            unknown = [name for name in fields if name not in info]
+            if unknown:
+                raise Exception('run {0} has no fields {1}'.format(run_number, unknown))
+
+        # In a database only the row of this run is read and written
+        if RunDatabase.is_database(cls.filename):
+            database = cls.database(cls.filename)
+            with database.transaction():
+                info = database.read([run_number]).get(run_number)
+                if info is None:
+                    info = dict(fields, number=run_number)
+                check(info)
+                info.update(fields)
+                database.write([info])
+            RunInfo(**info)
+            return
+
+        def update(runs):
+            if run_number not in runs:
+                RunInfo(**dict(fields, number=run_number))
+                return
+            check(runs[run_number].__dict__)
+            for name, value in fields.items():
+                setattr(runs[run_number], name, value)
+        RunInfo.update_runs(cls.filename, update)
 
     def get_mask_key(self):
         key = MaskInfo.create_name(self.diamond, signum(self.bias_voltage), self.data_type, self.mask_time)
@@ -131,10 +284,11 @@ class RunInfo:
     def get_mask(self):
         #diamond, bias_sign,MaskInfo.data_types[data_type],str(mask_time))
         key = self.get_mask_key()
-        if key in MaskInfo.masks:
-            return MaskInfo.masks[key]
+        masks = MaskInfo.get_masks()
+        if key in masks:
+            return masks[key]
         else:
-            raise Exception('cannot find key {key} in {keys}'.format(key=key, keys=MaskInfo.masks.keys()))
+            raise Exception('cannot find key {key} in {keys}'.format(key=key, keys=masks.keys()))
 
     def print_info(self):
         print 'RunTiming({0}, {1}, {2}, {3}, {4}, "{5}", {6})'.format(self.number,
@@ -150,15 +304,19 @@ class RunInfo:
     #  to a file using json
     @classmethod
     def dump(cls, filename):
+        if RunDatabase.is_database(filename):
+            cls.database(filename).replace([run.__dict__ for run in cls.runs.values()])
+            return
         print 'write new json file'
-        f = open(filename, "w")
-        # portalocker.lock(file, portalocker.LOCK_EX)
-        # portalocker.lock(file, portalocker.LOCK_SH)
+        # write a temporary file first: readers never see a partially written file
+        filename_tmp = "{0}.{1}.tmp".format(filename, os.getpid())
+        f = open(filename_tmp, "w")
         f.write(json.dumps(cls.runs,
                            default=lambda o: o.__dict__,
                            sort_keys=True,
                            indent=4))
         f.close()
+        os.rename(filename_tmp, filename)
 
     # End of to_JSON
 
@@ -166,16 +324,66 @@ class RunInfo:
     @classmethod
     def load(cls, filename):
         # first get the dictionary from the file..
-        f = open(filename, "r")
-        data = json.load(f)
-        f.close()
+        if RunDatabase.is_database(filename):
+            data = cls.database(filename).read()
+        else:
+            f = open(filename, "r")
+            data = json.load(f)
+            f.close()
 
         # ..then intialize the individual RunInfo objects from it
         for k, v in data.iteritems():
             RunInfo(**v)
+        cls.load_times[filename] = os.path.getmtime(filename)
 
             # End of to_JSON
 
+    # Modification time of the file at the last load
+    load_times = {}
+
+    # Load the file again if it was changed since the last load
+    #  (e.g. by other processes analysing other runs)
+    @classmethod
+    def reload(cls, filename):
+        if not os.path.exists(filename) or cls.load_times.get(filename) != os.path.getmtime(filename):
+            cls.load(filename)
+
+    # Open databases by (filename, process): a connection must not be used after a fork
+    databases = {}
+
+    @classmethod
+    def database(cls, filename):
+        key = (filename, os.getpid())
+        if key not in cls.databases:
+            cls.databases[key] = RunDatabase(filename)
+        return cls.databases[key]
+
+    # Read the file, apply update(runs) to the runs dictionary and write it back,
+    #  other processes using update_runs wait in the meantime
+    @classmethod
+    def update_runs(cls, filename, update):
+        if RunDatabase.is_database(filename):
+            # One transaction, only the changed runs are written
+            database = cls.database(filename)
+            with database.transaction():
+                cls.load(filename)
+                before = dict((number, json.dumps(run.__dict__, sort_keys=True)) for number, run in cls.runs.items())
+                update(cls.runs)
+                database.write([run.__dict__ for number, run in cls.runs.items()
+                                if before.get(number) != json.dumps(run.__dict__, sort_keys=True)])
+            cls.load_times[filename] = os.path.getmtime(filename)
+            return
+        lock = open(filename + ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            cls.load(filename)
+            update(cls.runs)
+            cls.dump(filename)
+            cls.load_times[filename] = os.path.getmtime(filename)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
 # End of class RunInfo
 
 if __name__ == "__main__":
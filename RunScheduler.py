@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""
+Scheduler for the complete analysis of all runs in the run database (runs.db).
+
+The analysis of a run depends on other steps:
+ - timing alignment (TimingAlignment.py, action 3) gives the
+   calibration_event_fraction, needed by the analysis of every run
+ - the analysis of a pedestal run gives the pedestal of the data runs
+   which have it as their pedestal_run
+
+The jobs and these dependencies form a graph (DAG). The jobs run on N local
+slots, a job starts as soon as the jobs it depends on are finished, the most
+expensive chains first. A data run therefore starts as soon as its own pedestal
+is known, not when all pedestals are done.
+
+After every job the run database is read again: a job whose inputs are still
+missing (e.g. the timing alignment failed) is skipped together with the jobs
+depending on it.
+
+Timing alignments run as subprocesses (output in results/run_<run>/timing.log),
+analyses on an AnalysisPool (output in results/run_<run>/analyze.log).
+"""
+
+
+# ##############################
+# Imports
+###############################
+
+import os
+import sys
+import math
+import time
+import subprocess
+import multiprocessing
+
+from RunInfo import RunInfo
+from AnalysisPool import AnalysisPool, log_file_name
+
+
+###############################
+# Cost estimate
+###############################
+
+# Cost of a fit in units of the cost of filling one event (rough estimate)
+FIT_COST = 2000.
+# Number of fits of the XY map (Analyze.makeXYPlots: 25 x 25 bins)
+N_XY_FITS = 625
+
+
+def time_bin_width(run):
+    """ Width of the time bins of Analyze.makeTimePlots [s] """
+    if run.rate_trigger < 100:
+        return 600.
+    return 60.
+
+
+def estimate_cost(kind, run):
+    """ Relative cost of a job from the number of events and the trigger rate """
+    events = max(run.events_trig, 0)
+    if kind == 'timing':
+        # alignment search, short pass and the full loop
+        return 3. * events
+    n_fits = N_XY_FITS
+    if run.rate_trigger > 0:
+        n_fits += events / float(run.rate_trigger) / time_bin_width(run)
+    return events + FIT_COST * n_fits
+
+
+###############################
+# Class: Job
+###############################
+
+class Job:
+    """ One step ('timing' or 'analysis') for one run """
+
+    def __init__(self, kind, run):
+        self.kind = kind
+        self.run = run
+        self.cost = estimate_cost(kind, RunInfo.runs[run])
+        # Jobs which have to finish first and jobs waiting for this one
+        self.requires = []
+        self.dependents = []
+        # Cost of this job and of the most expensive chain of jobs after it
+        self.rank = self.cost
+        # waiting, running, done, failed or skipped
+        self.state = 'waiting'
+        self.start = None
+        self.process = None
+
+    # End __init__
+
+    def name(self):
+        return '{0} {1:3d}'.format(self.kind, self.run)
+
+
+# End of class Job
+
+
+###############################
+# Class: RunScheduler
+###############################
+
+class RunScheduler:
+    """ Dependency graph of timing alignments and analyses, see module documentation.
+
+    Example:
+    RunInfo.load('runs.db')
+    scheduler = RunScheduler(n_workers=8)
+    scheduler.build()
+    scheduler.run()
+    """
+
+    def __init__(self, n_workers=None, stages=('timing', 'pedestal', 'data'), fit_engine='numpy',
+                 filename='runs.db'):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = n_workers
+        self.stages = stages
+        self.fit_engine = fit_engine
+        self.filename = filename
+        self.jobs = {}
+        self.pool = None
+
+    # End __init__
+
+    def build(self):
+        """ Create the jobs and dependencies for all runs in RunInfo.runs """
+        self.jobs = {}
+        runs = RunInfo.runs
+        if 'timing' in self.stages:
+            for r in RunInfo.query(data_type=[0, 1], calibration_event_fraction=-1.):
+                self.jobs[('timing', r.number)] = Job('timing', r.number)
+
+        candidates = []
+        if 'pedestal' in self.stages:
+            candidates += RunInfo.query(data_type=1, has_pedestal=False)
+        if 'data' in self.stages:
+            candidates += RunInfo.query(data_type=0, has_plots=False)
+        for r in candidates:
+            has_timing = r.calibration_event_fraction > 0. or ('timing', r.number) in self.jobs
+            has_pedestal = (r.data_type == 1 or not math.isnan(r.pedestal) or
+                            ('analysis', r.pedestal_run) in self.jobs)
+            if has_timing and has_pedestal:
+                self.jobs[('analysis', r.number)] = Job('analysis', r.number)
+
+        for (kind, rn), job in self.jobs.items():
+            if kind != 'analysis':
+                continue
+            requires = [('timing', rn)]
+            if runs[rn].data_type == 0:
+                requires.append(('analysis', runs[rn].pedestal_run))
+            for key in requires:
+                if key in self.jobs:
+                    job.requires.append(self.jobs[key])
+                    self.jobs[key].dependents.append(job)
+
+        # Timing jobs have no requirements, pedestal jobs only timing: dependents are ranked first
+        for job in sorted(self.jobs.values(), key=self.depth, reverse=True):
+            if job.dependents:
+                job.rank = job.cost + max(dependent.rank for dependent in job.dependents)
+
+    def depth(self, job):
+        """ Length of the longest chain of requirements of a job """
+        if not job.requires:
+            return 0
+        return 1 + max(self.depth(required) for required in job.requires)
+
+    def missing_input(self, job):
+        """ Why the job can not run with the current run information, None if it can """
+        r = RunInfo.runs[job.run]
+        if job.kind == 'timing':
+            return None
+        if not r.calibration_event_fraction > 0.:
+            return 'no timing (calibration_event_fraction {0})'.format(r.calibration_event_fraction)
+        if r.data_type == 0 and math.isnan(r.pedestal):
+            return 'no pedestal from run {0}'.format(r.pedestal_run)
+        return None
+
+    def skip(self, job, reason):
+        job.state = 'skipped'
+        print '{0}: skipped, {1}'.format(job.name(), reason)
+        for dependent in job.dependents:
+            if dependent.state == 'waiting':
+                self.skip(dependent, '{0} {1}'.format(job.name(), job.state))
+
+    def start(self, job):
+        job.state = 'running'
+        job.start = time.time()
+        r = RunInfo.runs[job.run]
+        if job.kind == 'timing':
+            log_name = 'results/run_{0}/timing.log'.format(job.run)
+            if not os.path.exists(os.path.dirname(log_name)):
+                os.makedirs(os.path.dirname(log_name))
+            log = open(log_name, 'w')
+            # The alignment uses several processes itself, share the cores between the slots
+            workers = max(1, multiprocessing.cpu_count() / self.n_workers)
+            job.process = subprocess.Popen([sys.executable, 'TimingAlignment.py', str(job.run), '3',
+                                            '-diamond', str(r.diamond), '-voltage', str(r.bias_voltage),
+                                            '--workers', str(workers)],
+                                           stdout=log, stderr=subprocess.STDOUT)
+            log.close()
+        else:
+            if self.pool is None:
+                self.pool = AnalysisPool(self.n_workers, self.fit_engine)
+            self.pool.submit(job.run)
+        print '{0}: started (rank {1:.3g})'.format(job.name(), job.rank)
+
+    def start_ready(self):
+        """ Start the waiting jobs whose requirements are done, highest rank first, while slots are free """
+        RunInfo.reload(self.filename)
+        ready = []
+        for job in self.jobs.values():
+            if job.state != 'waiting':
+                continue
+            not_done = [required for required in job.requires if required.state in ['failed', 'skipped']]
+            if not_done:
+                self.skip(job, '{0} {1}'.format(not_done[0].name(), not_done[0].state))
+            elif all(required.state == 'done' for required in job.requires):
+                reason = self.missing_input(job)
+                if reason is not None:
+                    self.skip(job, reason)
+                else:
+                    ready.append(job)
+        ready = [job for job in ready if job.state == 'waiting']
+        ready.sort(key=lambda job: job.rank, reverse=True)
+        n_running = len(self.running())
+        for job in ready[:max(0, self.n_workers - n_running)]:
+            self.start(job)
+
+    def running(self):
+        return [job for job in self.jobs.values() if job.state == 'running']
+
+    def finish(self, job, status, error=None):
+        job.state = 'done' if status == 'done' else 'failed'
+        print '{0}: {1:<16s} {2:7.1f} s'.format(job.name(), status, time.time() - job.start)
+        if error:
+            print error
+
+    def poll(self):
+        """ Finish the jobs which are done, return their number """
+        n_finished = 0
+        for job in self.running():
+            if job.kind != 'timing' or job.process.poll() is None:
+                continue
+            status = 'done'
+            if job.process.returncode != 0:
+                status = 'failed'
+            self.finish(job, status, None if status == 'done' else
+                        'exit code {0}, log in results/run_{1}/timing.log'.format(job.process.returncode, job.run))
+            n_finished += 1
+        if self.pool is not None:
+            result = self.pool.poll()
+            while result is not None:
+                error = result['error']
+                if result['status'] != 'done':
+                    error = '{0}log in {1}'.format(error + '\n' if error else '', log_file_name(result['run']))
+                self.finish(self.jobs[('analysis', result['run'])], result['status'], error)
+                n_finished += 1
+                result = self.pool.poll()
+        return n_finished
+
+    def run(self):
+        """ Run all jobs, return dictionary state: list of runs """
+        start = time.time()
+        self.start_ready()
+        while self.running():
+            if self.poll():
+                self.start_ready()
+            else:
+                time.sleep(0.2)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+        summary = {}
+        for job in self.jobs.values():
+            summary.setdefault(job.state, []).append(job.name())
+        print 'finished in {0:.1f} s'.format(time.time() - start)
+        for state in sorted(summary):
+            print '{0:>8s}: {1}'.format(state, ', '.join(sorted(summary[state])))
+        return summary
+
+
+# End of class RunScheduler
@@ -13,10 +13,6 @@ Also produce tracking based analysis plots.
 import sys
 import argparse
 
-import ROOT
-
-import TimingAlignmentClass
-
 # ##############################
 # Configuration
 # ##############################
@@ -30,11 +26,33 @@ parser.add_argument('action', metavar='A', type=int,
 parser.add_argument('-diamond', type=str, help='only needed for action=3')
 parser.add_argument('-voltage', type=int, help='only needed for action=3')
 parser.add_argument('--output-dir', '-o', dest='output', help='output directory', default='./results/')
+parser.add_argument('--workers', '-j', dest='workers', type=int, default=None,
+                    help='number of processes for the alignment search and the loop (default: number of cores)')
+parser.add_argument('--seeding', dest='seeding', choices=['grid', 'correlation'], default='grid',
+                    help='how to find the first alignment: try all pad/pixel seeds (grid) or '
+                         'cross-correlate the time differences between events (correlation)')
+parser.add_argument('--matching', dest='matching', choices=['window', 'tracking', 'banded'], default='window',
+                    help='window: best pixel event around the previous match, '
+                         'tracking: also update time offset/drift while matching (action=3 then needs no short pass), '
+                         'banded: align the event sequences allowing missing events in both streams')
+parser.add_argument('--resume', dest='resume', action='store_true',
+                    help='continue an interrupted analysis from its last checkpoint')
+parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                    help='directory for the cached input branches, e.g. ./branch_cache/ (default: no cache)')
+parser.add_argument('--cache-size', dest='cache_size', type=float, default=20.,
+                    help='maximal size of the branch cache in GB')
 args = parser.parse_args()
 
 run = args.run
 action = args.action
 
+# Imported after the arguments are checked: --help and wrong arguments do not wait for ROOT
+import ROOT
+
+import TimingAlignmentClass
+from BranchCache import BranchCache
+from RunInfo import RunInfo
+
 
 print 'Run', args.run
 print 'action', args.action
@@ -100,14 +118,10 @@ filename_pixel = format_pixel.format(basedir_pixel, run)
 f_pad = ROOT.TFile.Open(filename_pad)
 f_pixel = ROOT.TFile.Open(filename_pixel)
 if not f_pad:
-    RunInfo.load('runs.json')
-    RunInfo.runs[run].calibration_event_fraction = -3
-    RunInfo.update_run_info(RunInfo.runs[run])
+    RunInfo.update_fields(run, calibration_event_fraction=-3.)
     raise Exception('Cannot find Pad File')
 if not f_pixel:
-    RunInfo.load('runs.json')
-    RunInfo.runs[run].calibration_event_fraction = -4
-    RunInfo.update_run_info(RunInfo.runs[run])
+    RunInfo.update_fields(run, calibration_event_fraction=-4.)
     raise Exception('Cannot find Pixel File')
 
 
@@ -116,7 +130,15 @@ if not f_pixel:
 # Actual work
 # ##############################
 
-TA = TimingAlignmentClass.TimingAlignment(run, f_pixel, f_pad, branch_names)
+cache = None
+if args.cache_dir:
+    cache = BranchCache(args.cache_dir, int(args.cache_size * 1024 ** 3))
+TA = TimingAlignmentClass.TimingAlignment(run, f_pixel, f_pad, branch_names, cache)
+if args.workers is not None:
+    TA.n_workers = args.workers
+TA.alignment_seeding = args.seeding
+TA.matching = args.matching
+TA.resume = args.resume
 if True:
     if (action == 0) or (action == 1):
         # TaH.print_run_info(run, tree_pixel, tree_pad, branch_names)
@@ -132,7 +154,11 @@ if True:
         # TaH.RunTiming(run, diamond_name=diamond, bias_voltage=bias_voltage)
         TA.set_action(action)
         TA.find_first_alignment()
-        TA.set_action(1)
-        TA.analyse()
-        TA.set_action(0)
-        TA.analyse()
\ No newline at end of file
+        if args.matching == 'tracking':
+            # One full pass gives the final timing constants (and writes them)
+            TA.analyse()
+        else:
+            TA.set_action(1)
+            TA.analyse()
+            TA.set_action(0)
+            TA.analyse()
\ No newline at end of file
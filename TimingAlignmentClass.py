@@ -6,8 +6,16 @@ import os
 import sys
 import array
 import math
+import json
 from RunInfo import RunInfo
 import time
+import numpy
+import EventMatching
+import AlignmentSearch
+import multiprocessing
+from BranchReader import BranchReader
+from HistoCache import HistoCache, tree_fingerprint
+from FitCache import FitCache, cached_fit
 
 try:
     import progressbar
@@ -106,11 +114,19 @@ class Diamond:
 
 # End of class Diamond
 
+# TimingAlignment object shared with the segment worker processes (set before the fork)
+_segment_alignment = {}
+
+
+def _run_segment(segment):
+    return _segment_alignment["alignment"].run_segment(*segment)
+
+
 ###############################
 # Class: TimingAlignment
 ###############################
 class TimingAlignment:
-    def __init__(self, run, f_pixel, f_pad, branch_names):
+    def __init__(self, run, f_pixel, f_pad, branch_names, cache=None):
         self.run = run
         self.action = 0
         self.output_dir = "./results"
@@ -130,8 +146,33 @@ class TimingAlignment:
         self.tree_pad = tree_pad
         self.tree_pixel = tree_pixel
         self.branch_names = branch_names
+        self.chunk_size = 100000
+        # Optional BranchCache for the input branches
+        self.cache = cache
+        self.reader_pad = BranchReader(tree_pad, branch_names, self.chunk_size, cache)
+        self.reader_pixel = BranchReader(tree_pixel, branch_names, self.chunk_size, cache)
         self.histos = {}
+        # Results of the fits in save_histograms (reused when the same histograms are fitted again)
+        self.fit_cache = FitCache()
         self.search_width_pixel = 6
+        self.n_workers = multiprocessing.cpu_count()
+        # How to find the first alignment: 'grid' (try pad/pixel seeds) or 'correlation'
+        self.alignment_seeding = 'grid'
+        # How to match pad and pixel events:
+        #  'window': best pixel event in a window around the previous match
+        #  'tracking': same, but time offset / drift are updated while matching
+        #              (one pass gives the final constants)
+        #  'banded': align the two event sequences, allowing missing events on both sides
+        self.matching = 'window'
+        self.correlation_events = 500
+        # The loop is split into at most n_workers segments of at least this many events
+        self.min_segment_events = 50000
+        # Loop state and partial output are saved every checkpoint_interval events,
+        # with resume = True the loop continues from the last checkpoint
+        self.checkpoint_interval = 300000
+        self.resume = False
+        self.checkpoint = None
+        self.max_correlation_offset = 2000
         self.result_dir = "{0}/run_{1}/".format(self.output_dir, self.run)
         self.tree_out = None
         self.class_time = time.time()
@@ -164,18 +205,41 @@ class TimingAlignment:
         else:
             self.appendix = ''
 
-    def set_branches(self):
+    def set_branches(self, filename_out=None):
 
         # Output ROOT File
-
-        filename_out = "{0}/track_info{1}.root".format(self.result_dir, self.appendix)
-        self.f_out = ROOT.TFile(filename_out, "recreate")
-
-        # Output Tree
-        self.tree_out = ROOT.TTree("track_info", "track_info")
+        if filename_out is None:
+            filename_out = "{0}/track_info{1}.root".format(self.result_dir, self.appendix)
+        if self.checkpoint is not None:
+            # Continue the tree written up to the last checkpoint
+            self.f_out = ROOT.TFile(filename_out, "update")
+            self.tree_out = self.f_out.Get("track_info")
+        else:
+            # Keep the histograms cached in the file by the analysis, the entries they were filled
+            # with are checked when they are used again
+            cached = {}
+            if os.path.exists(filename_out):
+                f_old = ROOT.TFile(filename_out)
+                if f_old and not f_old.IsZombie():
+                    # the variants of the alignment describe the tree which is written again now
+                    cache = HistoCache(f_old)
+                    cached = cache.export([key for key, spec in cache.variants().items() if "action" not in spec])
+                    f_old.Close()
+            self.f_out = ROOT.TFile(filename_out, "recreate")
+            if cached:
+                HistoCache(self.f_out).restore(cached)
+                self.f_out.cd()
+
+            # Output Tree
+            self.tree_out = ROOT.TTree("track_info", "track_info")
+        # Only the checkpoints save the tree header
+        self.tree_out.SetAutoSave(0)
 
         # Output branches
         self.out_branches = {}
+        if self.checkpoint is not None:
+            self.connect_branches()
+            return
 
 
         # Event Number (from pad)
@@ -218,6 +282,14 @@ class TimingAlignment:
         self.out_branches["hit_plane_bits"] = array.array('i', [0])
         self.tree_out.Branch('hit_plane_bits', self.out_branches["hit_plane_bits"], 'hit_plane_bits/I')
 
+    def connect_branches(self):
+        """ Set the output branch buffers of an existing track_info tree """
+        for name, typecode in [('n_pad', 'i'), ('n_matched_pixel', 'i'), ('t_pad', 'f'), ('t_pixel', 'f'),
+                               ('accepted', 'i'), ('track_x', 'f'), ('track_y', 'f'), ('integral50', 'f'),
+                               ('calib_flag', 'i'), ('delta_pixel', 'i'), ('hit_plane_bits', 'i')]:
+            self.out_branches[name] = array.array(typecode, [0])
+            self.tree_out.SetBranchAddress(name, self.out_branches[name])
+
     def init_input_trees(self):
         self.set_events()
         # Get initial-times
@@ -237,7 +309,7 @@ class TimingAlignment:
         self.final_t_pixel = getattr(self.tree_pixel, self.branch_names["t_pixel"])
 
     def initialize_analysis(self):
-        RunInfo.load('runs.json')
+        RunInfo.load('runs.db')
         if self.run not in RunInfo.runs:
             raise Exception('cannot find run {run} in RunInfo json - Please add run first'.format(run=self.run))
         this_info = RunInfo.runs[self.run]
@@ -245,6 +317,9 @@ class TimingAlignment:
         self.run_timing = this_info
         this_mask = this_info.get_mask()
         self.diamond = Diamond(this_mask.diamond, this_mask.min_x, this_mask.max_x, this_mask.min_y, this_mask.max_y)
+        self.checkpoint = None
+        if self.resume:
+            self.checkpoint = self.load_checkpoint()
         self.set_branches()
         self.init_input_trees()
         pass
@@ -331,7 +406,7 @@ class TimingAlignment:
 
     def find_first_alignment(self):
         c = ROOT.TCanvas()
-        RunInfo.load('runs.json')
+        RunInfo.load('runs.db')
 
         max_align_pad = 10
         max_align_pixel = 80
@@ -343,8 +418,8 @@ class TimingAlignment:
         try:
             this_mask = this_info.get_mask()
         except e:
-            this_info.calibration_event_fraction = -5
-            RunInfo.update_run_info(this_info)
+            this_info.calibration_event_fraction = -5.
+            RunInfo.update_run_info(this_info, ['calibration_event_fraction'])
             raise e
         self.mask = this_mask
         self.run_timing = this_info
@@ -362,6 +437,28 @@ class TimingAlignment:
         n_events = 1000
         ensure_dir("{0}/aligning/".format(self.result_dir))
         self.search_width_pixel = 10
+
+        if self.alignment_seeding == 'correlation':
+            best = self.find_correlation_alignment(good_match_threshold, n_events, c)
+            if best is not None:
+                self.set_alignment(best[index_pad], best[index_pixel])
+                return
+            print 'No good match from the cross-correlation, try all pad / pixel events'
+
+        # Time stamps needed by the candidates: the window moves by at most
+        # search_width + 1 pixel events per pad event
+        t_pad = self.reader_pad.read(["t_pad"], 0, n_events)["t_pad"]
+        n_pixel = (self.search_width_pixel + 2) * n_events
+        t_pixel = self.reader_pixel.read(["t_pixel"], 0, n_pixel)["t_pixel"].astype(numpy.int64)
+
+        # Evaluate the candidates in parallel, the serial search below picks up the results
+        candidate_residuals = AlignmentSearch.evaluate_candidates(t_pad, t_pixel,
+                                                                  self.run_timing.time_offset,
+                                                                  self.run_timing.time_drift,
+                                                                  n_events,
+                                                                  good_match_threshold,
+                                                                  self.n_workers)
+
         # Loop over potential pad events for aligning:
         for i_align_pad in xrange(1, max_align_pad):
             if i_align_pad == 1 and len(li_residuals_rms) == 0:
@@ -370,8 +467,7 @@ class TimingAlignment:
                 max_align_pixel = 20
             else:
                 max_align_pixel = 40
-            self.tree_pad.GetEntry(i_align_pad-1)
-            self.initial_t_pad = getattr(self.tree_pad, self.branch_names["t_pad"])
+            self.initial_t_pad = t_pad[i_align_pad-1]
 
             # Loop over potential pixel events for aligning:
             for i_align_pixel in xrange(max_align_pixel):
@@ -380,23 +476,18 @@ class TimingAlignment:
                 elif len(li_residuals_rms) and i_align_pixel >= 40:
                     break
 
-                self.tree_pixel.GetEntry(i_align_pixel)
-                self.initial_t_pixel = getattr(self.tree_pixel, self.branch_names["t_pixel"])
+                self.initial_t_pixel = t_pixel[i_align_pixel]
                 name = "h_pad{i_pad}_pixel{i_pixel}".format(i_pad=i_align_pad, i_pixel=i_align_pixel)
                 self.histos[name] = ROOT.TH1F(name, "", 1600, -0.04, 0.04)
-                i_pixel = 0
-
-                for i_pad in xrange(1, n_events):
-                    self.tree_pad.GetEntry(i_pad-1)
-                    time_pad = getattr(self.tree_pad, self.branch_names["t_pad"])
-
-                    best_match = self.find_associated_pixel_event(i_pixel, time_pad, 1)
-                    self.histos[name].Fill(best_match[1])
 
-                    # Set the starting-value for the next iteration
-                    # Our basis assumption is no-missing event
-                    i_pixel = best_match[0] + 1
-                    # End of loop over pad events
+                # Cancelled by the workers (or no workers): evaluate now
+                if (i_align_pad, i_align_pixel) not in candidate_residuals:
+                    candidate_residuals[(i_align_pad, i_align_pixel)] = AlignmentSearch.candidate_residuals(
+                        t_pad, t_pixel, i_align_pad, i_align_pixel,
+                        self.run_timing.time_offset, self.run_timing.time_drift,
+                        n_events, self.search_width_pixel)
+                for residual in candidate_residuals[(i_align_pad, i_align_pixel)]:
+                    self.histos[name].Fill(residual)
 
                 self.histos[name].Draw()
                 fname = "{0}/aligning/ipad_{1:02d}_ipixel_{2:02d}.".format(self.result_dir, i_align_pad,
@@ -436,59 +527,214 @@ class TimingAlignment:
         best_i_align_pad = sorted(li_residuals_rms, key=lambda x: abs(x[index_rms]))[0][index_pad]
 
 
+        self.set_alignment(best_i_align_pad, best_i_align_pixel)
+
+    def find_correlation_alignment(self, good_match_threshold, n_events, c):
+        """ Find the alignment from the cross-correlation of the time differences between
+        consecutive pad and pixel events. Only the best offsets are checked with the residual RMS.
+        Return [pixel_event, pad_event, residual RMS, residual mean] or None if no offset is good
+        """
+        n_pad = self.correlation_events + n_events
+        n_pixel = n_pad + self.max_correlation_offset + (self.search_width_pixel + 2) * n_events
+        t_pad = self.reader_pad.read(["t_pad"], 0, n_pad)["t_pad"]
+        t_pixel = self.reader_pixel.read(["t_pixel"], 0, n_pixel)["t_pixel"].astype(numpy.int64)
+
+        offsets = AlignmentSearch.correlation_offsets(t_pad[:self.correlation_events],
+                                                      t_pixel[:self.correlation_events + self.max_correlation_offset],
+                                                      self.max_correlation_offset)
+        li_residuals_rms = []
+        for offset, correlation in offsets:
+            i_align_pad, i_align_pixel = AlignmentSearch.offset_to_candidate(offset)
+            residuals = AlignmentSearch.candidate_residuals(t_pad, t_pixel, i_align_pad, i_align_pixel,
+                                                            self.run_timing.time_offset,
+                                                            self.run_timing.time_drift,
+                                                            n_events,
+                                                            self.search_width_pixel,
+                                                            i_start=i_align_pixel + 1,
+                                                            first_pad=i_align_pad - 1)
+            name = "h_correlation_offset{0}".format(offset)
+            self.histos[name] = ROOT.TH1F(name, "", 1600, -0.04, 0.04)
+            for residual in residuals:
+                self.histos[name].Fill(residual)
+            self.histos[name].Draw()
+            c.Print(os.path.abspath("{0}/aligning/correlation_offset_{1}.pdf".format(self.result_dir, offset)))
+
+            print "Offset {0:5d} (Correlation {1:.3f}): Pad Event {2:2d} / Pixel Event {3:4d}: Mean: {4:+2.6f} RMS:{5:+2.6f} Integral: {6:4.0f}".format(
+                offset, correlation, i_align_pad, i_align_pixel,
+                self.histos[name].GetMean(), self.histos[name].GetRMS(), self.histos[name].Integral())
+
+            if self.histos[name].Integral() > 900 and self.histos[name].GetRMS() < good_match_threshold:
+                li_residuals_rms.append(
+                    [i_align_pixel, i_align_pad, self.histos[name].GetRMS(), self.histos[name].GetMean()])
+
+        if len(li_residuals_rms) == 0:
+            return None
+        return sorted(li_residuals_rms, key=lambda x: abs(x[2]))[0]
+
+    def set_alignment(self, best_i_align_pad, best_i_align_pixel):
         print "Best pad / pixel event for alignment: ", best_i_align_pad, best_i_align_pixel
         self.run_timing.align_ev_pixel = best_i_align_pixel
         self.run_timing.align_ev_pad = best_i_align_pad
         self.run_timing.print_info()
         if self.write_json:
-            RunInfo.update_run_info(self.run_timing)
-        pass
+            RunInfo.update_run_info(self.run_timing, ['align_ev_pixel', 'align_ev_pad'])
 
-    def loop(self):
-        i_pixel = self.run_timing.align_ev_pixel
+    def match_events(self, first=None, last=None, i_start=None):
+        """ Match the pad entries [first, last) (default: all events of the loop) to pixel events
+        in one pass over the time stamps (vectorized, or event by event while tracking the clock drift).
+        i_start is the pixel event matched before first (default: the alignment event).
+        Returns [pad entries, i_best, delta_t, time_pixel_in_pad]
+        """
+        if first is None:
+            first = self.run_timing.align_ev_pad - 1
+        if last is None:
+            last = self.max_events - 1
+        if i_start is None:
+            i_start = self.run_timing.align_ev_pixel
+        pad_entries = numpy.arange(first, last)
+        if len(pad_entries) == 0:
+            return [pad_entries, numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0)]
+        t_pad = self.reader_pad.read_all(["t_pad"], int(pad_entries[0]), int(pad_entries[-1]) + 1)["t_pad"]
+        t_pixel = self.reader_pixel.read_all(["t_pixel"])["t_pixel"].astype(numpy.int64)
+        if self.matching == 'banded':
+            match = EventMatching.align_banded(t_pad,
+                                               t_pixel,
+                                               self.initial_t_pixel,
+                                               self.initial_t_pad,
+                                               self.run_timing.time_offset,
+                                               self.run_timing.time_drift)
+            self.report_skipped(pad_entries, match[3], match[4])
+            match = match[:3]
+        elif self.matching == 'tracking':
+            match = EventMatching.match_events_tracking(t_pad,
+                                                        t_pixel,
+                                                        self.initial_t_pixel,
+                                                        self.initial_t_pad,
+                                                        self.run_timing.time_offset,
+                                                        self.run_timing.time_drift,
+                                                        i_start,
+                                                        self.search_width_pixel)
+            print "Tracked time offset: {0:+.3e} -> {1:+.3e}, drift: {2:+.3e} -> {3:+.3e}, {4:.1f} pixel events per pad event".format(
+                self.run_timing.time_offset, match[3], self.run_timing.time_drift, match[4],
+                float(match[5]) / max(1, len(pad_entries)))
+            self.run_timing.time_offset = match[3]
+            self.run_timing.time_drift = match[4]
+            match = match[:3]
+        else:
+            match = EventMatching.match_events(t_pad,
+                                               t_pixel,
+                                               self.initial_t_pixel,
+                                               self.initial_t_pad,
+                                               self.run_timing.time_offset,
+                                               self.run_timing.time_drift,
+                                               i_start,
+                                               self.search_width_pixel)
+        return [pad_entries] + match
+
+    def report_skipped(self, pad_entries, skipped_pad, skipped_pixel):
+        """ Print and save the ranges of pad / pixel events without partner (banded matching) """
+        skipped = {"pad": [[int(pad_entries[first]), int(pad_entries[last])] for first, last in skipped_pad],
+                   "pixel": skipped_pixel}
+        print "Skipped {0} pad events in {1} ranges and {2} pixel events in {3} ranges".format(
+            sum(last - first + 1 for first, last in skipped["pad"]), len(skipped["pad"]),
+            sum(last - first + 1 for first, last in skipped["pixel"]), len(skipped["pixel"]))
+        for first, last in skipped["pad"]:
+            if last - first >= 9:
+                print "  pad entries {0} - {1} skipped".format(first, last)
+        for first, last in skipped["pixel"]:
+            if last - first >= 9:
+                print "  pixel entries {0} - {1} skipped".format(first, last)
+        f = open("{0}/skipped_events{1}.json".format(self.result_dir, self.appendix), "w")
+        f.write(json.dumps(skipped, sort_keys=True, indent=4))
+        f.close()
+
+    def loop(self, first=None, last=None, i_pixel=None, show_progress=True):
+        """ Match and fill the pad entries [first, last) (default: all events of the loop).
+        i_pixel is the pixel event matched before first (default: the alignment event).
+        Return [last matched pixel event, state of the accepted branch]
+        """
+        if i_pixel is None:
+            i_pixel = self.run_timing.align_ev_pixel
+        # Checkpoints are written for the loop over all events
+        checkpoints = first is None and last is None
+        time_offset = self.run_timing.time_offset
+        time_drift = self.run_timing.time_drift
+        i_ev_start = 0
+        if checkpoints and self.checkpoint is not None:
+            i_ev_start = self.checkpoint["next_event"]
+            i_pixel = self.checkpoint["i_pixel"]
+            self.out_branches["accepted"][0] = self.checkpoint["accepted"]
+            print "Resume at pad entry {0}".format(self.run_timing.align_ev_pad - 1 + i_ev_start)
         bar = None
-        if progressbar_loaded:
+        if progressbar_loaded and show_progress:
             widgets = [progressbar.Bar('=', ' [', ']'), ' ', progressbar.Percentage()]
             # bar = progressbar.ProgressBar("Analyzed Events:",maxval=max_events, widgets=widgets).start()
             bar = progressbar.ProgressBar(maxval=self.max_events, widgets=widgets, term_width=50).start()
 
-        for i_pad in xrange(self.run_timing.align_ev_pad,self.max_events):
+        # When resuming, the matching is redone from the start (it is cheap and gives the same result)
+        pad_entries, matched_pixel, matched_delta_t, matched_time_pixel = self.match_events(
+            first, last, None if checkpoints else i_pixel)
+        if len(pad_entries) <= i_ev_start:
+            return [i_pixel, self.out_branches["accepted"][0]]
+
+        # Pad quantities are read column-wise, chunk by chunk. The pixel quantities are
+        # gathered for the pixel events matched to the pad events of each chunk.
+        pad_keys = ["t_pad", "n_pad", "calib_flag_pad", "integral_50_pad"]
+        pixel_keys = ["plane_bits_pixel", "track_x", "track_y"]
+        pad_chunks = self.reader_pad.iter_chunks(pad_keys, int(pad_entries[i_ev_start]), int(pad_entries[-1]) + 1)
+        chunk_first = pad_entries[i_ev_start]
+        chunk_last = chunk_first
+        pad_columns = None
+        pixel_columns = None
+
+        for i_ev in xrange(i_ev_start, len(pad_entries)):
+            i_pad = pad_entries[i_ev] + 1
             if bar:
                 bar.update(i_pad)
-            else:
+            elif show_progress:
                 if i_pad % 1000 == 0: print "{0} / {1}".format(i_pad, self.max_events)
 
-            self.tree_pad.GetEntry(i_pad-1)
-            time_pad = getattr(self.tree_pad, self.branch_names["t_pad"])
-
-            best_match = self.find_associated_pixel_event(i_pixel, time_pad)
-            delta_pixel = -1* i_pixel
-            i_pixel = best_match[0]
-            delta_pixel += i_pixel
-            self.tree_pixel.GetEntry(i_pixel)
-
-            # Check if we are happy with the timing
-            # (residual below 1 ms)
-            is_correctly_matched = abs(best_match[1]) < 0.001
-            calib_flag = getattr(self.tree_pad, self.branch_names["calib_flag_pad"])
-            integral50 = getattr(self.tree_pad, self.branch_names["integral_50_pad"])
+            if i_pad - 1 >= chunk_last:
+                chunk_first, pad_columns = next(pad_chunks)
+                chunk_last = chunk_first + len(pad_columns["t_pad"])
+                pixel_columns = self.reader_pixel.gather(pixel_keys,
+                                                         matched_pixel[i_ev:i_ev + chunk_last - chunk_first])
+            i_chunk = i_pad - 1 - chunk_first
+            time_pad = pad_columns["t_pad"][i_chunk]
+
+            best_match = [int(matched_pixel[i_ev]), matched_delta_t[i_ev], matched_time_pixel[i_ev]]
+            is_matched = best_match[0] >= 0
+            calib_flag = int(pad_columns["calib_flag_pad"][i_chunk])
+            integral50 = pad_columns["integral_50_pad"][i_chunk]
             time_pixel_in_pad = best_match[2]
 
-            if is_correctly_matched:
-                self.out_branches["accepted"][0] = 1
-            hit_plane_bits = getattr(self.tree_pixel, self.branch_names["plane_bits_pixel"])
-            track_x = getattr(self.tree_pixel, self.branch_names["track_x"])
-            track_y = getattr(self.tree_pixel, self.branch_names["track_y"])
-            self.out_branches['n_matched_pixel'][0] = i_pixel
-            #     # print i_pixel
-            # else:
-            #     hit_plane_bits = -1
-            #     track_x = -999
-            #     track_y = -999
-            #     self.out_branches["accepted"][0] = 0
-            #     self.out_branches['n_matched_pixel'][0] = -1
-
-            self.out_branches["n_pad"][0] = getattr(self.tree_pad, self.branch_names["n_pad"])
+            if is_matched:
+                delta_pixel = -1* i_pixel
+                i_pixel = best_match[0]
+                delta_pixel += i_pixel
+
+                # Check if we are happy with the timing
+                # (residual below 1 ms)
+                is_correctly_matched = abs(best_match[1]) < 0.001
+
+                if is_correctly_matched:
+                    self.out_branches["accepted"][0] = 1
+                hit_plane_bits = int(pixel_columns["plane_bits_pixel"][i_chunk])
+                track_x = pixel_columns["track_x"][i_chunk]
+                track_y = pixel_columns["track_y"][i_chunk]
+                self.out_branches['n_matched_pixel'][0] = i_pixel
+            else:
+                # Skipped by the banded alignment: there is no pixel event for this pad event
+                is_correctly_matched = False
+                delta_pixel = 0
+                time_pixel_in_pad = -1
+                hit_plane_bits = -1
+                track_x = -999
+                track_y = -999
+                self.out_branches["accepted"][0] = 0
+                self.out_branches['n_matched_pixel'][0] = -1
+
+            self.out_branches["n_pad"][0] = int(pad_columns["n_pad"][i_chunk])
             self.out_branches["t_pad"][0] = time_pad
             self.out_branches["t_pixel"][0] = time_pixel_in_pad
             self.out_branches["track_x"][0] = track_x
@@ -498,9 +744,10 @@ class TimingAlignment:
             self.out_branches["hit_plane_bits"][0] = hit_plane_bits
             self.out_branches['delta_pixel'][0] = delta_pixel
             self.tree_out.Fill()
-            self.histos['h_delta_n'].Fill(best_match[0] - i_pixel + 1)
-            self.histos['h'].Fill(best_match[1])
-            self.histos['h2'].Fill(time_pad - self.initial_t_pad, best_match[1])
+            if is_matched:
+                self.histos['h_delta_n'].Fill(best_match[0] - i_pixel + 1)
+                self.histos['h'].Fill(best_match[1])
+                self.histos['h2'].Fill(time_pad - self.initial_t_pad, best_match[1])
 
             if is_correctly_matched:
                 self.histos['h_calib_events'].Fill(hit_plane_bits, calib_flag)
@@ -521,8 +768,233 @@ class TimingAlignment:
                     y_box = ret[1]
                     self.histos['integral_box_matrix'][x_box][y_box].Fill(integral50)
 
+            if checkpoints and (i_ev + 1) % self.checkpoint_interval == 0 and i_ev + 1 < len(pad_entries):
+                self.write_checkpoint(i_ev + 1, i_pixel, time_offset, time_drift)
+        return [i_pixel, self.out_branches["accepted"][0]]
+
+    def checkpoint_file_name(self):
+        return "{0}/checkpoint{1}.json".format(self.result_dir, self.appendix)
+
+    def write_checkpoint(self, next_event, i_pixel, time_offset, time_drift):
+        """ Save the tree and the histograms filled so far to the output file and the loop state
+        to the checkpoint file. next_event is the index of the next event in the loop,
+        time_offset / time_drift are the timing constants at the start of the loop.
+        """
+        self.tree_out.AutoSave("SaveSelf")
+        self.f_out.cd()
+        for key in self.histos:
+            if key == 'integral_box_matrix':
+                for row in self.histos[key]:
+                    for histo in row:
+                        histo.Write("", ROOT.TObject.kOverwrite)
+            else:
+                self.histos[key].Write("", ROOT.TObject.kOverwrite)
+        self.f_out.SaveSelf()
+
+        checkpoint = {"run": self.run,
+                      "align_ev_pad": self.run_timing.align_ev_pad,
+                      "align_ev_pixel": self.run_timing.align_ev_pixel,
+                      "max_events": self.max_events,
+                      "matching": self.matching,
+                      "time_offset": time_offset,
+                      "time_drift": time_drift,
+                      "next_event": next_event,
+                      "i_pixel": int(i_pixel),
+                      "accepted": int(self.out_branches["accepted"][0]),
+                      "tree_entries": int(self.tree_out.GetEntries())}
+        # Replace the old checkpoint only once the new one is complete
+        f = open(self.checkpoint_file_name() + ".tmp", "w")
+        f.write(json.dumps(checkpoint, sort_keys=True, indent=4))
+        f.close()
+        os.rename(self.checkpoint_file_name() + ".tmp", self.checkpoint_file_name())
+
+    def load_checkpoint(self):
+        """ Read the checkpoint of this run and action.
+        Return the checkpoint or None if there is none which fits the current settings
+        """
+        if not os.path.exists(self.checkpoint_file_name()):
+            print "No checkpoint found, start from the beginning"
+            return None
+        checkpoint = json.load(open(self.checkpoint_file_name()))
+
+        self.set_events()
+        expected = {"run": self.run,
+                    "align_ev_pad": self.run_timing.align_ev_pad,
+                    "align_ev_pixel": self.run_timing.align_ev_pixel,
+                    "max_events": self.max_events,
+                    "matching": self.matching}
+        for key in expected:
+            if checkpoint[key] != expected[key]:
+                print "Checkpoint has {0} = {1} instead of {2}, start from the beginning".format(
+                    key, checkpoint[key], expected[key])
+                return None
+
+        filename_out = "{0}/track_info{1}.root".format(self.result_dir, self.appendix)
+        f = ROOT.TFile(filename_out)
+        tree = f.Get("track_info") if f and not f.IsZombie() else None
+        tree_entries = tree.GetEntries() if tree else -1
+        f.Close()
+        if tree_entries != checkpoint["tree_entries"]:
+            print "Output tree has {0} instead of {1} entries, start from the beginning".format(
+                tree_entries, checkpoint["tree_entries"])
+            return None
+
+        # The matching is repeated with the timing constants of the interrupted loop
+        self.run_timing.time_offset = checkpoint["time_offset"]
+        self.run_timing.time_drift = checkpoint["time_drift"]
+        return checkpoint
+
+    def restore_histograms(self):
+        """ Add the histograms saved with the last checkpoint """
+        for key in self.histos:
+            if key == 'integral_box_matrix':
+                histos = [histo for row in self.histos[key] for histo in row]
+            else:
+                histos = [self.histos[key]]
+            for histo in histos:
+                saved = self.f_out.GetKey(histo.GetName()).ReadObj()
+                histo.Add(saved)
+                saved.Delete()
+
+    def segment_file_name(self, i_segment):
+        return "{0}/track_info{1}_segment{2}.root".format(self.result_dir, self.appendix, i_segment)
+
+    def loop_segmented(self):
+        """ Run the loop on n_workers processes, each one on a consecutive segment of the pad events.
+
+        The pixel event matched before a segment is predicted from the time offset / drift
+        (nearest pixel event in time, found by binary search). A segment whose prediction
+        turns out different from the last match of the previous segment is redone with
+        the right starting point, so the output is the same as the one of loop().
+        """
+        first = self.run_timing.align_ev_pad - 1
+        last = self.max_events - 1
+        n_segments = min(self.n_workers, (last - first) / self.min_segment_events)
+        if n_segments <= 1:
+            self.loop()
+            return
+        bounds = [first + (last - first) * i_segment / n_segments for i_segment in xrange(n_segments + 1)]
+
+        # Pixel event matched before each segment
+        t_pixel = self.reader_pixel.read_all(["t_pixel"])["t_pixel"].astype(numpy.int64)
+        t_pad = numpy.array([self.reader_pad.read_entry(["t_pad"], bound - 1)["t_pad"] for bound in bounds[1:-1]])
+        seeds = EventMatching.nearest_pixel_events(t_pad,
+                                                   t_pixel,
+                                                   self.initial_t_pixel,
+                                                   self.initial_t_pad,
+                                                   self.run_timing.time_offset,
+                                                   self.run_timing.time_drift)
+        # The accepted flag is only set, never reset, by the window matching
+        segments = [[0, bounds[0], bounds[1], self.run_timing.align_ev_pixel, 0]]
+        for i_segment in xrange(1, n_segments):
+            segments.append([i_segment, bounds[i_segment], bounds[i_segment + 1], int(seeds[i_segment - 1]), 1])
+
+        print "Loop over {0} segments on {1} processes".format(n_segments, self.n_workers)
+        _segment_alignment["alignment"] = self
+        # Segments finished before an interruption are kept
+        results = [None] * n_segments
+        if self.resume:
+            for segment in segments:
+                results[segment[0]] = self.load_segment(segment)
+        todo = [segment for segment in segments if results[segment[0]] is None]
+        if len(todo) < n_segments:
+            print "Resume: {0} of {1} segments already done".format(n_segments - len(todo), n_segments)
+
+        pool = multiprocessing.Pool(min(self.n_workers, n_segments))
+        try:
+            for segment, result in zip(todo, pool.map(_run_segment, todo)):
+                results[segment[0]] = result
+            for i_segment in xrange(1, n_segments):
+                i_pixel, accepted = results[i_segment - 1]
+                if [segments[i_segment][3], segments[i_segment][4]] != [i_pixel, accepted]:
+                    print "Segment {0}: redo with pixel event {1} instead of {2}".format(
+                        i_segment, i_pixel, segments[i_segment][3])
+                    segments[i_segment][3:] = [i_pixel, accepted]
+                    results[i_segment] = pool.apply(_run_segment, (segments[i_segment],))
+        finally:
+            pool.close()
+            pool.join()
+            _segment_alignment.clear()
+
+        self.merge_segments(n_segments)
+
+    def run_segment(self, i_segment, first, last, i_pixel, accepted):
+        """ Loop over the pad entries [first, last) in a worker process and write
+        the tree and the histograms to a separate file.
+        Return [last matched pixel event, state of the accepted branch]
+        """
+        # Own file handles: the parent's handles share their file offsets after the fork
+        self.f_pad = ROOT.TFile.Open(self.f_pad.GetName())
+        self.f_pixel = ROOT.TFile.Open(self.f_pixel.GetName())
+        self.tree_pad = self.f_pad.Get("rec")
+        self.tree_pixel = self.f_pixel.Get("time_tree")
+        self.reader_pad = BranchReader(self.tree_pad, self.branch_names, self.chunk_size, self.cache)
+        self.reader_pixel = BranchReader(self.tree_pixel, self.branch_names, self.chunk_size, self.cache)
+
+        self.set_branches(self.segment_file_name(i_segment))
+        self.init_histogramms()
+        self.out_branches["accepted"][0] = accepted
+        result = self.loop(first, last, i_pixel, show_progress=False)
+        self.f_out.Write()
+        self.f_out.Close()
+        print "Segment {0}: pad entries {1} - {2} done".format(i_segment, first, last - 1)
+
+        result = [int(result[0]), int(result[1])]
+        f = open(self.segment_file_name(i_segment) + ".json", "w")
+        f.write(json.dumps({"segment": [i_segment, first, last, i_pixel, accepted],
+                            "timing": self.segment_timing(),
+                            "result": result}))
+        f.close()
+        return result
+
+    def segment_timing(self):
+        return [self.run_timing.align_ev_pad, self.run_timing.align_ev_pixel,
+                self.run_timing.time_offset, self.run_timing.time_drift]
+
+    def load_segment(self, segment):
+        """ Result of a segment finished before with the same settings, or None """
+        filename = self.segment_file_name(segment[0]) + ".json"
+        if not os.path.exists(filename) or not os.path.exists(self.segment_file_name(segment[0])):
+            return None
+        done = json.load(open(filename))
+        if done["segment"] != list(segment) or done["timing"] != self.segment_timing():
+            return None
+        return done["result"]
+
+    def merge_segments(self, n_segments):
+        """ Append the segment trees to the output tree and add up the histograms, in segment order """
+        chain = ROOT.TChain("track_info")
+        for i_segment in xrange(n_segments):
+            chain.Add(self.segment_file_name(i_segment))
+        self.f_out.cd()
+        self.tree_out.CopyEntries(chain)
+        del chain
+
+        for i_segment in xrange(n_segments):
+            f_segment = ROOT.TFile(self.segment_file_name(i_segment))
+            for key in self.histos:
+                if key == 'integral_box_matrix':
+                    for row in self.histos[key]:
+                        for histo in row:
+                            histo.Add(f_segment.Get(histo.GetName()))
+                else:
+                    self.histos[key].Add(f_segment.Get(self.histos[key].GetName()))
+            f_segment.Close()
+            os.remove(self.segment_file_name(i_segment))
+            os.remove(self.segment_file_name(i_segment) + ".json")
+        self.f_out.cd()
 
     def save_histograms(self):
+        # Constants the histograms were filled with (the fits below update the timing)
+        spec = {"run": self.run,
+                "action": self.action,
+                "matching": self.matching,
+                "max_events": int(self.max_events),
+                "align_ev_pad": int(self.run_timing.align_ev_pad),
+                "align_ev_pixel": int(self.run_timing.align_ev_pixel),
+                "time_offset": float(self.run_timing.time_offset),
+                "time_drift": float(self.run_timing.time_drift)}
+
         c = ROOT.TCanvas()
         self.histos['h'].GetXaxis().SetTitle("t_{pixel} - t_{pad} [s]")
         self.histos['h'].GetYaxis().SetTitle("Events")
@@ -616,20 +1088,31 @@ class TimingAlignment:
 
         proj_zoom.Draw("COLZ")
         c.Print("{0}/integral_zoom{1}.pdf".format(self.result_dir, self.appendix))
-        for x_pos in range(len(self.histos['integral_box_matrix'])):
-            for y_pos in range(len(self.histos['integral_box_matrix'][x_pos])):
-                fun = ROOT.TF1("", "gaus")
-                self.histos['integral_box_matrix'][x_pos][y_pos].Fit(fun,"Q")
-                print "XXX X: {0} Y: {1} Mean: {2:2.2f} RMS {3:2.2f}".format(x_pos,
-                                                                             y_pos,
-                                                                             fun.GetParameter(1),
-                                                                             fun.GetParameter(2))
-                self.histos['integral_box_matrix'][x_pos][y_pos].Draw()
-                c.Print("{0}/integrals/1d_integral_x_{1}_y_{2}{3}.pdf".format(self.result_dir, x_pos, y_pos,
-                                                                              self.appendix))
-                c.Print("{0}/integrals/1d_integral_x_{1}_y_{2}{3}.png".format(self.result_dir, x_pos, y_pos,
-                                                                              self.appendix))
-        self.f_out.Write()
+        # the fit results are kept also if the plotting fails
+        try:
+            for x_pos in range(len(self.histos['integral_box_matrix'])):
+                for y_pos in range(len(self.histos['integral_box_matrix'][x_pos])):
+                    fun = ROOT.TF1("", "gaus")
+                    cached_fit(self.fit_cache, self.histos['integral_box_matrix'][x_pos][y_pos], fun, "Q")
+                    print "XXX X: {0} Y: {1} Mean: {2:2.2f} RMS {3:2.2f}".format(x_pos,
+                                                                                 y_pos,
+                                                                                 fun.GetParameter(1),
+                                                                                 fun.GetParameter(2))
+                    self.histos['integral_box_matrix'][x_pos][y_pos].Draw()
+                    c.Print("{0}/integrals/1d_integral_x_{1}_y_{2}{3}.pdf".format(self.result_dir, x_pos, y_pos,
+                                                                                  self.appendix))
+                    c.Print("{0}/integrals/1d_integral_x_{1}_y_{2}{3}.png".format(self.result_dir, x_pos, y_pos,
+                                                                                  self.appendix))
+        finally:
+            self.fit_cache.save()
+        self.f_out.Write("", ROOT.TObject.kOverwrite)
+        spec["tree"] = tree_fingerprint(self.tree_out)
+        cache = HistoCache(self.f_out)
+        key = cache.put(spec, [h for h in self.histos.values() if isinstance(h, ROOT.TH1)])
+        # keep only the current variant of this action (e.g. not the one of a previous pass)
+        for other, other_spec in cache.variants().items():
+            if other != key and other_spec.get("action") == self.action:
+                cache.remove(other)
         total_calib_events = 0
         for i in range(1, 17):
             total_calib_events += int(self.histos['h_calib_events'].GetBinContent(i, 2))
@@ -657,10 +1140,18 @@ class TimingAlignment:
         self.initialize_analysis()
         self.init_histogramms()
 
-        self.loop()
+        if self.checkpoint is not None:
+            self.restore_histograms()
+
+        if self.matching == 'window' and self.n_workers > 1 and self.checkpoint is None:
+            self.loop_segmented()
+        else:
+            self.loop()
         self.save_histograms()
+        if os.path.exists(self.checkpoint_file_name()):
+            os.remove(self.checkpoint_file_name())
 
         if self.action != 0:
             if self.write_json:
-                RunInfo.update_run_info(self.run_timing)
+                RunInfo.update_run_info(self.run_timing, RunInfo.timing_fields)
             pass
\ No newline at end of file
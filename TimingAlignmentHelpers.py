@@ -14,6 +14,7 @@ import sys
 import array
 import math
 from RunInfo import RunInfo
+from BranchReader import BranchReader
 
 try:
     import progressbar
@@ -251,7 +252,7 @@ def find_alignment(run, tree_pixel, tree_pad, branch_names, c, output_dir='./res
     ensure_dir(result_dir)
     print result_dir
 
-    RunInfo.load('runs.json')
+    RunInfo.load('runs.db')
 
     max_align_pad = 10
     max_align_pixel = 40
@@ -283,38 +284,38 @@ def find_alignment(run, tree_pixel, tree_pad, branch_names, c, output_dir='./res
     good_match_threshold = 0.000450  # RMS below 390 ns should be a good match
     n_events = 1000
     ensure_dir("{0}/aligning/".format(result_dir))
+
+    # Only the time stamps of the first events are needed
+    t_pad = BranchReader(tree_pad, branch_names).read(["t_pad"], 0, n_events)["t_pad"]
+    t_pixel = BranchReader(tree_pixel, branch_names).read(["t_pixel"], 0, 2 * n_events + max_align_pixel)["t_pixel"]
+
     # Loop over potential pad events for aligning:
     for i_align_pad in xrange(max_align_pad):
 
-        tree_pad.GetEntry(i_align_pad)
-        initial_t_pad = getattr(tree_pad, branch_names["t_pad"])
+        initial_t_pad = t_pad[i_align_pad]
 
         # Loop over potential pixel events for aligning:
         for i_align_pixel in xrange(max_align_pixel):
 
-            tree_pixel.GetEntry(i_align_pixel)
-
-            initial_t_pixel = getattr(tree_pixel, branch_names["t_pixel"])
+            initial_t_pixel = long(t_pixel[i_align_pixel])
 
             h = ROOT.TH1F("h_pad{i_pad}_pixel{i_pixel}".format(i_pad=i_align_pad,i_pixel=i_align_pixel), "", 1600, -0.04, 0.04)
             # h2 = ROOT.TH1F("h_pad{i_pad}_pixel{i_pixel}_xn", "", 800, -0.04, 0.04,100,-.5,1000.5)
             i_pixel = 0
 
 
-            for i_pad in xrange(0, n_events):
+            for i_pad in xrange(0, min(n_events, len(t_pad))):
 
-                tree_pad.GetEntry(i_pad)
-                time_pad = getattr(tree_pad, branch_names["t_pad"])
+                time_pad = t_pad[i_pad]
 
                 delta_ts = []
 
                 for i_pixel_test in range(i_pixel + 1 - 10, i_pixel + 1 + 10):
 
-                    if i_pixel_test < 0:
+                    if i_pixel_test < 0 or i_pixel_test >= len(t_pixel):
                         continue
 
-                    tree_pixel.GetEntry(i_pixel_test)
-                    time_pixel = getattr(tree_pixel, branch_names["t_pixel"])
+                    time_pixel = long(t_pixel[i_pixel_test])
 
                     delta_ts.append([i_pixel_test, pixel_to_pad_time(time_pixel,
                                                                      initial_t_pixel,
@@ -366,7 +367,7 @@ def find_alignment(run, tree_pixel, tree_pad, branch_names, c, output_dir='./res
     run_timing.align_pixel = best_i_align_pixel
     run_timing.align_pad = best_i_align_pad
     run_timing.print_info()
-    RunInfo.update_run_info(run_timing)
+    RunInfo.update_fields(run, align_ev_pixel=run_timing.align_pixel, align_ev_pad=run_timing.align_pad)
 
 
 ###############################
@@ -375,7 +376,7 @@ def find_alignment(run, tree_pixel, tree_pad, branch_names, c, output_dir='./res
 
 def analyze(run, action, tree_pixel, tree_pad, branch_names, c, output_dir="./results"):
     ensure_dir(output_dir + '/')
-    RunInfo.load('runs.json')
+    RunInfo.load('runs.db')
 
     if run not in RunInfo.runs:
         raise Exception('cannot find run {run} in RunInfo json - Please add run first'.format(run=run))
@@ -504,6 +505,16 @@ def analyze(run, action, tree_pixel, tree_pad, branch_names, c, output_dir="./re
     initial_t_pad = getattr(tree_pad, branch_names["t_pad"])
     initial_t_pixel = getattr(tree_pixel, branch_names["t_pixel"])
 
+    # The window scan only needs the time stamps: read them column-wise
+    reader_pad = BranchReader(tree_pad, branch_names)
+    reader_pixel = BranchReader(tree_pixel, branch_names)
+    t_pad = reader_pad.read_all(["t_pad"], 0, max_events)["t_pad"]
+    t_pixel = reader_pixel.read_all(["t_pixel"])["t_pixel"]
+
+    # Phase 1: match on the time stamps, remember the well matched pad / pixel events
+    accepted_pad = []
+    accepted_pixel = []
+
     i_pixel = 0
     if progressbar_loaded:
         widgets = [progressbar.Bar('=', ' [', ']'), ' ', progressbar.Percentage()]
@@ -517,17 +528,15 @@ def analyze(run, action, tree_pixel, tree_pad, branch_names, c, output_dir="./re
             if i_pad % 1000 == 0:
                 print "{0} / {1}".format(i_pad, max_events)
 
-        tree_pad.GetEntry(i_pad)
-        time_pad = getattr(tree_pad, branch_names["t_pad"])
+        time_pad = t_pad[i_pad]
 
         delta_ts = []
         for i_pixel_test in range(i_pixel - 6, i_pixel + 6):
 
-            if i_pixel_test < 0:
+            if i_pixel_test < 0 or i_pixel_test >= len(t_pixel):
                 continue
 
-            tree_pixel.GetEntry(i_pixel_test)
-            time_pixel = getattr(tree_pixel, branch_names["t_pixel"])
+            time_pixel = long(t_pixel[i_pixel_test])
 
             delta_ts.append([i_pixel_test, pixel_to_pad_time(time_pixel,
                                                              initial_t_pixel,
@@ -539,7 +548,6 @@ def analyze(run, action, tree_pixel, tree_pad, branch_names, c, output_dir="./re
         best_match = sorted(delta_ts, key=lambda x: abs(x[1]))[0]
 
         i_pixel = best_match[0]
-        tree_pixel.GetEntry(i_pixel)
 
         h_delta_n.Fill(best_match[0] - i_pixel + 1)
         h.Fill(best_match[1])
@@ -548,43 +556,51 @@ def analyze(run, action, tree_pixel, tree_pad, branch_names, c, output_dir="./re
         # Check if we are happy with the timing
         # (residual below 1 ms)
         if abs(best_match[1]) < 0.001:
-
-            hit_plane_bits = getattr(tree_pixel, branch_names["plane_bits_pixel"])
-            calib_flag = getattr(tree_pad, branch_names["calib_flag_pad"])
-            track_x = getattr(tree_pixel, branch_names["track_x"])
-            track_y = getattr(tree_pixel, branch_names["track_y"])
-            integral50 = getattr(tree_pad, branch_names["integral_50_pad"])
-
-            out_branches["n_pad"][0] = getattr(tree_pad, branch_names["n_pad"])
-            out_branches["t_pad"][0] = time_pad
-            out_branches["accepted"][0] = 1
-            out_branches["track_x"][0] = track_x
-            out_branches["track_y"][0] = track_y
-            out_branches["integral50"][0] = integral50
-            tree_out.Fill()
-
-            h_calib_events.Fill(hit_plane_bits, calib_flag)
-            h_tracks.Fill(track_x, track_y)
-            h_tracks_zoom.Fill(track_x, track_y)
-            h_integral.Fill(track_x, track_y, integral50)
-            h_integral_zoom.Fill(track_x, track_y, integral50)
-
-            ret = coordinate_to_box(track_x,
-                                    track_y,
-                                    diamond.x_pos_min,
-                                    diamond.x_pos_max,
-                                    diamond.y_pos_min,
-                                    diamond.y_pos_max,
-                                    n_boxes)
-
-            if ret != -1:
-                x_box = ret[0]
-                y_box = ret[1]
-                integral_box_matrix[x_box][y_box].Fill(integral50)
-
-                # done filling tree and calibration histogram
+            accepted_pad.append(i_pad)
+            accepted_pixel.append(i_pixel)
     # End of loop over pad events
 
+    # Phase 2: read the payload of the accepted events only
+    pad_columns = reader_pad.gather(["n_pad", "calib_flag_pad", "integral_50_pad"], accepted_pad)
+    pixel_columns = reader_pixel.gather(["plane_bits_pixel", "track_x", "track_y"], accepted_pixel)
+    for i_accepted in xrange(len(accepted_pad)):
+        time_pad = t_pad[accepted_pad[i_accepted]]
+        hit_plane_bits = int(pixel_columns["plane_bits_pixel"][i_accepted])
+        calib_flag = int(pad_columns["calib_flag_pad"][i_accepted])
+        track_x = pixel_columns["track_x"][i_accepted]
+        track_y = pixel_columns["track_y"][i_accepted]
+        integral50 = pad_columns["integral_50_pad"][i_accepted]
+
+        out_branches["n_pad"][0] = int(pad_columns["n_pad"][i_accepted])
+        out_branches["t_pad"][0] = time_pad
+        out_branches["accepted"][0] = 1
+        out_branches["track_x"][0] = track_x
+        out_branches["track_y"][0] = track_y
+        out_branches["integral50"][0] = integral50
+        tree_out.Fill()
+
+        h_calib_events.Fill(hit_plane_bits, calib_flag)
+        h_tracks.Fill(track_x, track_y)
+        h_tracks_zoom.Fill(track_x, track_y)
+        h_integral.Fill(track_x, track_y, integral50)
+        h_integral_zoom.Fill(track_x, track_y, integral50)
+
+        ret = coordinate_to_box(track_x,
+                                track_y,
+                                diamond.x_pos_min,
+                                diamond.x_pos_max,
+                                diamond.y_pos_min,
+                                diamond.y_pos_max,
+                                n_boxes)
+
+        if ret != -1:
+            x_box = ret[0]
+            y_box = ret[1]
+            integral_box_matrix[x_box][y_box].Fill(integral50)
+
+            # done filling tree and calibration histogram
+    # End of loop over accepted events
+
     h.GetXaxis().SetTitle("t_{pixel} - t_{pad} [s]")
     h.GetYaxis().SetTitle("Events")
     h.Draw()
@@ -690,5 +706,6 @@ def analyze(run, action, tree_pixel, tree_pad, branch_names, c, output_dir="./re
 
     f_out.Write()
     if action != 0:
-        RunInfo.update_run_info(run_timing)
+        RunInfo.update_fields(run, align_ev_pixel=run_timing.align_pixel, align_ev_pad=run_timing.align_pad,
+                              time_offset=run_timing.offset, time_drift=run_timing.slope)
 # end of analyze
@@ -1,71 +1,43 @@
 #!/usr/bin/python
 
-import math, sys, os
+import sys
 from RunInfo import RunInfo
-from subprocess import call
+from RunScheduler import RunScheduler
 
 
-do_pedestal = False
-do_data     = False
+stages    = []
+n_workers = None
 
 args = sys.argv
 
+if 'timing' in args or 'tim' in args or 't' in args:
+    stages.append('timing')
 if 'pedestal' in args or 'ped' in args or 'p' in args:
-    do_pedestal = True
+    stages.append('pedestal')
 if 'data' in args or 'dat' in args or 'd' in args:
-    do_data = True
-
-if do_pedestal and do_data:
-    print 'you can do either pedestal or data, not both!'
-    print 'don\'t be greedy'
-    sys.exit()
-
-if not do_pedestal and not do_data:
-    print 'you have to specify either \'data\' or \'pedestal\''
+    stages.append('data')
+if 'all' in args or 'a' in args:
+    stages = ['timing', 'pedestal', 'data']
+for arg in args:
+    ## number of parallel jobs, e.g. -j8 (default: number of cores)
+    if arg.startswith('-j'):
+        n_workers = int(arg[2:])
+
+if not stages:
+    print 'you have to specify \'timing\', \'pedestal\', \'data\' (or several of them) or \'all\''
     print 'don\'t be modest'
     sys.exit()
 
-RunInfo.load('runs.json')
-
+RunInfo.load('runs.db')
 
-if do_pedestal:
-    ped_not = []
-    ped_all = []
-    
-    for rn, r in RunInfo.runs.items():
-        if r.data_type == 1:
-            ped_all.append(rn)
-            if math.isnan(r.pedestal) and r.calibration_event_fraction > 0.:
-                ped_not.append(rn)
-    
-    
-    print 'these are the unanalyzed pedestal runs:'
-    print ped_not
-    
-    for run in ped_not:
-        cmd = 'python Analyze.py '+str(run)
-        print 'calling', cmd
-        call('python Analyze.py '+str(run), shell=True)
+## timing alignment -> pedestal runs -> data runs, each job starts as soon as the jobs it needs are done
+scheduler = RunScheduler(n_workers, stages)
+scheduler.build()
 
-if do_data:
-    dat_not = []
-    dat_all = []
-    
-    for rn, r in RunInfo.runs.items():
-        if r.data_type == 0:
-            dat_all.append(rn)
-            has_pedestal = not math.isnan(r.pedestal)
-            has_timing   = r.calibration_event_fraction > 0.
-            has_plots    = os.path.isfile('results/run_'+str(rn)+'/plots.pdf') # check if a file already exists
+for stage, kind, data_type in [('timing', 'timing', None), ('pedestal', 'analysis', 1), ('data', 'analysis', 0)]:
+    if stage in stages:
+        print 'these are the unanalyzed %s runs:' %stage
+        print sorted(rn for (k, rn) in scheduler.jobs if k == kind and
+                     (data_type is None or RunInfo.runs[rn].data_type == data_type))
 
-            if (has_pedestal and has_timing) and not has_plots:
-                dat_not.append(rn)
-    
-    
-    print 'these are the unanalyzed data runs:'
-    print dat_not
-    
-    for run in dat_not:
-        cmd = 'python Analyze.py '+str(run)
-        print 'calling', cmd
-        call('python Analyze.py '+str(run), shell=True)
+scheduler.run()